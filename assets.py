@@ -0,0 +1,178 @@
+"""Content-hashed static asset bundles.
+
+Running this module concatenates and minifies the CSS and JS listed in
+bundles into static/dist/<name>.<hash>.<ext> and writes assets.json, a
+manifest mapping each bundle name to its hashed URL. A bundle's URL
+changes whenever its content does, so app.yaml serves static/dist with
+a one year lifetime. Templates get the URLs from asset_urls(); without
+a manifest (e.g. a fresh checkout) they get the source files instead.
+
+    python assets.py [--precompress]
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+dist_dir = 'static/dist'
+manifest_path = os.path.join(root_dir, 'assets.json')
+
+# Bundle name: source files, relative to the repo, in load order. The
+# Bootstrap CSS is the hand-modified copy (see bootstrap-modified-css.txt),
+# not the .min files, which lack the blog's changes. head.js is loaded in
+# <head>: html5shiv and respond.js must run before the body is parsed.
+bundles = {
+    'blog.css': ['static/css/vendor/bootstrap.css',
+                 'static/css/vendor/bootstrap-responsive.css',
+                 'static/css/main.css'],
+    'head.js': ['static/js/vendor/modernizr-2.6.1-respond-1.1.0.min.js'],
+    'blog.js': ['static/js/vendor/bootstrap.min.js',
+                'static/js/main.js'],
+}
+
+css_comment_re = re.compile(r'/\*(?!!).*?\*/', re.S)
+css_space_re = re.compile(r'\s+')
+css_punct_re = re.compile(r'\s*([{};,>])\s*')
+css_url_re = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+js_comment_line_re = re.compile(r'^\s*//.*$', re.M)
+
+
+def minify_css(css):
+    """Removes comments (except /*! licenses */) and redundant space"""
+    css = css_comment_re.sub('', css)
+    css = css_space_re.sub(' ', css)
+    css = css_punct_re.sub(r'\1', css)
+    return css.replace(': ', ':').replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """Conservative JS minifier: drops comment-only lines, indentation
+       and blank lines. Line breaks are kept, so semicolon insertion
+       works as in the source.
+    """
+    js = js_comment_line_re.sub('', js)
+    return '\n'.join(line.strip() for line in js.splitlines()
+                     if line.strip())
+
+
+def rebase_urls(css, path):
+    """Makes the relative url()s of the CSS file at path absolute, so
+       they still resolve from static/dist
+    """
+    base = posixpath.dirname('/' + path)
+
+    def rebase(match):
+        url = match.group(2)
+        if url.startswith(('/', 'data:', 'http:', 'https:', '#')):
+            return match.group(0)
+        return 'url({0})'.format(posixpath.normpath(
+            posixpath.join(base, url)))
+    return css_url_re.sub(rebase, css)
+
+
+def build_bundle(name, sources):
+    """Returns the concatenated, minified content of one bundle"""
+    parts = []
+    for path in sources:
+        with open(os.path.join(root_dir, path)) as f:
+            content = f.read()
+        if name.endswith('.css'):
+            parts.append(rebase_urls(minify_css(content), path))
+        elif path.endswith('.min.js'):
+            parts.append(content.strip())
+        else:
+            parts.append(minify_js(content))
+    # A source without a trailing semicolon must not run into the next.
+    separator = '\n' if name.endswith('.css') else ';\n'
+    return separator.join(parts) + '\n'
+
+
+def write_precompressed(path, content):
+    """Writes gzip (and, with the brotli module, brotli) variants of a
+       bundle for servers or CDNs that serve precompressed files
+    """
+    with open(path + '.gz', 'wb') as raw:
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0,
+                           compresslevel=9)
+        gz.write(content)
+        gz.close()
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+def build(precompress=False):
+    """Writes every bundle and the manifest. Bundles from older builds
+       are removed. Returns the manifest.
+    """
+    out_dir = os.path.join(root_dir, dist_dir)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    manifest = {}
+    written = set()
+    for name, sources in sorted(bundles.iteritems()):
+        content = build_bundle(name, sources)
+        stem, ext = posixpath.splitext(name)
+        filename = '{stem}.{hash}{ext}'.format(
+            stem=stem, hash=hashlib.sha1(content).hexdigest()[:12], ext=ext)
+        path = os.path.join(out_dir, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        written.add(filename)
+        if precompress:
+            write_precompressed(path, content)
+            written.update([filename + '.gz', filename + '.br'])
+        manifest[name] = '/{dir}/{file}'.format(dir=dist_dir, file=filename)
+        logging.info('%s: %d bytes from %d files', filename, len(content),
+                     len(sources))
+    for filename in os.listdir(out_dir):
+        if filename not in written:
+            os.remove(os.path.join(out_dir, filename))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest():
+    """Returns the manifest written by build(), or None"""
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+manifest = load_manifest()
+
+# Identifies the built assets. Part of the page cache keys, so pages
+# rendered with the URLs of an older build are not served after deploying.
+version = hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()[:8]
+
+
+def asset_urls(name):
+    """Returns the URLs a page loads for a bundle: the hashed bundle if
+       it was built, otherwise its source files
+    """
+    if manifest and name in manifest:
+        return [manifest[name]]
+    return ['/' + path for path in bundles[name]]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--precompress', action='store_true',
+                        help='also write .gz (and .br) variants')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    build(args.precompress)
@@ -0,0 +1,109 @@
+"""Bulk import and export throughput, in posts per second.
+
+For each --posts size, writes a JSON Lines file of generated posts,
+imports it into an empty local datastore with bulk.py in --batch-size
+batches, rebuilds the sidebar counts, search index and related posts,
+then exports every post back to a file. Reports posts per second for
+each phase, against writing --baseline posts one at a time through
+util.post_new, which updates the counts, the search index and related
+posts per post.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_bulk.py \\
+        --posts 10000 100000
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import harness
+
+
+def write_records(path, num_posts, content_length):
+    """Writes num_posts generated post records to path"""
+    this_year = datetime.date.today().year
+    content = harness.markdown_source(content_length)
+    with open(path, 'w') as out:
+        for n in xrange(num_posts):
+            out.write(json.dumps({
+                'id': n + 1,
+                'subject': 'Imported post {n}'.format(n=n),
+                'content': content,
+                'image_url': 'http://example.com/{n}.png'.format(n=n),
+                'tag': 'tag{t}'.format(t=n % 10),
+                'created': datetime.date(this_year - n % 5, 1 + n % 12,
+                                         1 + n % 28).isoformat(),
+                'visits': n % 100}))
+            out.write('\n')
+
+
+def timed(fn, *args):
+    """Returns (result, seconds) of fn(*args)"""
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--content-length', type=int, default=3000)
+    parser.add_argument('--baseline', type=int, default=200)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    tmp_dir = tempfile.mkdtemp()
+
+    import bulk
+    import util
+
+    print '{0:<28} {1:>10} {2:>12} {3:>10}'.format(
+        'case', 'posts', 'seconds', 'posts/s')
+
+    def report(label, count, seconds):
+        print '{0:<28} {1:>10} {2:>12.1f} {3:>10.0f}'.format(
+            label, count, seconds, count / seconds if seconds else 0.0)
+
+    bed = harness.activate_testbed()
+    content = harness.markdown_source(args.content_length)
+
+    def post_new_each():
+        for n in xrange(args.baseline):
+            util.post_new('Post {n}'.format(n=n), content,
+                          'http://example.com/{n}.png'.format(n=n),
+                          'tag{t}'.format(t=n % 10))
+
+    _, seconds = timed(post_new_each)
+    report('util.post_new, one by one', args.baseline, seconds)
+    bed.deactivate()
+
+    for num_posts in args.posts:
+        source = os.path.join(tmp_dir, 'posts.jsonl')
+        target = os.path.join(tmp_dir, 'export.jsonl')
+        write_records(source, num_posts, args.content_length)
+        bed = harness.activate_testbed()
+        util.local_cache.clear()
+        with open(source) as lines:
+            count, seconds = timed(bulk.import_posts, lines,
+                                   args.batch_size)
+        report('import batches', count, seconds)
+        _, rebuild_seconds = timed(bulk.rebuild_derived)
+        report('  rebuild derived data', count, rebuild_seconds)
+        report('  import total', count, seconds + rebuild_seconds)
+        with open(target, 'w') as out:
+            count, seconds = timed(bulk.export_posts, out, args.batch_size)
+        report('export', count, seconds)
+        bed.deactivate()
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Serial vs concurrent data loading of the reader pages.
+
+Every reader page needs its content (a listing page or one post) and the
+sidebar counts. With a production-like latency injected into each RPC,
+this times loading the two one after the other against loading them
+together as ndb tasklets, the way the handlers do, with memcache cold
+(flushed before each load) and warm.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_concurrency.py \\
+        --rpc-latency-ms 5
+"""
+import argparse
+import datetime
+
+import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--rpc-latency-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import models
+    import util
+
+    post_ids = harness.seed_posts(args.posts, args.tags, args.years)
+    harness.inject_rpc_latency(args.rpc_latency_ms)
+    year = str(datetime.date.today().year)
+    pages = [('main', util.main_page_posts_async),
+             ('permalink', lambda: models.BlogPost.get_by_id_async(
+                 int(post_ids[0]))),
+             ('tag', lambda: util.tag_cache_async('tag0')),
+             ('archive', lambda: util.archive_cache_async(year))]
+
+    def serial(content):
+        content().get_result()
+        util.sidebar_counts_async().get_result()
+
+    @ndb.synctasklet
+    def concurrent(content):
+        yield content(), util.sidebar_counts_async()
+
+    rows = []
+    for cold in (True, False):
+        for page, content in pages:
+            for label, load in (('serial', serial),
+                                ('concurrent', concurrent)):
+                def run():
+                    if cold:
+                        memcache.flush_all()
+                    ndb.get_context().clear_cache()
+                    load(content)
+                run()  # warms memcache for the warm case
+                stats = harness.summarize(
+                    harness.time_calls(run, args.iterations))
+                rows.append(('{0} {1} {2}'.format(
+                    page, label, 'cold' if cold else 'warm'), stats))
+    harness.print_table('{n} posts, {ms} ms per RPC'.format(
+        n=args.posts, ms=args.rpc_latency_ms), rows)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
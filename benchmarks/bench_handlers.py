@@ -0,0 +1,160 @@
+"""Handler-level benchmark of every reader and admin route in main.routes.
+
+Seeds the local datastore stub with N posts across M tags and Y years,
+then drives main.app in-process and reports latency percentiles,
+datastore RPCs per request and bytes rendered. Every route is measured
+warm (caches kept between requests) and cold (memcache and the
+in-process cache flushed before each request). Results are written as
+JSON so runs can be compared across commits. --rpc-latency-ms gives
+every datastore and memcache RPC a production-like latency, so pages
+that overlap their RPCs show it.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_handlers.py \\
+        --posts 100 10000 --output bench_handlers.json
+"""
+import argparse
+import datetime
+import json
+import re
+import subprocess
+
+import harness
+
+
+# Routes that write data or run maintenance jobs are not benchmarked.
+skipped_routes = ('/admin', '/logout')
+skipped_prefixes = ('/tasks/', '/_ah/')
+pattern_chars = re.compile(r'[\\.^$*+?{}\[\]()|]')
+# A 1x1 transparent PNG, stored as the uploaded image of the /img/ route.
+image_id = 'benchmark'
+image_png = ('\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01'
+             '\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00'
+             '\x00\x00\x0bIDATx\xdac`\x00\x02\x00\x00\x05\x00\x01\xe9'
+             '\xfa\xdc\xd8\x00\x00\x00\x00IEND\xaeB`\x82')
+
+
+def route_paths(main, post_ids, num_tags):
+    """Maps each benchmarked route template to a concrete GET path.
+       Raises ValueError for a route with a pattern but no example, so a
+       new route is never benchmarked as a 404.
+    """
+    year = datetime.date.today().year
+    examples = {'/(\\d+)': '/' + post_ids[0],
+                '/tags/(.*)': '/tags/tag{t}'.format(t=num_tags - 1),
+                '/archive/(\\d{4})': '/archive/{y}'.format(y=year),
+                '/post-change': '/post-change?q=' + post_ids[0],
+                '/search': '/search?q=lorem+benchmark',
+                '/img/(\\w+)/(\\w+)': '/img/{id}/full'.format(id=image_id),
+                '/sitemap\\.xml': '/sitemap.xml',
+                '/sitemap-pages\\.xml': '/sitemap-pages.xml',
+                '/sitemap-(\\d{4})-(\\d+)\\.xml':
+                    '/sitemap-{y}-1.xml'.format(y=year)}
+    paths = []
+    for template, _ in main.routes:
+        if template in skipped_routes or template.startswith(
+                skipped_prefixes):
+            continue
+        if template not in examples and pattern_chars.search(template):
+            raise ValueError('No example path for route ' + template)
+        paths.append((template, examples.get(template, template)))
+    return paths
+
+
+def measure(main, path, cookie, iterations, cold):
+    """Requests path repeatedly and summarizes the timings"""
+    import webapp2
+    from google.appengine.api import memcache
+    import instrumentation
+    import util
+
+    samples, rpcs, sizes, statuses = [], [], [], set()
+    for _ in xrange(iterations):
+        if cold:
+            memcache.flush_all()
+            util.local_cache.clear()
+        request = webapp2.Request.blank(path)
+        if cookie:
+            request.headers['Cookie'] = cookie
+        response = request.get_response(main.app)
+        record = instrumentation.last_record()
+        samples.append(record['total_ms'])
+        rpcs.append(record['datastore_rpcs'])
+        sizes.append(len(response.body))
+        statuses.add(response.status_int)
+    stats = harness.summarize(samples)
+    stats.update({'datastore_rpcs': sum(rpcs) / float(len(rpcs)),
+                  'bytes': max(sizes),
+                  'statuses': sorted(statuses)})
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=harness.repo_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, nargs='+', default=[100])
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--rpc-latency-ms', type=float, default=0.0)
+    parser.add_argument('--output', default='bench_handlers.json')
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    results = {'commit': git_commit(),
+               'date': datetime.datetime.utcnow().isoformat(),
+               'tags': args.tags,
+               'years': args.years,
+               'iterations': args.iterations,
+               'rpc_latency_ms': args.rpc_latency_ms,
+               'runs': []}
+
+    for num_posts in args.posts:
+        bed = harness.activate_testbed()
+        import main as blog_main
+        import models
+        import storage
+        import util
+
+        post_ids = harness.seed_posts(num_posts, args.tags, args.years)
+        preview = models.PostPreview(subject='Preview',
+                                     image_url='http://example.com/p.png',
+                                     tag='tag0', id='preview')
+        preview.set_content('Preview')
+        preview.put()
+        storage.repository().save_image(image_id, 'image/png', image_png)
+        admin_cookie = 'user_id=' + util.make_secure_val('admin')
+        if args.rpc_latency_ms:
+            harness.inject_rpc_latency(args.rpc_latency_ms)
+
+        rows = []
+        for template, path in route_paths(blog_main, post_ids, args.tags):
+            for user, cookie in (('reader', None), ('admin', admin_cookie)):
+                for cold in (False, True):
+                    stats = measure(blog_main, path, cookie,
+                                    args.iterations, cold)
+                    stats.update({'route': template, 'path': path,
+                                  'user': user,
+                                  'cache': 'cold' if cold else 'warm'})
+                    results['runs'].append(dict(stats, posts=num_posts))
+                    rows.append(('{0} {1} {2}'.format(
+                        path[:20], user, stats['cache']), stats))
+        harness.print_table('{n} posts'.format(n=num_posts), rows)
+        bed.deactivate()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'Wrote {path}'.format(path=args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Listing page bytes with full-size post images vs resized variants.
+
+Uploads --images generated photo-like images through images.py, writes
+a post for each and requests the home page through main.app. Reports
+the bytes a reader downloads for the page and its images when every
+card loads the full-size upload (what a pasted image URL costs) against
+the 250x350 card variant and its 2x variant, and times generating a
+variant on its first request against serving it from the cache.
+
+Needs PIL or Pillow.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_images.py
+"""
+import argparse
+import random
+import re
+from cStringIO import StringIO
+
+import harness
+
+
+def photo(width, height, seed):
+    """Returns the JPEG bytes of a smooth, photo-like random image"""
+    from PIL import Image
+    rng = random.Random(seed)
+    small = Image.new('RGB', (16, 22))
+    small.putdata([(rng.randrange(256), rng.randrange(256),
+                    rng.randrange(256)) for _ in xrange(16 * 22)])
+    out = StringIO()
+    small.resize((width, height), Image.BICUBIC).save(out, 'JPEG',
+                                                      quality=92)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=4200)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    import webapp2
+    import config
+    import images
+    import main as blog_main
+    import storage
+
+    uploads = [photo(args.width, args.height, n)
+               for n in xrange(args.images)]
+    for n, data in enumerate(uploads):
+        image_id = images.save_upload(data)
+        storage.repository().create_post(
+            'Post {n}'.format(n=n), harness.markdown_source(1000),
+            images.image_url(image_id), 'tag0')
+
+    def get(path):
+        response = webapp2.Request.blank(path).get_response(blog_main.app)
+        assert response.status_int == 200, (path, response.status_int)
+        return response.body
+
+    page = get('/')
+    ids = sorted(set(re.findall(r'/img/(\w+)/card"', page)))
+    print 'Home page: {0} bytes of HTML, {1} uploaded images'.format(
+        len(page), len(ids))
+    print '  {0:<22} {1:>12} {2:>12}'.format('images', 'image bytes',
+                                            'page total')
+    print '  {0:<22} {1:>12} {2:>12}'.format(
+        'uploaded originals', sum(len(data) for data in uploads),
+        len(page) + sum(len(data) for data in uploads))
+    for size in ('full', 'card2x', 'card'):
+        total = sum(len(get('/img/{0}/{1}'.format(image_id, size)))
+                    for image_id in ids)
+        print '  {0:<22} {1:>12} {2:>12}'.format(size, total,
+                                                total + len(page))
+
+    rows = []
+    counter = iter(xrange(10 ** 9))
+
+    def first_request():
+        # A size the listing has not requested yet, for a new variant.
+        size = 'first{0}'.format(next(counter))
+        config.image_sizes[size] = (250, 350, 'crop')
+        get('/img/{0}/{1}'.format(ids[0], size))
+
+    rows.append(('card, generated', harness.summarize(
+        harness.time_calls(first_request, args.iterations))))
+    rows.append(('card, cached', harness.summarize(harness.time_calls(
+        lambda: get('/img/{0}/card'.format(ids[0])), args.iterations))))
+    harness.print_table('Variant requests', rows)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
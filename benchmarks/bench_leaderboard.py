@@ -0,0 +1,108 @@
+"""Post history page: full visit sort vs the incremental leaderboard.
+
+For each --posts size, seeds the posts, records --visits random visits
+(Zipf-like, so a few posts get most of them) and flushes them. Then
+times ranking every post by a full scan of the summaries and counter
+shards (what the post history page did on a cache miss), building the
+leaderboard from scratch (done once), a visit flush that merges
+--flush-posts posts into the leaderboard, and requests for the first
+post history page, a later leaderboard page and the all posts pages
+through main.app, with their datastore RPCs.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_leaderboard.py \\
+        --posts 10000 100000
+"""
+import argparse
+import random
+
+import harness
+
+
+def record_visits(post_ids, visits, rng):
+    """Counts visits to post_ids, skewed towards the first ones"""
+    import counters
+    for _ in xrange(visits):
+        rank = min(int(rng.paretovariate(1.0)) - 1, len(post_ids) - 1)
+        counters.record_visit(post_ids[rank])
+
+
+def full_sort():
+    """Ranks every post by its summary and counter shards"""
+    import models
+    import storage
+    shards = {}
+    for shard in models.VisitShard.query():
+        shards[shard.post_id] = shards.get(shard.post_id, 0) + shard.count
+    ranked = [(summary.post_id,
+               summary.visits + shards.get(summary.post_id, 0))
+              for summary in storage.repository().iter_summaries()]
+    ranked.sort(key=lambda item: item[1], reverse=True)
+    return ranked
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--visits', type=int, default=20000)
+    parser.add_argument('--flush-posts', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+
+    import webapp2
+    import config
+    import counters
+    import instrumentation
+    import main as blog_main
+    import util
+
+    def get(path):
+        response = webapp2.Request.blank(path).get_response(blog_main.app)
+        assert response.status_int == 200, (path, response.status_int)
+        record = instrumentation.last_record()
+        return record['total_ms'], record['datastore_rpcs']
+
+    last_page = config.leaderboard_size // config.history_page_size
+    for num_posts in args.posts:
+        bed = harness.activate_testbed()
+        util.local_cache.clear()
+        rng = random.Random(num_posts)
+        post_ids = harness.seed_posts(num_posts, 10, 5, content_length=500)
+        record_visits(post_ids, args.visits, rng)
+        counters.flush_visits()
+
+        rows = [('full sort of every post', harness.summarize(
+            harness.time_calls(full_sort, args.iterations)))]
+        rows.append(('leaderboard rebuild', harness.summarize(
+            harness.time_calls(counters.rebuild_leaderboard,
+                               args.iterations))))
+        flush_samples = []
+        for _ in xrange(args.iterations):
+            for post_id in rng.sample(post_ids, args.flush_posts):
+                counters.record_visit(post_id)
+            flush_samples.extend(harness.time_calls(counters.flush_visits,
+                                                    1))
+        rows.append(('flush of {n} posts'.format(n=args.flush_posts),
+                     harness.summarize(flush_samples)))
+        harness.print_table('{n} posts'.format(n=num_posts), rows)
+
+        print '  {0:<34} {1:>9} {2:>9} {3:>6}'.format(
+            'page', 'mean ms', 'p99 ms', 'RPCs')
+        for path in ('/post-history',
+                     '/post-history?page={n}'.format(n=last_page),
+                     '/post-history?all=1'):
+            samples = [get(path) for _ in xrange(args.iterations)]
+            stats = harness.summarize([ms for ms, _ in samples])
+            print '  {0:<34} {1:>9.3f} {2:>9.3f} {3:>6.1f}'.format(
+                path, stats['mean_ms'], stats['p99_ms'],
+                sum(rpcs for _, rpcs in samples) / float(len(samples)))
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
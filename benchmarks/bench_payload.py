@@ -0,0 +1,58 @@
+"""Payload size of listing pages: full BlogPost entities vs PostSummary.
+
+Reports the encoded entity size (what a datastore query returns) and the
+memcache value size of one cached listing page, for a range of post
+lengths.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_payload.py
+"""
+import argparse
+
+import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[1000, 10000, 50000, 200000])
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    from google.appengine.ext import ndb
+    import models
+    import util
+
+    print 'Listing payload, {n} posts per page'.format(n=args.page_size)
+    print '  {0:>10} {1:>14} {2:>14} {3:>14} {4:>14} {5:>8}'.format(
+        'content', 'post bytes', 'summary bytes', 'page (posts)',
+        'page (summ.)', 'ratio')
+    for length in args.lengths:
+        posts = []
+        for n in xrange(args.page_size):
+            post = models.BlogPost(subject='Post {n}'.format(n=n),
+                                   image_url='http://example.com/a.png',
+                                   tag='bench')
+            post.set_content('x' * length)
+            post.put()
+            post.post_id = str(post.key.id())
+            posts.append(post)
+        summaries = [models.PostSummary.from_post(post) for post in posts]
+        ndb.put_multi(summaries)
+
+        post_bytes = len(util.entity_adapter.entity_to_pb(posts[0]).Encode())
+        summary_bytes = len(
+            util.entity_adapter.entity_to_pb(summaries[0]).Encode())
+        page_posts = len(util.encode_entities(posts))
+        page_summaries = len(util.encode_entities(summaries))
+        print '  {0:>10} {1:>14} {2:>14} {3:>14} {4:>14} {5:>7.1f}x'.format(
+            length, post_bytes, summary_bytes, page_posts, page_summaries,
+            float(page_posts) / page_summaries)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
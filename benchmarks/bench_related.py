@@ -0,0 +1,91 @@
+"""Related posts: write-time refresh cost and permalink read cost.
+
+Seeds --posts posts, builds the related posts index with
+/tasks/rebuild-related and reports how long that took. Then times
+related.refresh_post on its own and whole post edits through
+util.post_update, which include it, and requests permalinks through
+main.app with cold and warm caches, reporting latency and datastore and
+memcache RPCs. A warm permalink reads its related posts from the cache
+without a query.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_related.py
+"""
+import argparse
+import random
+import time
+
+import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    import webapp2
+    from google.appengine.api import memcache
+    import instrumentation
+    import main as blog_main
+    import related
+    import search
+    import storage
+    import util
+
+    post_ids = harness.seed_posts(args.posts, 10, 5)
+    start = time.time()
+    rebuilt = related.rebuild_index()
+    print 'Rebuilt related posts of {n} posts in {ms:.0f} ms'.format(
+        n=rebuilt, ms=(time.time() - start) * 1000.0)
+
+    rng = random.Random(1)
+    repo = storage.repository()
+    rows = []
+
+    def refresh():
+        post = repo.get_post_async(rng.choice(post_ids)).get_result()
+        related.refresh_post(post, search.post_terms(post.subject,
+                                                     post.content))
+
+    def edit():
+        post = repo.get_post_async(rng.choice(post_ids)).get_result()
+        util.post_update(post.subject, post.content + '\n\nEdited.',
+                         post.image_url, post.tag, post.post_id)
+
+    rows.append(('related.refresh_post', harness.summarize(
+        harness.time_calls(refresh, args.iterations))))
+    rows.append(('util.post_update', harness.summarize(
+        harness.time_calls(edit, args.iterations))))
+    harness.print_table('Post writes, {n} posts'.format(n=args.posts),
+                        rows)
+
+    print '{0:<22} {1:>9} {2:>9} {3:>10} {4:>10}'.format(
+        'permalink', 'mean ms', 'p99 ms', 'memcache', 'datastore')
+    for label in ('cold', 'warm'):
+        samples, memcache_rpcs, datastore_rpcs = [], [], []
+        for post_id in post_ids[:args.iterations]:
+            if label == 'cold':
+                memcache.flush_all()
+                util.local_cache.clear()
+            else:
+                webapp2.Request.blank('/' + post_id).get_response(
+                    blog_main.app)
+            webapp2.Request.blank('/' + post_id).get_response(blog_main.app)
+            record = instrumentation.last_record()
+            samples.append(record['total_ms'])
+            memcache_rpcs.append(record['memcache_rpcs'])
+            datastore_rpcs.append(record['datastore_rpcs'])
+        stats = harness.summarize(samples)
+        print '{0:<22} {1:>9.3f} {2:>9.3f} {3:>10.2f} {4:>10.2f}'.format(
+            label, stats['mean_ms'], stats['p99_ms'],
+            sum(memcache_rpcs) / float(len(memcache_rpcs)),
+            sum(datastore_rpcs) / float(len(datastore_rpcs)))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Permalink render cost for long posts, Markdown rendered per request
+vs once at write time.
+
+For a range of post lengths, times rendering blogpost.html when the
+Markdown is converted on every request (the cost the page would pay
+without the stored content_html) against rendering the stored HTML, and
+reports the one-off conversion cost paid when a post is saved.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_render.py
+"""
+import argparse
+
+import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--lengths', type=int, nargs='+',
+                        default=[1000, 10000, 50000, 200000])
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    import markup
+    import models
+    import util
+
+    values = {'blog_name': 'My Blog',
+              'blog_desc': 'Benchmark',
+              'user': None,
+              'tag_list': [('tag0', 1)],
+              'archive_list': [('2012', 1)]}
+    rows = []
+    for length in args.lengths:
+        post = models.BlogPost(subject='Long post', post_id='1',
+                               image_url='http://example.com/a.png',
+                               tag='tag0')
+        source = harness.markdown_source(length)
+
+        def per_request():
+            post.set_content(source)
+            util.generate_template('blogpost.html', blog_post=post, **values)
+
+        def precomputed():
+            util.generate_template('blogpost.html', blog_post=post, **values)
+
+        def on_save():
+            markup.render(source)
+
+        for label, fn in (('per request', per_request),
+                          ('precomputed', precomputed),
+                          ('markdown only (on save)', on_save)):
+            fn()
+            stats = harness.summarize(harness.time_calls(fn, args.iterations))
+            stats['bytes'] = len(post.content_html)
+            rows.append(('{0:>6} chars {1}'.format(length, label), stats))
+    harness.print_table('blogpost.html render', rows)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Listing cache stampedes: concurrent misses with and without leases.
+
+Starts --requests concurrent reads of the main page listing as ndb
+tasklets, with a production-like latency injected into each RPC, and
+counts how many of them query the storage backend. Three cases: every
+request recomputing (the behaviour without leases, forced with
+update=True), a cold cache with no copy of the page at all (the others
+wait for the lease holder), and a cache invalidated by a new post (the
+others serve the stale copy).
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_stampede.py \\
+        --rpc-latency-ms 5
+"""
+import argparse
+
+import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--rpc-latency-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import storage
+    import util
+
+    harness.seed_posts(args.posts, 10, 5)
+    harness.inject_rpc_latency(args.rpc_latency_ms)
+
+    repo = storage.repository()
+    list_posts_async = repo.list_posts_async
+    queries = []
+
+    def counting_list_posts_async(*args, **kwargs):
+        queries.append(1)
+        return list_posts_async(*args, **kwargs)
+    repo.list_posts_async = counting_list_posts_async
+
+    def no_leases():
+        memcache.flush_all()
+        return True
+
+    def cold():
+        memcache.flush_all()
+        return False
+
+    def invalidated():
+        util.main_page_posts()
+        util.bump_cache_versions('posts')
+        return False
+
+    rows = []
+    for label, prepare in (('no leases', no_leases),
+                           ('cold, leases', cold),
+                           ('invalidated, leases', invalidated)):
+        stampede_queries = []
+
+        @ndb.synctasklet
+        def stampede():
+            update = prepare()
+            ndb.get_context().clear_cache()
+            util.cache_stats.clear()
+            del queries[:]
+            yield [util.main_page_posts_async(update=update)
+                   for _ in xrange(args.requests)]
+            stampede_queries.append(len(queries))
+
+        samples = harness.time_calls(stampede, args.iterations)
+        stats = harness.summarize(samples)
+        stats['datastore_rpcs'] = (float(sum(stampede_queries)) /
+                                   len(stampede_queries))
+        rows.append((label, stats))
+        print '{0}: {1} coalesced, {2} served stale in the last run'.format(
+            label, util.cache_stats[('main_page_posts', 'coalesced')],
+            util.cache_stats[('main_page_posts', 'stale')])
+    harness.print_table(
+        '{n} concurrent requests, {ms} ms per RPC (RPCs = listing '
+        'queries)'.format(n=args.requests, ms=args.rpc_latency_ms), rows)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Instance startup: import time and first request latency.
+
+Each sample runs in a fresh Python process, like a new instance: it
+times importing main (the app and everything it loads at module level),
+seeds the local datastore stub, flushes memcache, then times the first
+requests to the home page and a permalink. With --warmup the process
+first serves /_ah/warmup, as App Engine does before routing traffic to
+the instance, and its duration is reported separately. Also lists the
+blog modules loaded by the import, to check that the ones only needed
+on rare paths stay out.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_startup.py
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import harness
+
+blog_modules = ('assets', 'config', 'counters', 'feeds', 'handlers',
+                'instrumentation', 'localcache', 'mailer', 'markup', 'main',
+                'models', 'search', 'storage', 'util')
+
+
+def child(args):
+    """Runs one sample and prints it as JSON"""
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    start = time.time()
+    import main
+    import_ms = (time.time() - start) * 1000.0
+    loaded = sorted(name for name in blog_modules if name in sys.modules)
+
+    import webapp2
+    from google.appengine.api import memcache
+    post_ids = harness.seed_posts(args.posts, 10, 5)
+    memcache.flush_all()
+
+    def get(path):
+        start = time.time()
+        response = webapp2.Request.blank(path).get_response(main.app)
+        assert response.status_int == 200, (path, response.status_int)
+        return (time.time() - start) * 1000.0
+
+    sample = {'import_ms': import_ms, 'loaded': loaded}
+    if args.warmup:
+        sample['warmup_ms'] = get('/_ah/warmup')
+    sample['home_ms'] = get('/')
+    sample['permalink_ms'] = get('/' + post_ids[0])
+    bed.deactivate()
+    print json.dumps(sample)
+
+
+def run_samples(args, warmup):
+    """Runs --samples child processes. Returns their samples."""
+    command = [sys.executable, os.path.abspath(__file__), '--child',
+               '--posts', str(args.posts)]
+    if args.sdk:
+        command += ['--sdk', args.sdk]
+    if warmup:
+        command.append('--warmup')
+    samples = []
+    for _ in xrange(args.samples):
+        output = subprocess.check_output(command)
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--warmup', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    rows = []
+    loaded = None
+    for warmup in (False, True):
+        samples = run_samples(args, warmup)
+        loaded = samples[-1]['loaded']
+        label = 'after warmup' if warmup else 'no warmup'
+        for field in ('import_ms', 'warmup_ms', 'home_ms', 'permalink_ms'):
+            if field in samples[0]:
+                rows.append(('{0} {1}'.format(field[:-3], label),
+                             harness.summarize([sample[field]
+                                                for sample in samples])))
+    harness.print_table('Startup, {n} processes each'.format(
+        n=args.samples), rows)
+    print 'Blog modules loaded by importing main: ' + ', '.join(loaded)
+
+
+if __name__ == '__main__':
+    main()
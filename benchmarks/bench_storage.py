@@ -0,0 +1,157 @@
+"""Storage backend comparison: the datastore against SQLite.
+
+Writes the same posts through both repositories in storage.py, then
+times the reads the pages make (a post, the first and a deep page of the
+main listing, a tag page, the sidebar counts) and writing a post. The
+datastore runs on the local stub, so its numbers show the backend code
+rather than production RPC latency; pass --rpc-latency-ms to add it.
+
+The SQLite file is then read and written by --processes processes at
+once, as the worker processes of a WSGI server would (see wsgi.py).
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_storage.py
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import harness
+
+
+def seed(repo, num_posts, num_tags, content):
+    """Writes num_posts posts. Returns (post ids, cursor of page 10)."""
+    post_ids = []
+    for n in xrange(num_posts):
+        post, _ = repo.create_post('Benchmark post {n}'.format(n=n), content,
+                                   'http://example.com/{n}.png'.format(n=n),
+                                   'tag{t}'.format(t=n % num_tags))
+        post_ids.append(post.post_id)
+
+    # The cursor of the tenth page, so deep pages are read through it.
+    cursor = None
+    for _ in xrange(9):
+        _, cursor = repo.list_posts_async(10, cursor).get_result()
+    return post_ids, cursor
+
+
+def cases(repo, post_ids, cursor, content):
+    """(label, function) of the timed reads and writes"""
+    num_posts = len(post_ids)
+    counter = iter(xrange(10 ** 9))
+    return [
+        ('get post', lambda: repo.get_post_async(
+            post_ids[next(counter) % num_posts]).get_result()),
+        ('main page 1', lambda: repo.list_posts_async(10).get_result()),
+        ('main page 10', lambda: repo.list_posts_async(
+            10, cursor).get_result()),
+        ('tag page 1', lambda: repo.list_posts_async(
+            10, tag='tag0').get_result()),
+        ('sidebar counts', lambda: repo.sidebar_counts_async().get_result()),
+        ('create post', lambda: repo.create_post(
+            'Another post', content, 'http://example.com/a.png', 'tag0')),
+    ]
+
+
+def workload(repo, num_posts, num_tags, iterations, content):
+    """Seeds repo and times its reads and writes. Returns table rows."""
+    post_ids, cursor = seed(repo, num_posts, num_tags, content)
+    rows = []
+    for label, fn in cases(repo, post_ids, cursor, content):
+        fn()
+        rows.append((label, harness.summarize(
+            harness.time_calls(fn, iterations))))
+    return rows
+
+
+def init_worker(sdk):
+    harness.setup_sdk(sdk)
+    harness.activate_testbed()
+
+
+def worker_samples(job):
+    """Times every case against the SQLite file at path in this worker
+       process. Returns (label, samples) pairs.
+    """
+    import storage
+    path, post_ids, cursor, iterations, content = job
+    repo = storage.SqliteRepository(path)
+    return [(label, harness.time_calls(fn, iterations))
+            for label, fn in cases(repo, post_ids, cursor, content)]
+
+
+def concurrent_workload(path, post_ids, cursor, processes, iterations,
+                        content, sdk):
+    """Runs the cases in processes processes at once against the seeded
+       SQLite file at path. Returns table rows and the calls per second
+       of all processes together.
+    """
+    pool = multiprocessing.Pool(processes, init_worker, (sdk,))
+    start = time.time()
+    results = pool.map(worker_samples,
+                       [(path, post_ids, cursor, iterations, content)] *
+                       processes)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    rows = []
+    for i, (label, _) in enumerate(results[0]):
+        rows.append((label, harness.summarize(
+            [ms for result in results for ms in result[i][1]])))
+    calls = sum(len(samples) for result in results
+                for _, samples in result)
+    return rows, calls / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--tags', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--rpc-latency-ms', type=float, default=0.0,
+                        help='minimum latency of each datastore RPC')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+    if args.rpc_latency_ms:
+        harness.inject_rpc_latency(args.rpc_latency_ms, ('datastore_v3',))
+
+    import storage
+
+    content = harness.markdown_source(3000)
+    # No ndb caches, so the datastore is read as a fresh request would.
+    from google.appengine.ext import ndb
+    ctx = ndb.get_context()
+    ctx.set_cache_policy(False)
+    ctx.set_memcache_policy(False)
+    harness.print_table('datastore', workload(
+        storage.DatastoreRepository(), args.posts, args.tags,
+        args.iterations, content))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        harness.print_table('sqlite', workload(
+            storage.SqliteRepository(os.path.join(tmp_dir, 'blog.sqlite3')),
+            args.posts, args.tags, args.iterations, content))
+        # A fresh file, so the processes start from the same posts.
+        path = os.path.join(tmp_dir, 'shared.sqlite3')
+        post_ids, cursor = seed(storage.SqliteRepository(path), args.posts,
+                                args.tags, content)
+        rows, rate = concurrent_workload(path, post_ids, cursor,
+                                         args.processes, args.iterations,
+                                         content, args.sdk)
+        harness.print_table('sqlite, {n} processes ({rate:.0f} calls/s)'
+                            .format(n=args.processes, rate=rate), rows)
+    finally:
+        shutil.rmtree(tmp_dir)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Per-request render cost of blog.html and blogpost.html.
+
+Compares the old behaviour (a new jinja2 Environment per render) with the
+shared environment in util, both on a warm instance and on a cold instance
+that only has the memcache bytecode cache to start from.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_templates.py
+"""
+import argparse
+import datetime
+
+import harness
+
+
+class FakePost(object):
+    def __init__(self, n):
+        self.post_id = str(n)
+        self.subject = 'Post number {n}'.format(n=n)
+        self.content = 'Lorem ipsum dolor sit amet. ' * 200
+        self.content_html = '<p>{0}</p>'.format(self.content)
+        self.description = self.content[:145]
+        self.excerpt = '<p>{0}...</p>'.format(self.content[:350])
+        self.image_url = 'http://example.com/{n}.png'.format(n=n)
+        self.tag = 'tag{n}'.format(n=n % 5)
+        self.author = 'Author A'
+        self.created = datetime.date(2012, 1, 1)
+        self.visits = n
+
+
+def template_values():
+    posts = [FakePost(n) for n in xrange(10)]
+    return {'blog_name': 'My Blog',
+            'blog_desc': 'Benchmark',
+            'user': None,
+            'tag_list': [('tag{n}'.format(n=n), n) for n in xrange(5)],
+            'archive_list': [('2012', 10)],
+            'blog_entries': posts,
+            'blog_post': posts[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sdk')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    import jinja2
+    from google.appengine.api import memcache
+    import util
+
+    values = template_values()
+
+    def legacy_render(name):
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(util.template_dir),
+            autoescape=False)
+        return env.get_template(name).render(**values)
+
+    def cold_render(name):
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(util.template_dir),
+            autoescape=False,
+            bytecode_cache=jinja2.MemcachedBytecodeCache(
+                memcache, prefix='jinja2/bytecode/'))
+        return env.get_template(name).render(**values)
+
+    rows = []
+    for name in ('blog.html', 'blogpost.html'):
+        rows.append(('{0} per-render env'.format(name),
+                     harness.summarize(harness.time_calls(
+                         lambda: legacy_render(name), args.iterations))))
+        util.generate_template(name, **values)
+        rows.append(('{0} cold env + bytecode'.format(name),
+                     harness.summarize(harness.time_calls(
+                         lambda: cold_render(name), args.iterations))))
+        rows.append(('{0} shared env'.format(name),
+                     harness.summarize(harness.time_calls(
+                         lambda: util.generate_template(name, **values),
+                         args.iterations))))
+    harness.print_table('Template render cost', rows)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Two-tier cache: memcache RPCs per request with and without the
+in-process tier.
+
+Drives the reader pages through main.app with warm caches, once with
+util.local_cache disabled (every cached value read from memcache) and
+once enabled, and reports latency and memcache and datastore RPCs per
+request. With the tier, a warm page costs only the memcache read of the
+scope versions. --rpc-latency-ms gives every RPC a production-like
+latency.
+
+    APPENGINE_SDK=~/google_appengine python benchmarks/bench_tiers.py \\
+        --rpc-latency-ms 2
+"""
+import argparse
+import datetime
+
+import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--rpc-latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    harness.setup_sdk(args.sdk)
+    bed = harness.activate_testbed()
+
+    import webapp2
+    import instrumentation
+    import main as blog_main
+    import util
+
+    post_ids = harness.seed_posts(args.posts, 10, 5)
+    if args.rpc_latency_ms:
+        harness.inject_rpc_latency(args.rpc_latency_ms)
+    year = datetime.date.today().year
+    paths = ['/', '/' + post_ids[0], '/tags/tag0',
+             '/archive/{0}'.format(year)]
+    max_bytes = util.local_cache.max_bytes
+
+    print '{0:<28} {1:>9} {2:>9} {3:>10} {4:>10}'.format(
+        'page', 'mean ms', 'p99 ms', 'memcache', 'datastore')
+    for label, tier_bytes in (('memcache', 0), ('two-tier', max_bytes)):
+        util.local_cache.clear()
+        util.local_cache.max_bytes = tier_bytes
+        for path in paths:
+            samples, memcache_rpcs, datastore_rpcs = [], [], []
+            for n in xrange(args.iterations + 1):
+                webapp2.Request.blank(path).get_response(blog_main.app)
+                record = instrumentation.last_record()
+                if n:  # the first request warms the caches
+                    samples.append(record['total_ms'])
+                    memcache_rpcs.append(record['memcache_rpcs'])
+                    datastore_rpcs.append(record['datastore_rpcs'])
+            stats = harness.summarize(samples)
+            print '{0:<28} {1:>9.3f} {2:>9.3f} {3:>10.2f} {4:>10.2f}'.format(
+                '{0} {1}'.format(path[:16], label), stats['mean_ms'],
+                stats['p99_ms'],
+                sum(memcache_rpcs) / float(len(memcache_rpcs)),
+                sum(datastore_rpcs) / float(len(datastore_rpcs)))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
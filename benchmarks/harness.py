@@ -0,0 +1,166 @@
+"""Shared helpers for the benchmark scripts in this directory.
+
+The scripts run outside of dev_appserver, so the App Engine SDK has to be
+put on sys.path first. Point APPENGINE_SDK (or --sdk) at the directory
+that contains dev_appserver.py.
+"""
+import datetime
+import os
+import sys
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_sdk(sdk_path=None):
+    """Puts the App Engine SDK and the blog on sys.path"""
+    sdk_path = sdk_path or os.environ.get('APPENGINE_SDK')
+    if not sdk_path:
+        sys.exit('Set APPENGINE_SDK or pass --sdk to the SDK directory.')
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+
+
+def activate_testbed():
+    """Activates the local service stubs used by the blog. The datastore
+       is strongly consistent so runs are repeatable.
+    """
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='blog')
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_mail_stub()
+    bed.init_taskqueue_stub(root_path=repo_dir)
+    # Entities cached by a previous testbed must not leak into this one.
+    ndb.get_context().clear_cache()
+    return bed
+
+
+def inject_rpc_latency(latency_ms, services=('datastore_v3', 'memcache')):
+    """Makes every async RPC to services take at least latency_ms of wall
+       time, as it would against the production services. The local stubs
+       answer in microseconds, which hides the difference between issuing
+       RPCs one after another and overlapping them: an RPC here becomes
+       ready latency_ms after it was made, so RPCs in flight together
+       finish together. Call it after activate_testbed.
+    """
+    from google.appengine.api import apiproxy_rpc
+    from google.appengine.api import apiproxy_stub_map
+    delay = latency_ms / 1000.0
+
+    class DelayedRPC(apiproxy_rpc.RPC):
+        def _MakeCallImpl(self):
+            self.ready_at = time.time() + delay
+            super(DelayedRPC, self)._MakeCallImpl()
+
+        def _WaitImpl(self):
+            time.sleep(max(0.0, self.ready_at - time.time()))
+            return super(DelayedRPC, self)._WaitImpl()
+
+    for service in services:
+        stub = apiproxy_stub_map.apiproxy.GetStub(service)
+        stub.CreateRPC = lambda stub=stub: DelayedRPC(stub=stub)
+
+
+def markdown_source(length):
+    """Returns about length characters of Markdown with the usual mix of
+       paragraphs, emphasis, links, lists and code
+    """
+    block = ('## A heading\n\n'
+             'Lorem *ipsum* dolor sit amet, **consectetur** adipiscing elit, '
+             'see [the docs](http://example.com/docs "Docs") and `code`.\n'
+             'Sed do eiusmod tempor incididunt ut labore et dolore.\n\n'
+             '- first item\n- second _item_\n\n'
+             '> A quoted line.\n\n'
+             '    indented = code\n\n')
+    return (block * (length / len(block) + 1))[:length]
+
+
+def seed_posts(num_posts, num_tags, num_years, content_length=3000,
+               batch_size=500):
+    """Writes num_posts posts spread over num_tags tags and the last
+       num_years years, with their summaries and sidebar counts.
+       Returns the post ids.
+    """
+    from google.appengine.ext import ndb
+    import models
+    import search
+
+    this_year = datetime.date.today().year
+    start, _ = models.BlogPost.allocate_ids(num_posts)
+    post_ids = []
+    # Seeding bypasses ndb's caches, so runs start with them empty.
+    options = {'use_cache': False, 'use_memcache': False}
+    for offset in xrange(0, num_posts, batch_size):
+        posts = []
+        for n in xrange(offset, min(offset + batch_size, num_posts)):
+            post_id = start + n
+            post = models.BlogPost(
+                id=post_id,
+                post_id=str(post_id),
+                subject='Benchmark post {n}'.format(n=n),
+                image_url='http://example.com/{n}.png'.format(n=n),
+                tag='tag{t}'.format(t=n % num_tags),
+                created=datetime.date(this_year - n % num_years,
+                                      1 + n % 12, 1 + n % 28))
+            post.set_content(markdown_source(content_length))
+            posts.append(post)
+            post_ids.append(str(post_id))
+        # Puts first, so the summaries copy last_modified.
+        ndb.put_multi(posts, **options)
+        ndb.put_multi([models.PostSummary.from_post(post) for post in posts],
+                      **options)
+    models.SidebarCounts.rebuild()
+    search.rebuild_index()
+    return post_ids
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def time_calls(fn, iterations):
+    """Runs fn iterations times and returns the timings in milliseconds"""
+    samples = []
+    for _ in xrange(iterations):
+        start = time.time()
+        fn()
+        samples.append((time.time() - start) * 1000.0)
+    return samples
+
+
+def summarize(samples):
+    """Summary statistics for a list of millisecond timings"""
+    return {'n': len(samples),
+            'mean_ms': sum(samples) / len(samples) if samples else 0.0,
+            'p50_ms': percentile(samples, 50),
+            'p90_ms': percentile(samples, 90),
+            'p99_ms': percentile(samples, 99)}
+
+
+def print_table(title, rows):
+    """Prints (label, summary) rows as a fixed-width table. Datastore RPCs
+       and bytes are shown when the summaries have them.
+    """
+    print title
+    print '  {0:<34} {1:>9} {2:>9} {3:>9} {4:>6} {5:>8}'.format(
+        'case', 'mean ms', 'p50 ms', 'p99 ms', 'RPCs', 'bytes')
+    for label, stats in rows:
+        print '  {0:<34} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>6} {5:>8}'.format(
+            label, stats['mean_ms'], stats['p50_ms'], stats['p99_ms'],
+            '{0:.1f}'.format(stats['datastore_rpcs'])
+            if 'datastore_rpcs' in stats else '-',
+            stats.get('bytes', '-'))
@@ -0,0 +1,198 @@
+"""Bulk export and import of posts as JSON Lines.
+
+Export streams every post, in id order, to a file with one JSON object
+per line: id, subject, content (the Markdown source, or HTML for posts
+flagged legacy_html), image_url, tag, author, created, visits and
+legacy_html. Import streams such a file back, batch_size posts at a
+time: each batch is written with one put_multi for the posts and one
+for their summaries (one transaction with the SQLite backend).
+Ids are kept, so permalinks survive a restore, and reserved in the
+datastore's id allocator; with --new-ids every post gets a newly
+allocated id instead, for copying posts into a blog that has its own.
+Neither direction holds more than a batch in memory.
+
+Sidebar counts, the search index, the related posts and the visits
+leaderboard are rebuilt once after the last batch rather than per post,
+and every cache scope is bumped. Exported visits are each post's total
+over its counter shards; an import stores them on the post and deletes
+the post's shards, so a replaced post's visits are not counted twice.
+
+The datastore is the live app's, through remote_api (its memcache is
+used too, so its caches are invalidated), or a local dev_appserver
+datastore file; with config.storage_backend = 'sqlite' posts go to the
+SQLite file instead.
+
+    APPENGINE_SDK=~/google_appengine python bulk.py export \\
+        --remote blog.appspot.com posts.jsonl
+    APPENGINE_SDK=~/google_appengine python bulk.py import \\
+        --datastore-path ~/blog.datastore posts.jsonl
+"""
+import argparse
+import datetime
+import json
+import logging
+import sys
+import time
+
+import snapshot
+
+
+def post_record(post, visits):
+    """The JSON-serializable export of a BlogPost with its total visits"""
+    return {'id': int(post.post_id),
+            'subject': post.subject,
+            'content': post.content,
+            'image_url': post.image_url,
+            'tag': post.tag,
+            'author': post.author,
+            'created': post.created.isoformat(),
+            'visits': visits,
+            'legacy_html': post.is_legacy()}
+
+
+def record_post(record, keep_id=True):
+    """Builds an unsaved BlogPost from an exported record, rendering its
+       content. Raises KeyError or ValueError for a malformed record.
+    """
+    from google.appengine.ext import ndb
+    import models
+    post = models.BlogPost(subject=record['subject'],
+                           image_url=record['image_url'],
+                           tag=record['tag'],
+                           created=datetime.datetime.strptime(
+                               record['created'], '%Y-%m-%d').date(),
+                           visits=int(record.get('visits', 0)))
+    if record.get('author'):
+        post.author = record['author']
+    if keep_id:
+        post.key = ndb.Key(models.BlogPost, int(record['id']))
+        post.post_id = str(post.key.id())
+    post.legacy_html = bool(record.get('legacy_html'))
+    post.set_content(record['content'])
+    post.last_modified = datetime.datetime.utcnow()
+    return post
+
+
+def export_posts(out, batch_size=500):
+    """Writes every post to the file out, with its visits summed over its
+       counter shards a batch at a time. Returns the number written.
+    """
+    import storage
+    exported = 0
+    batch = []
+    for post in storage.repository().iter_posts(batch_size):
+        batch.append(post)
+        if len(batch) == batch_size:
+            exported += _write_records(out, batch)
+            batch = []
+    return exported + _write_records(out, batch)
+
+
+def _write_records(out, posts):
+    import counters
+    totals = counters.post_visits([post.post_id for post in posts])
+    for post in posts:
+        record = post_record(post, totals.get(post.post_id, post.visits))
+        out.write(json.dumps(record, sort_keys=True))
+        out.write('\n')
+    return len(posts)
+
+
+def import_posts(lines, batch_size=500, keep_ids=True):
+    """Writes the posts of an iterable of JSON lines in batches. Blank
+       lines are skipped. Returns the number written. Run rebuild_derived
+       afterwards.
+    """
+    import counters
+    import storage
+    repo = storage.repository()
+    imported = 0
+    batch = []
+
+    def write(batch):
+        repo.import_posts(batch)
+        # The records hold total visits, so counts of replaced posts
+        # are not added twice.
+        counters.clear_shards([post.post_id for post in batch])
+        return len(batch)
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            batch.append(record_post(json.loads(line), keep_ids))
+        except (KeyError, ValueError) as e:
+            raise ValueError('line {n}: {error!r}'.format(n=number, error=e))
+        if len(batch) == batch_size:
+            imported += write(batch)
+            batch = []
+    if batch:
+        imported += write(batch)
+    return imported
+
+
+def rebuild_derived():
+    """Recounts the sidebar, rebuilds the search index, related posts and
+       visits leaderboard and invalidates every cached page
+    """
+    import counters
+    import related
+    import search
+    import storage
+    import util
+    counts = storage.repository().rebuild_counts()
+    util.bump_cache_versions('global', 'sidebar')
+    util.sidebar_counts(counts)
+    search.rebuild_index()
+    related.rebuild_index()
+    counters.rebuild_leaderboard()
+    util.bump_cache_versions('global')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('file', help="JSON Lines file, or '-' for stdio")
+    parser.add_argument('--sdk')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--remote', help='app host serving remote_api')
+    source.add_argument('--datastore-path', help='local datastore file')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--new-ids', action='store_true',
+                        help='allocate new ids instead of keeping them')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    snapshot.setup_sdk(args.sdk)
+    snapshot.connect(args, save_changes=True, remote_memcache=True)
+
+    start = time.time()
+    if args.action == 'export':
+        if args.file == '-':
+            count = export_posts(sys.stdout, args.batch_size)
+        else:
+            with open(args.file, 'w') as out:
+                count = export_posts(out, args.batch_size)
+    else:
+        if args.file == '-':
+            count = import_posts(sys.stdin, args.batch_size,
+                                 not args.new_ids)
+        else:
+            with open(args.file) as lines:
+                count = import_posts(lines, args.batch_size,
+                                     not args.new_ids)
+        written = time.time() - start
+        logging.info('Wrote %d posts in %.1fs', count, written)
+        rebuild_derived()
+        logging.info('Rebuilt derived data in %.1fs',
+                     time.time() - start - written)
+    elapsed = time.time() - start
+    logging.info('%sed %d posts in %.1fs (%.0f posts/s)',
+                 args.action.capitalize(), count, elapsed,
+                 count / elapsed if elapsed else 0.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,3 +30,93 @@ linkedin_url = 'http://www.linkedin.com/company/URL'
 #Contact form e-mails
 email_to = 'test@test.com'
 email_from = 'test@test.com'
+
+#Contact form messages are queued and sent in batches by /tasks/send-mail.
+#Messages queued within mail_batch_seconds are sent by the same run.
+mail_batch_seconds = 10
+mail_batch_size = 50
+mail_lease_seconds = 60
+mail_max_retries = 5
+mail_retry_base_seconds = 30
+mail_retry_max_seconds = 3600
+
+#Template caching. Compiled templates are kept per instance and their
+#bytecode is shared through memcache. Set template_auto_reload to True
+#during development so edited templates are picked up (checks mtimes).
+template_auto_reload = False
+template_cache_size = 50
+
+#Visit counting. Visits are counted in memcache and written to this many
+#counter shards per post by the /tasks/flush-visits cron job (cron.yaml).
+visit_counter_shards = 20
+visit_flush_lock_seconds = 60
+
+#Post history page (/post-history). The leaderboard_size most visited posts
+#are kept in one VisitLeaderboard entity, updated by each visit flush, and
+#listed history_page_size per page; after them every post is listed,
+#newest first, with its visits.
+leaderboard_size = 100
+history_page_size = 20
+
+#Number of posts per page on the main, tag and archive pages. Older posts
+#are reached through ?cursor= links.
+posts_per_page = 10
+tag_posts_per_page = 10
+archive_posts_per_page = 10
+
+#Number of results per page on the /search page
+search_results_per_page = 10
+
+#Number of most recent posts in the Atom feed (/feed)
+feed_size = 20
+
+#URLs per sitemap file. The sitemap protocol allows at most 50,000; archive
+#years with more posts are split over several files.
+sitemap_urls_per_file = 50000
+
+#Where posts, previews, the admin account, subscribers and uploaded images
+#are stored: 'datastore' on App Engine, or 'sqlite' to keep them in the
+#sqlite_path file when running under a plain WSGI server (see storage.py).
+storage_backend = 'datastore'
+sqlite_path = 'blog.sqlite3'
+
+#Stampede protection for the listing caches. On a miss one request takes
+#a lease (for at most cache_lease_seconds) and runs the query; the others
+#serve the last copy of the page or poll for up to cache_lease_wait_seconds.
+#Listing pages expire after listing_cache_seconds and are refreshed early,
+#at random, as that nears; a larger beta refreshes earlier.
+listing_cache_seconds = 3600
+cache_lease_seconds = 10
+cache_lease_wait_seconds = 2
+cache_lease_poll_seconds = 0.05
+cache_early_refresh_beta = 1.0
+
+#In-process cache tier. Each instance keeps up to local_cache_bytes of
+#recently used listing pages, rendered pages and sidebar counts, each for
+#at most local_cache_seconds. The scope versions are still read from
+#memcache on every request, so a new post is seen by all instances at once.
+local_cache_bytes = 32 * 1024 * 1024
+local_cache_seconds = 300
+
+#Uploaded post images (images.py). Uploads are scaled down to fit
+#image_max_dimension and served at /img/<id>/full; the sizes below are
+#(width, height, 'crop' to fill or 'fit' inside), generated on first use.
+#Listing and post pages show the 250x350 card, with card2x for HiDPI.
+image_max_dimension = 2048
+image_quality = 82
+image_sizes = {'card': (250, 350, 'crop'),
+               'card2x': (500, 700, 'crop')}
+
+#Related posts shown under each post (related.py), precomputed when a post
+#is written. A candidate scores related_tag_weight for sharing the tag,
+#related_term_weight times the similarity of the two posts' related_terms
+#heaviest search terms and related_recency_weight for being new, halving
+#every related_half_life_days. Writing a post rescores related_candidates
+#posts; /tasks/rebuild-related recomputes every list.
+related_posts = 4
+related_candidates = 50
+related_terms = 20
+related_tag_weight = 1.0
+related_term_weight = 2.0
+related_recency_weight = 0.5
+related_half_life_days = 365
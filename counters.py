@@ -0,0 +1,182 @@
+"""Write-behind visit counting for blog posts.
+
+A visit only increments a memcache counter. Post ids whose counter went
+from 0 to 1 are appended to a list of numbered 'dirty' slots, and the
+/tasks/flush-visits cron job moves the pending counts into sharded
+VisitShard entities in one batch, so viewing a post never writes to the
+datastore.
+
+The post history page ranks posts from the VisitLeaderboard entity.
+Totals only grow, so a post can only enter the top leaderboard_size by
+being flushed: each flush reads the totals of the posts it wrote and
+merges them in, and no flush or page view scans every post.
+"""
+import heapq
+import logging
+import random
+from operator import itemgetter
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import config
+import models
+import storage
+
+
+pending_prefix = 'visits_pending_'
+dirty_prefix = 'visits_dirty_'
+dirty_head = 'visits_dirty_head'  # number of the last dirty slot written
+dirty_tail = 'visits_dirty_tail'  # number of the last dirty slot flushed
+flush_lock = 'visits_flush_lock'
+
+
+def record_visit(post_id):
+    """Counts a visit to post_id in memcache"""
+    count = memcache.incr(pending_prefix + post_id, initial_value=0)
+    if count is None:
+        logging.warning('Visit to post %s was not counted', post_id)
+    elif count == 1:
+        mark_dirty(post_id)
+
+
+def mark_dirty(post_id):
+    """Queues post_id for the next flush"""
+    slot = memcache.incr(dirty_head, initial_value=0)
+    if slot is not None:
+        memcache.set(dirty_prefix + str(slot), post_id)
+
+
+def flush_visits():
+    """Writes the pending visit counts to VisitShard entities in one
+       batch and returns the number of visits flushed.
+    """
+    if not memcache.add(flush_lock, 1, time=config.visit_flush_lock_seconds):
+        return 0
+    try:
+        head = int(memcache.get(dirty_head) or 0)
+        tail = int(memcache.get(dirty_tail) or 0)
+        if head < tail:  # the head counter was evicted and restarted
+            tail = 0
+        slots = [str(n) for n in xrange(tail + 1, head + 1)]
+        post_ids = set(memcache.get_multi(slots,
+                                          key_prefix=dirty_prefix).values())
+        pending = memcache.get_multi(list(post_ids),
+                                     key_prefix=pending_prefix)
+        counts = dict((post_id, int(count))
+                      for post_id, count in pending.iteritems()
+                      if int(count) > 0)
+        if counts:
+            write_shards(counts)
+            # Visits recorded since the read above stay pending.
+            left = memcache.offset_multi(
+                dict((post_id, -count) for post_id, count
+                     in counts.iteritems()), key_prefix=pending_prefix)
+            for post_id, count in left.iteritems():
+                if count:
+                    mark_dirty(post_id)
+            update_leaderboard(post_visits(counts.keys()))
+        memcache.delete_multi(slots, key_prefix=dirty_prefix)
+        memcache.set(dirty_tail, head)
+        return sum(counts.itervalues())
+    finally:
+        memcache.delete(flush_lock)
+
+
+def write_shards(counts):
+    """Adds {post_id: visits} to one random shard per post"""
+    post_ids = counts.keys()
+    keys = [ndb.Key('VisitShard', '{post_id}-{shard}'.format(
+                post_id=post_id,
+                shard=random.randrange(config.visit_counter_shards)))
+            for post_id in post_ids]
+    shards = ndb.get_multi(keys)
+    for i, post_id in enumerate(post_ids):
+        if shards[i] is None:
+            shards[i] = models.VisitShard(key=keys[i], post_id=post_id)
+        shards[i].count += counts[post_id]
+    ndb.put_multi(shards)
+
+
+def _shard_keys(post_ids):
+    return [ndb.Key('VisitShard', '{post_id}-{shard}'.format(
+                post_id=post_id, shard=shard))
+            for post_id in post_ids
+            for shard in xrange(config.visit_counter_shards)]
+
+
+def post_visits(post_ids):
+    """Returns {post_id: total visits} of the existing posts of post_ids:
+       the sum of their counter shards, read by key in one batch, plus
+       the visits stored on their summaries before counters existed.
+    """
+    shards = {}
+    for shard in ndb.get_multi(_shard_keys(post_ids), use_cache=False):
+        if shard is not None:
+            shards[shard.post_id] = shards.get(shard.post_id, 0) + shard.count
+    return dict((summary.post_id,
+                 summary.visits + shards.get(summary.post_id, 0))
+                for summary in storage.repository().get_summaries(post_ids))
+
+
+def clear_shards(post_ids):
+    """Deletes the counter shards of post_ids, whose totals were written
+       to BlogPost.visits (by a bulk import)
+    """
+    ndb.delete_multi(_shard_keys(post_ids))
+
+
+def _top(totals):
+    """The leaderboard_size most visited of (post_id, visits) tuples"""
+    return heapq.nlargest(config.leaderboard_size, totals,
+                          key=itemgetter(1))
+
+
+def update_leaderboard(totals):
+    """Merges {post_id: total visits} of just flushed posts into the
+       leaderboard, if it exists yet
+    """
+    def txn():
+        board = models.VisitLeaderboard.get_by_id(
+            models.VisitLeaderboard.entity_name)
+        if board is None:
+            return
+        merged = dict(board.ranked())
+        merged.update(totals)
+        top = _top(merged.iteritems())
+        if top != board.ranked():
+            board.post_ids = [post_id for post_id, _ in top]
+            board.visits = [visits for _, visits in top]
+            board.put()
+
+    ndb.transaction(txn)
+
+
+def rebuild_leaderboard():
+    """Ranks every post by its shards and summary. Only used when the
+       leaderboard does not exist yet, i.e. the first post history view
+       after deploying, and after bulk imports. Returns the entity.
+    """
+    logging.debug('DB Query: Visit Shards')
+    shards = {}
+    for shard in models.VisitShard.query().iter(batch_size=500):
+        shards[shard.post_id] = shards.get(shard.post_id, 0) + shard.count
+    top = _top((summary.post_id,
+                summary.visits + shards.get(summary.post_id, 0))
+               for summary in storage.repository().iter_summaries())
+    board = models.VisitLeaderboard(id=models.VisitLeaderboard.entity_name,
+                                    post_ids=[post_id for post_id, _ in top],
+                                    visits=[visits for _, visits in top])
+    board.put()
+    return board
+
+
+def leaderboard():
+    """Returns (post_id, visits) tuples of the most visited posts, most
+       visited first. The entity is read through ndb's memcache cache.
+    """
+    board = models.VisitLeaderboard.get_by_id(
+        models.VisitLeaderboard.entity_name)
+    if board is None:
+        board = rebuild_leaderboard()
+    return board.ranked()
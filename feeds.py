@@ -0,0 +1,161 @@
+"""Atom feed and sitemap documents.
+
+Both are generated from post summaries and returned gzip
+compressed, ready to be cached and served as is. Sitemap files are
+streamed through the compressor, so a file with tens of thousands of
+URLs is never held uncompressed. The sitemap is sharded by archive
+year (and, past sitemap_urls_per_file posts, by part within a year), so
+writing a post only invalidates the file of its year.
+"""
+import math
+import urllib
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+import config
+import storage
+import util
+
+
+atom_ns = 'http://www.w3.org/2005/Atom'
+sitemap_ns = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+class GzipWriter(object):
+    """Collects written text as gzip-compressed chunks"""
+    def __init__(self):
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+        self.chunks = []
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.chunks.append(self.compressor.compress(text))
+
+    def getvalue(self):
+        return ''.join(self.chunks) + self.compressor.flush()
+
+
+def gunzip(data):
+    """Decompresses a document for clients that do not accept gzip"""
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def w3c_datetime(value):
+    """Formats a date or naive UTC datetime for Atom and sitemaps"""
+    if not hasattr(value, 'hour'):
+        return value.strftime('%Y-%m-%dT00:00:00Z')
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def atom_feed(host_url):
+    """Returns (gzipped Atom feed of the latest posts, last modified)"""
+    posts, _ = storage.repository().list_posts_async(
+        config.feed_size).get_result()
+    updated = util.latest_modified(posts)
+    out = GzipWriter()
+    out.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+              u'<feed xmlns="{ns}">\n'
+              u'<title>{title}</title>\n<subtitle>{desc}</subtitle>\n'
+              u'<link href={home}/>\n<link rel="self" href={feed}/>\n'
+              u'<id>{id}</id>\n<author><name>{author}</name></author>\n'
+              .format(ns=atom_ns, title=escape(config.blog_name),
+                      desc=escape(config.blog_desc),
+                      home=quoteattr(host_url + '/'),
+                      feed=quoteattr(host_url + '/feed'),
+                      id=escape(host_url + '/'),
+                      author=escape(config.blog_author)))
+    if updated:
+        out.write(u'<updated>{0}</updated>\n'.format(w3c_datetime(updated)))
+    for post in posts:
+        link = '{host}/{post_id}'.format(host=host_url, post_id=post.post_id)
+        out.write(u'<entry>\n<title>{title}</title>\n<link href={link}/>\n'
+                  u'<id>{id}</id>\n<published>{published}</published>\n'
+                  u'<updated>{updated}</updated>\n'
+                  u'<category term={tag}/>\n'
+                  u'<summary type="html">{summary}</summary>\n</entry>\n'
+                  .format(title=escape(post.subject), link=quoteattr(link),
+                          id=escape(link),
+                          published=w3c_datetime(post.created),
+                          updated=w3c_datetime(post.last_modified),
+                          tag=quoteattr(post.tag),
+                          summary=escape(post.excerpt or u'')))
+    out.write(u'</feed>\n')
+    return out.getvalue(), updated
+
+
+def sitemap_parts(count):
+    """Number of sitemap files for an archive year with count posts"""
+    return max(1, int(math.ceil(count / float(config.sitemap_urls_per_file))))
+
+
+def sitemap_index(host_url):
+    """Returns (gzipped sitemap index, None). Lists the pages sitemap and
+       one file per part of every archive year.
+    """
+    out = GzipWriter()
+    out.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+              u'<sitemapindex xmlns="{ns}">\n'.format(ns=sitemap_ns))
+    locations = ['/sitemap-pages.xml']
+    for year, count in util.sidebar_counts()['archive']:
+        locations.extend('/sitemap-{year}-{part}.xml'.format(year=year,
+                                                              part=part)
+                         for part in xrange(1, sitemap_parts(count) + 1))
+    for location in locations:
+        out.write(u'<sitemap><loc>{0}</loc></sitemap>\n'.format(
+            escape(host_url + location)))
+    out.write(u'</sitemapindex>\n')
+    return out.getvalue(), None
+
+
+def _url(out, loc, lastmod=None):
+    out.write(u'<url><loc>{0}</loc>'.format(escape(loc)))
+    if lastmod:
+        out.write(u'<lastmod>{0}</lastmod>'.format(w3c_datetime(lastmod)))
+    out.write(u'</url>\n')
+
+
+def sitemap_pages(host_url):
+    """Returns (gzipped sitemap of the home, about, tag and archive pages,
+       None)
+    """
+    sidebar = util.sidebar_counts()
+    out = GzipWriter()
+    out.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+              u'<urlset xmlns="{ns}">\n'.format(ns=sitemap_ns))
+    _url(out, host_url + '/')
+    _url(out, host_url + '/about')
+    for tag, _ in sidebar['tags']:
+        _url(out, '{host}/tags/{tag}'.format(
+            host=host_url, tag=urllib.quote(tag.encode('utf-8'))))
+    for year, _ in sidebar['archive']:
+        _url(out, '{host}/archive/{year}'.format(host=host_url, year=year))
+    out.write(u'</urlset>\n')
+    return out.getvalue(), None
+
+
+def sitemap_year(host_url, year, part):
+    """Returns (gzipped sitemap of part of the posts of an archive year,
+       last modified), or (None, None) if the part does not exist.
+    """
+    if part < 1:
+        return None, None
+    per_file = config.sitemap_urls_per_file
+    out = GzipWriter()
+    out.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+              u'<urlset xmlns="{ns}">\n'.format(ns=sitemap_ns))
+    written = 0
+    last_modified = None
+    for post in storage.repository().iter_summaries(
+            year, offset=(part - 1) * per_file, limit=per_file):
+        _url(out, '{host}/{post_id}'.format(host=host_url,
+                                            post_id=post.post_id),
+             post.last_modified)
+        if last_modified is None or post.last_modified > last_modified:
+            last_modified = post.last_modified
+        written += 1
+    if not written:
+        return None, None
+    out.write(u'</urlset>\n')
+    return out.getvalue(), last_modified
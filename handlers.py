@@ -1,13 +1,32 @@
 import cgi
+import collections
 import logging
+import time
+import urllib
 
 import webapp2
-from google.appengine.ext import db
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 
 import models
 import config
+import counters
+import instrumentation
+import storage
 import util
 
+# feeds, images, mailer, related and search are imported by the handlers
+# that use them, so they are not loaded while an instance starts.
+
+
+def etag_listed(if_none_match, etag):
+    """Whether an If-None-Match header value lists etag, weakly compared,
+       or is '*'
+    """
+    etags = [tag.strip() for tag in (if_none_match or '').split(',')]
+    etags = [tag[2:] if tag.startswith('W/') else tag for tag in etags]
+    return '*' in etags or etag in etags
+
 
 class BaseRequestHandler(webapp2.RequestHandler):
     """Base Handler for all Requests"""
@@ -17,19 +36,130 @@ class BaseRequestHandler(webapp2.RequestHandler):
                    'google_plus_url': config.google_plus_url,
                    'linkedin_url': config.linkedin_url,
                    'user': None}
+    # Query parameters read by a handler using serve_cached. Only they are
+    # part of its page cache key, so other query strings share the entry.
+    cache_params = ()
+
+    def initialize(self, request, response):
+        """Gives every request its own copy of the template variables, so
+           the admin 'user' flag set for one request cannot leak into a
+           page rendered (and cached) for an anonymous reader.
+        """
+        super(BaseRequestHandler, self).initialize(request, response)
+        self.blog_values = dict(BaseRequestHandler.blog_values)
 
-    def generate(self, template_name, template_values={}):
+    def generate(self, template_name, template_values={}, sidebar=None):
         """Supplies a common template generation function.
-           generate() augments the template variables.
+           generate() augments the template variables. sidebar is the
+           util.sidebar_counts() result, when the caller already has it.
         """
-        side_bar_data = {'tag_list': util.generate_tag_list(),
-                         'archive_list': util.generate_archive_list()}
+        if sidebar is None:
+            sidebar = util.sidebar_counts()
+        side_bar_data = {'tag_list': sidebar['tags'],
+                         'archive_list': sidebar['archive']}
         self.blog_values.update(template_values)
         self.blog_values.update(side_bar_data)
         self.response.out.write(util.generate_template(template_name,
                                                             **self.blog_values)
                                                             )
 
+    def serve_cached(self, scopes, render, *args):
+        """Serves anonymous GET requests from the page cache, calling
+           render(*args) only on a miss. scopes are the util cache scopes
+           the page depends on. Logged-in admins always get a freshly
+           rendered page. Renders that do not end in a 200, or that used a
+           stale listing, are not cached. Pages depend on the sidebar and
+           more, so their Last-Modified is when the cache entry was stored:
+           a change to any scope stores a new entry.
+        """
+        if self.check_secure_cookie():
+            render(*args)
+            return
+        key = util.page_cache_key(self.cache_path(), scopes)
+        page = util.page_cache_get(key)
+        if page is None:
+            stale_reads = util.stale_reads()
+            render(*args)
+            if (self.response.status_int != 200 or
+                    util.stale_reads() != stale_reads):
+                return
+            page = util.page_cache_set(key, self.response.body)
+            self.response.clear()
+        self.write_page(page)
+
+    def cache_path(self):
+        """The request path with just the cache_params the request has"""
+        params = [(name, self.request.get(name).encode('utf-8'))
+                  for name in self.cache_params if self.request.get(name)]
+        if not params:
+            return self.request.path
+        return self.request.path + '?' + urllib.urlencode(params)
+
+    def serve_document(self, scopes, content_type, build, *args):
+        """Serves a gzip-compressed document such as the feed from the page
+           cache, calling build(host_url, *args) only on a miss. build
+           returns (gzipped body, last modified); a None body is a 404.
+           A 404 is cached too, as an empty body, so requests for missing
+           documents do not query until the scopes change. Clients that do
+           not accept gzip get it decompressed.
+        """
+        import feeds
+        host_url = self.request.host_url
+        key = util.page_cache_key(host_url + self.request.path, scopes)
+        page = util.page_cache_get(key)
+        if page is None:
+            body, last_modified = build(host_url, *args)
+            page = util.page_cache_set(key, body or '', last_modified)
+        if not page['body']:
+            self.abort(404)
+        self.response.content_type = content_type
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.response.headers['Content-Encoding'] = 'gzip'
+        else:
+            page = dict(page, body=feeds.gunzip(page['body']),
+                        etag=page['etag'][:-1] + '-identity"')
+        self.write_page(page)
+
+    def write_page(self, page):
+        """Writes a cached page, or a 304 if the client's copy is current"""
+        self.response.headers['ETag'] = page['etag']
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.last_modified = page['last_modified']
+        if self.not_modified(page):
+            self.response.set_status(304)
+        else:
+            self.response.write(page['body'])
+
+    def not_modified(self, page):
+        """Evaluates If-None-Match, or If-Modified-Since when it is absent"""
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            return etag_listed(if_none_match, page['etag'])
+        since = self.request.if_modified_since
+        if since is None:
+            return False
+        last_modified = page['last_modified'].replace(microsecond=0)
+        return last_modified <= since.replace(tzinfo=None)
+
+    @ndb.tasklet
+    def page_of_async(self, listing, *args):
+        """Calls a util async listing helper for the page named by
+           ?cursor=. Returns a future of (posts, next_page); next_page is
+           the link to the following page or None. A malformed cursor is
+           a 404.
+        """
+        cursor = self.request.get('cursor') or None
+        try:
+            posts, next_cursor = yield listing(*args, cursor=cursor)
+        except (datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            self.abort(404)
+        if next_cursor:
+            raise ndb.Return(
+                (posts, '?cursor={cursor}'.format(cursor=next_cursor)))
+        raise ndb.Return((posts, None))
+
     def set_secure_cookie(self, name, value):
         hashed_val = util.make_secure_val(value)
         cookie_value = '{name}={value}; Path=/'.format(name=name,
@@ -60,6 +190,19 @@ class BaseRequestHandler(webapp2.RequestHandler):
             self.blog_values['user'] = 'admin'
             self.generate(template, {})
 
+    def post_params(self):
+        """Returns the submitted post fields, storing an image uploaded
+           by the admin. Raises ValueError for an unusable upload.
+        """
+        upload = self.request.POST.get('image_file')
+        image_url = None
+        # A form submitted without a file has an empty filename.
+        if self.check_secure_cookie() and getattr(upload, 'filename', None):
+            import images
+            image_url = images.image_url(
+                images.save_upload(upload.file.read()))
+        return util.blog_post_param(self.request, image_url)
+
     def post_eval(self, preview, update, **params):
         if params:
             self.redirect(util.post_helper(params['subject'],
@@ -76,10 +219,20 @@ class BaseRequestHandler(webapp2.RequestHandler):
 
 class BlogPostHandler(BaseRequestHandler):
     """Main Blog Page Handler"""
+    cache_params = ('cursor',)
+
     def get(self):
-        blog_entries = util.main_page_posts()
+        self.serve_cached(['posts', 'sidebar'], self.render)
+
+    @ndb.synctasklet
+    def render(self):
+        # The listing and the sidebar load concurrently.
+        (blog_entries, next_page), sidebar = yield (
+            self.page_of_async(util.main_page_posts_async),
+            util.sidebar_counts_async())
         self.check_admin_status()
-        self.generate('blog.html', {'blog_entries': blog_entries})
+        self.generate('blog.html', {'blog_entries': blog_entries,
+                                    'next_page': next_page}, sidebar)
 
 
 class PermalinkHandler(BaseRequestHandler):
@@ -87,45 +240,129 @@ class PermalinkHandler(BaseRequestHandler):
         """Generator of permalink page for each blog entry
            postid variable gets passed in (i.e. /blog/(\d+))
         """
-        post_num = int(post_id)
-        blog_post = models.BlogPost.get_by_id(post_num)
-        logging.error('DB write: Permalink Visit')
-        blog_post.visits += 1
-        blog_post.put()
+        self.serve_cached(['post:' + post_id, 'sidebar'], self.render, post_id)
+        if self.response.status_int in (200, 304):
+            counters.record_visit(post_id)
+
+    @ndb.synctasklet
+    def render(self, post_id):
+        blog_post, sidebar, related_posts = yield (
+            storage.repository().get_post_async(post_id),
+            util.sidebar_counts_async(), util.related_posts_async(post_id))
 
         self.check_admin_status()
         if not blog_post:
-            self.generate('error.html', {})
+            self.generate('error.html', {}, sidebar)
+            self.response.set_status(404)
         else:
             self.generate('blogpost.html',
                           {'blog_post': blog_post,
-                           'blog_author_link': config.blog_author_link})
+                           'blog_author_link': config.blog_author_link,
+                           'related_posts': related_posts},
+                          sidebar)
 
 
 class TagHandler(BaseRequestHandler):
     """Tag Page Handler"""
+    cache_params = ('cursor',)
+
     def get(self, tag_name):
-        tag_list = dict(util.generate_tag_list())
+        self.serve_cached(['tag:' + tag_name, 'sidebar'], self.render,
+                          tag_name)
+
+    @ndb.synctasklet
+    def render(self, tag_name):
+        (blog_entries, next_page), sidebar = yield (
+            self.page_of_async(util.tag_cache_async, tag_name),
+            util.sidebar_counts_async())
+        tag_list = dict(sidebar['tags'])
         self.check_admin_status()
         if tag_name not in tag_list.keys():
             self.redirect('/')
             return
         else:
-            blog_entries = util.tag_cache(tag_name)
-            self.generate('blog.html', {'blog_entries': blog_entries})
+            self.generate('blog.html', {'blog_entries': blog_entries,
+                                        'next_page': next_page}, sidebar)
 
 
 class ArchiveHandler(BaseRequestHandler):
     """Archive Page Handler"""
+    cache_params = ('cursor',)
+
     def get(self, archive_year):
-        archive_list = dict(util.generate_archive_list())
+        self.serve_cached(['year:' + archive_year, 'sidebar'], self.render,
+                          archive_year)
+
+    @ndb.synctasklet
+    def render(self, archive_year):
+        (blog_entries, next_page), sidebar = yield (
+            self.page_of_async(util.archive_cache_async, archive_year),
+            util.sidebar_counts_async())
+        archive_list = dict(sidebar['archive'])
         self.check_admin_status()
         if archive_year not in archive_list.keys():
             self.redirect('/')
             return
         else:
-            blog_entries = util.archive_cache(archive_year)
-            self.generate('blog.html', {'blog_entries': blog_entries})
+            self.generate('blog.html', {'blog_entries': blog_entries,
+                                        'next_page': next_page}, sidebar)
+
+
+class SearchHandler(BaseRequestHandler):
+    """Search Results Page Handler"""
+    cache_params = ('q', 'page')
+
+    def get(self):
+        self.serve_cached(['posts', 'sidebar'], self.render)
+
+    def render(self):
+        query = self.request.get('q').strip()
+        try:
+            page = max(int(self.request.get('page', 1)), 1)
+        except ValueError:
+            self.abort(404)
+        import search
+        blog_entries, has_more = search.search(query, page)
+        next_page = None
+        if has_more:
+            next_page = '?{0}'.format(urllib.urlencode(
+                {'q': query.encode('utf-8'), 'page': page + 1}))
+        self.check_admin_status()
+        self.generate('blog.html', {'blog_entries': blog_entries,
+                                    'next_page': next_page,
+                                    'search_query': query})
+
+
+class FeedHandler(BaseRequestHandler):
+    """Atom feed of the latest posts"""
+    def get(self):
+        import feeds
+        self.serve_document(['posts'], 'application/atom+xml',
+                            feeds.atom_feed)
+
+
+class SitemapIndexHandler(BaseRequestHandler):
+    """Sitemap index, listing the pages sitemap and the archive years"""
+    def get(self):
+        import feeds
+        self.serve_document(['sidebar'], 'application/xml',
+                            feeds.sitemap_index)
+
+
+class SitemapPagesHandler(BaseRequestHandler):
+    """Sitemap of the home, about, tag and archive pages"""
+    def get(self):
+        import feeds
+        self.serve_document(['sidebar'], 'application/xml',
+                            feeds.sitemap_pages)
+
+
+class SitemapYearHandler(BaseRequestHandler):
+    """Sitemap of the posts of one archive year, split into parts"""
+    def get(self, year, part):
+        import feeds
+        self.serve_document(['year:' + year], 'application/xml',
+                            feeds.sitemap_year, year, int(part))
 
 
 class NewPostHandler(BaseRequestHandler):
@@ -141,15 +378,19 @@ class NewPostHandler(BaseRequestHandler):
     def post(self):
         update = None
         preview = self.request.POST.get('Preview', None)
-        params = util.blog_post_param(self.request)
+        try:
+            params = self.post_params()
+        except ValueError as e:
+            self.blog_values['user'] = 'admin'
+            self.generate('newpost.html', {'newpost_error': str(e)})
+            return
         self.post_eval(preview, update, **params)
 
 
 class PreviewHandler(BaseRequestHandler):
     """Blog Post Preview Handler"""
     def get(self):
-        post_key = db.Key.from_path('PostPreview', 'preview')
-        blog_post = models.PostPreview.get(post_key)
+        blog_post = storage.repository().get_preview()
 
         self.check_admin_status()
         if not blog_post:
@@ -164,7 +405,8 @@ class EditPostHandler(BaseRequestHandler):
         if self.check_secure_cookie():
             self.blog_values['user'] = 'admin'
             post_id = int(self.request.get('q'))
-            blog_post = models.BlogPost.get_by_id(post_id)
+            blog_post = storage.repository().get_post_async(
+                post_id).get_result()
             self.generate('newpost.html',
                           {'subject': blog_post.subject,
                            'content': blog_post.content,
@@ -177,7 +419,12 @@ class EditPostHandler(BaseRequestHandler):
     def post(self):
         update = int(self.request.get('q'))
         preview = self.request.POST.get('Preview', None)
-        params = util.blog_post_param(self.request)
+        try:
+            params = self.post_params()
+        except ValueError as e:
+            self.blog_values['user'] = 'admin'
+            self.generate('newpost.html', {'newpost_error': str(e)})
+            return
         self.post_eval(preview, update, **params)
 
 
@@ -272,11 +519,51 @@ class PasswordChangeHandler(BaseRequestHandler):
 
 
 class PostHistoryHandler(BaseRequestHandler):
-    """Post History Handler"""
+    """Post History Handler. ?page=N pages through the most visited posts;
+       after them ?all=1 lists every post newest first.
+    """
     def get(self):
         self.check_admin_status()
-        blog_entries = util.visits_cache()
-        self.generate('post-history.html', {'blog_entries': blog_entries})
+        if self.request.get('all'):
+            blog_entries, next_page = self.page_of_async(
+                util.visits_by_date_async).get_result()
+            if next_page:
+                next_page = '?all=1&' + next_page[1:]
+        else:
+            try:
+                page = int(self.request.get('page') or 1)
+            except ValueError:
+                page = 0
+            if page < 1:
+                self.abort(404)
+            blog_entries, more = util.visits_leaderboard(page)
+            next_page = '?page={n}'.format(n=page + 1) if more else '?all=1'
+        self.generate('post-history.html',
+                      {'blog_entries': blog_entries,
+                       'all_posts': bool(self.request.get('all')),
+                       'next_page': next_page})
+
+
+class StatsHandler(BaseRequestHandler):
+    """Admin page with per-route request timings of this instance"""
+    def get(self):
+        if not self.check_secure_cookie():
+            self.redirect('/login')
+            return
+        self.blog_values['user'] = 'admin'
+        cache_stats = {}
+        for (key, outcome), count in util.cache_stats.iteritems():
+            cache_stats.setdefault(key, collections.Counter())[outcome] = count
+        for counts in cache_stats.itervalues():
+            # Hit ratio of each tier, over the lookups that reached it.
+            remote = counts['hit'] + counts['miss']
+            lookups = counts['local'] + remote
+            counts['local_ratio'] = counts['local'] / float(lookups or 1)
+            counts['memcache_ratio'] = counts['hit'] / float(remote or 1)
+        self.generate('admin-stats.html',
+                      {'route_stats': instrumentation.route_summary(),
+                       'cache_stats': sorted(cache_stats.iteritems()),
+                       'local_cache': util.local_cache})
 
 
 class AdminHandler(BaseRequestHandler):
@@ -286,7 +573,114 @@ class AdminHandler(BaseRequestHandler):
                                          config.admin_pw)
         admin = models.Admin(admin_username=config.admin_username,
                              admin_pw_hash=pw_hash,
-                             key_name='admin_key_name')
-        admin.put()
+                             id=models.Admin.entity_name)
+        storage.repository().save_admin(admin)
         self.redirect('/')
         return
+
+
+class ImageHandler(webapp2.RequestHandler):
+    """Serves an uploaded post image or one of its resized variants.
+       The content of an image URL never changes.
+    """
+    def get(self, image_id, size):
+        import images
+        if size != 'full' and size not in config.image_sizes:
+            self.abort(404)
+        etag = '"{id}-{size}"'.format(id=image_id, size=size)
+        not_modified = etag_listed(self.request.headers.get('If-None-Match'),
+                                   etag)
+        image = None
+        # A 304 needs no image data, only an id known to exist.
+        if not (not_modified and images.known(image_id)):
+            image = images.variant(image_id, size)
+            if image is None:
+                self.abort(404)
+        headers = self.response.headers
+        headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        headers['ETag'] = etag
+        if not_modified:
+            self.response.set_status(304)
+        else:
+            self.response.content_type, body = image
+            self.response.write(body)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Warmup request sent to a new instance before it takes traffic.
+       Compiles every template, opens the storage backend and renders the
+       home page, which loads the sidebar counts and the first listing
+       page into the caches of this instance.
+    """
+    def get(self):
+        start = time.time()
+        templates = util.compile_templates()
+        storage.repository()
+        home = webapp2.Request.blank('/').get_response(self.app)
+        logging.info('Warmed up in %.1f ms: %d templates, home page %d',
+                     (time.time() - start) * 1000.0, len(templates),
+                     home.status_int)
+
+
+class FlushVisitsHandler(webapp2.RequestHandler):
+    """Cron handler that writes pending visit counts to the datastore"""
+    def get(self):
+        flushed = counters.flush_visits()
+        logging.info('Flushed %d visits', flushed)
+
+
+class SendMailHandler(webapp2.RequestHandler):
+    """Task and cron handler that sends queued contact form messages"""
+    def get(self):
+        import mailer
+        sent = mailer.send_queued()
+        logging.info('Sent %d contact messages', sent)
+
+    post = get
+
+
+class RebuildSummariesHandler(webapp2.RequestHandler):
+    """Task handler that writes summaries for posts created before
+       PostSummary existed. Run it once after deploying.
+    """
+    def get(self):
+        written = util.rebuild_post_summaries()
+        logging.info('Rebuilt %d post summaries', written)
+        self.response.write('Rebuilt {n} post summaries'.format(n=written))
+
+
+class RebuildSearchIndexHandler(webapp2.RequestHandler):
+    """Task handler that indexes every post for search. Run it once for
+       posts created before the search index existed.
+    """
+    def get(self):
+        import search
+        indexed = search.rebuild_index()
+        logging.info('Indexed %d posts for search', indexed)
+        self.response.write('Indexed {n} posts'.format(n=indexed))
+
+
+class RebuildRelatedHandler(webapp2.RequestHandler):
+    """Task handler that recomputes the related posts of every post. Run
+       it after /tasks/rebuild-search, or now and then to refresh the
+       recency part of the scores.
+    """
+    def get(self):
+        import related
+        rebuilt = related.rebuild_index()
+        util.bump_cache_versions('global')
+        logging.info('Computed related posts for %d posts', rebuilt)
+        self.response.write('Computed related posts for {n} posts'.format(
+            n=rebuilt))
+
+
+class MigrateHandler(webapp2.RequestHandler):
+    """Task handler that migrates entities written by the old db models.
+       Run it once after deploying the ndb models.
+    """
+    def get(self):
+        written = util.migrate_to_ndb()
+        logging.info('Migrated entities: %r', dict(written))
+        self.response.write(', '.join(
+            '{kind}: {n}'.format(kind=kind, n=n)
+            for kind, n in sorted(written.iteritems())))
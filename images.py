@@ -0,0 +1,125 @@
+"""Uploaded post images and their resized variants.
+
+An uploaded image is scaled down to at most image_max_dimension pixels,
+recompressed and stored through the storage backend under the hash of
+its content, so the same file uploaded twice is stored once, and served
+as /img/<id>/full. The variants named in config.image_sizes are
+generated on their first request, stored next to the original and
+cached in memcache. The content of an /img/ URL never changes, so it is
+served with a one year lifetime.
+
+Resizing needs PIL (the App Engine 'PIL' library, or Pillow locally).
+"""
+import hashlib
+from cStringIO import StringIO
+
+import config
+import storage
+import util
+
+# Datastore entities are limited to 1MB.
+max_stored_bytes = 1000 * 1000
+# In-process cache key prefix marking an image id as stored.
+known_prefix = 'image-known|'
+
+
+def _pil():
+    from PIL import Image
+    from PIL import ImageFile
+    from PIL import ImageOps
+    # Optimized and progressive JPEGs are written in one block, which
+    # must hold the whole image.
+    ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK,
+                             config.image_max_dimension ** 2 * 4)
+    return Image, ImageOps
+
+
+def _encode(image, format):
+    """Returns (content type, bytes) of image recompressed as format"""
+    out = StringIO()
+    if format == 'JPEG':
+        image.convert('RGB').save(out, 'JPEG', quality=config.image_quality,
+                                  optimize=True, progressive=True)
+        return 'image/jpeg', out.getvalue()
+    image.save(out, 'PNG', optimize=True)
+    return 'image/png', out.getvalue()
+
+
+def _format(image):
+    """PNG for images with transparency, JPEG for everything else"""
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        return 'PNG'
+    return 'JPEG'
+
+
+def save_upload(data):
+    """Stores an uploaded image. Returns its id. Raises ValueError when
+       data is not an image or is too large even after recompressing.
+    """
+    Image, _ = _pil()
+    try:
+        image = Image.open(StringIO(data))
+        image.load()
+    except (IOError, SyntaxError):
+        raise ValueError('The uploaded file is not an image.')
+    format = _format(image)
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA' if format == 'PNG' else 'RGB')
+    size = config.image_max_dimension
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    content_type, stored = _encode(image, format)
+    if len(stored) > max_stored_bytes:
+        raise ValueError('The uploaded image is too large.')
+    image_id = hashlib.sha1(stored).hexdigest()[:16]
+    storage.repository().save_image(image_id, content_type, stored)
+    return image_id
+
+
+def image_url(image_id, size='full'):
+    return '/img/{id}/{size}'.format(id=image_id, size=size)
+
+
+def resize(data, size):
+    """Returns (content type, bytes) of the size variant of an image"""
+    Image, ImageOps = _pil()
+    image = Image.open(StringIO(data))
+    width, height, mode = config.image_sizes[size]
+    if mode == 'crop':
+        image = ImageOps.fit(image, (width, height), Image.ANTIALIAS)
+    else:
+        image.thumbnail((width, height), Image.ANTIALIAS)
+    return _encode(image, _format(image))
+
+
+def known(image_id):
+    """Whether this instance found image_id stored before. Uploads are
+       never deleted, so it still exists.
+    """
+    return util.local_cache.get(known_prefix + image_id) is not None
+
+
+def variant(image_id, size):
+    """Returns (content type, bytes) of a variant of an uploaded image,
+       generating it on first use, or None if there is no such image.
+       The 'full' variant is the stored upload.
+    """
+    key = 'image|{id}|{size}'.format(id=image_id, size=size)
+    data = util.cache_get_data(key)
+    if data is not None:
+        util.local_cache.set(known_prefix + image_id, '1')
+        return tuple(data.split('|', 1))
+    repo = storage.repository()
+    if size == 'full':
+        image = repo.get_image(image_id)
+    else:
+        variant_id = '{id}-{size}'.format(id=image_id, size=size)
+        image = repo.get_image(variant_id)
+        if image is None:
+            original = repo.get_image(image_id)
+            if original is not None:
+                image = resize(original[1], size)
+                repo.save_image(variant_id, *image)
+    if image is not None:
+        util.cache_set_data(key, '|'.join(image))
+        util.local_cache.set(known_prefix + image_id, '1')
+    return image
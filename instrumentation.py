@@ -0,0 +1,183 @@
+"""Per-request instrumentation.
+
+InstrumentationMiddleware wraps the WSGI app and, through API proxy
+hooks, records for every request the datastore RPC count and latency,
+memcache hits and misses and the template render time. The numbers are
+sent back in a Server-Timing header, logged as one JSON record per
+request and aggregated per route for the /admin/stats page. Aggregates
+are kept per instance.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+hook_name = 'blog_instrumentation'
+route_environ_key = 'blog.route'
+samples_per_route = 1000
+
+_local = threading.local()
+_lock = threading.Lock()
+_route_samples = collections.defaultdict(
+    lambda: collections.deque(maxlen=samples_per_route))
+
+
+class RequestStats(object):
+    """API and template timings of one request"""
+    def __init__(self):
+        self.start = time.time()
+        self.elapsed_ms = None
+        self.rpc_count = collections.Counter()
+        self.rpc_ms = collections.Counter()
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self.template_ms = 0.0
+        self.pending = {}
+        self.status = '500'
+
+    def finish(self):
+        if self.elapsed_ms is None:
+            self.elapsed_ms = (time.time() - self.start) * 1000.0
+
+    def server_timing(self):
+        """Value of the Server-Timing header"""
+        return ', '.join([
+            'db;dur={0:.1f};desc="{1} RPCs"'.format(
+                self.rpc_ms['datastore_v3'], self.rpc_count['datastore_v3']),
+            'memcache;dur={0:.1f};desc="{1} hits, {2} misses"'.format(
+                self.rpc_ms['memcache'], self.memcache_hits,
+                self.memcache_misses),
+            'tmpl;dur={0:.1f}'.format(self.template_ms),
+            'total;dur={0:.1f}'.format(self.elapsed_ms)])
+
+    def record(self, route, status):
+        """Structured log record of the request"""
+        return {'route': route,
+                'status': status,
+                'total_ms': round(self.elapsed_ms, 1),
+                'datastore_rpcs': self.rpc_count['datastore_v3'],
+                'datastore_ms': round(self.rpc_ms['datastore_v3'], 1),
+                'memcache_rpcs': self.rpc_count['memcache'],
+                'memcache_hits': self.memcache_hits,
+                'memcache_misses': self.memcache_misses,
+                'template_ms': round(self.template_ms, 1)}
+
+
+def current():
+    """Returns the RequestStats of the running request, or None"""
+    return getattr(_local, 'stats', None)
+
+
+def last_record():
+    """Returns the log record of the last request finished on this thread"""
+    return getattr(_local, 'last_record', None)
+
+
+def record_template(elapsed_ms):
+    """Adds template render time to the running request"""
+    stats = current()
+    if stats is not None:
+        stats.template_ms += elapsed_ms
+
+
+def pre_call_hook(service, call, request, response, rpc):
+    stats = current()
+    if stats is not None:
+        stats.pending[id(response)] = time.time()
+
+
+def post_call_hook(service, call, request, response, rpc):
+    stats = current()
+    if stats is None:
+        return
+    start = stats.pending.pop(id(response), None)
+    stats.rpc_count[service] += 1
+    if start is not None:
+        stats.rpc_ms[service] += (time.time() - start) * 1000.0
+    if service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        stats.memcache_hits += hits
+        stats.memcache_misses += request.key_size() - hits
+
+
+def install_hooks():
+    """Registers the hooks on the current API proxy. Safe to call on
+       every request; the testbed replaces the proxy when activated.
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append(hook_name, pre_call_hook)
+    apiproxy.GetPostCallHooks().Append(hook_name, post_call_hook)
+
+
+def route_dispatcher(router, request, response):
+    """webapp2 dispatcher that labels the request with its route"""
+    try:
+        return router.default_dispatcher(request, response)
+    finally:
+        route = getattr(request, 'route', None)
+        if route is not None:
+            request.environ[route_environ_key] = route.template
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[int(round(pct / 100.0 * (len(ordered) - 1)))]
+
+
+def route_summary():
+    """Per-route aggregates of the requests seen by this instance"""
+    with _lock:
+        routes = dict((route, list(samples))
+                      for route, samples in _route_samples.iteritems())
+    summary = []
+    for route, records in sorted(routes.iteritems()):
+        totals = [r['total_ms'] for r in records]
+        summary.append({
+            'route': route,
+            'count': len(records),
+            'p50_ms': percentile(totals, 50),
+            'p90_ms': percentile(totals, 90),
+            'p99_ms': percentile(totals, 99),
+            'datastore_rpcs': (sum(r['datastore_rpcs'] for r in records) /
+                               float(len(records))),
+            'memcache_rpcs': (sum(r['memcache_rpcs'] for r in records) /
+                              float(len(records))),
+            'template_ms': percentile([r['template_ms'] for r in records],
+                                      50)})
+    return summary
+
+
+class InstrumentationMiddleware(object):
+    """WSGI middleware that times every request"""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        install_hooks()
+        stats = _local.stats = RequestStats()
+
+        def timed_start_response(status, headers, exc_info=None):
+            stats.finish()
+            headers = list(headers)
+            headers.append(('Server-Timing', stats.server_timing()))
+            stats.status = status
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, timed_start_response)
+        finally:
+            _local.stats = None
+            stats.finish()
+            route = environ.get(route_environ_key, '(unmatched)')
+            record = stats.record(route, int(stats.status.split(' ')[0]))
+            _local.last_record = record
+            logging.info('request_stats %s', json.dumps(record))
+            with _lock:
+                _route_samples[route].append(record)
@@ -0,0 +1,60 @@
+"""In-process LRU cache of strings, the first tier in front of memcache.
+
+Every instance keeps one, shared by its request threads. Entries are
+bounded by their total size in bytes and expire after a fixed number of
+seconds. Keys are expected to carry the cache scope versions read from
+memcache (see util.versioned_key_async), so a bumped version makes an
+instance's copy unreachable just as it does the memcache one; the expiry
+only limits how long an instance holds a value nobody asks for.
+"""
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache of strings bounded by their total length"""
+
+    def __init__(self, max_bytes, seconds):
+        self.max_bytes = max_bytes
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        # key: (expires, value), least recently used first.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        """Returns the cached string, or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.size -= len(entry[1])
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        """Caches a string. Values larger than the whole cache are not
+           kept.
+        """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(value) > self.max_bytes:
+                return
+            self.entries[key] = (time.time() + self.seconds, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,100 @@
+"""Queued sending of contact form messages.
+
+The contact form only adds a task to the 'contact-mail' pull queue and
+schedules a worker run. The worker (/tasks/send-mail) leases queued
+messages in batches, sends them, records the senders as SubscribeEmail
+entities keyed by address and retries failed messages with exponential
+backoff by shortening or extending their lease.
+"""
+import json
+import logging
+import time
+
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.runtime import apiproxy_errors
+
+import config
+import storage
+
+
+queue_name = 'contact-mail'
+worker_url = '/tasks/send-mail'
+
+
+def queue_message(email, subject, message):
+    """Queues a contact form message and schedules the worker"""
+    payload = json.dumps({'email': email,
+                          'subject': subject,
+                          'message': message})
+    taskqueue.Queue(queue_name).add(taskqueue.Task(payload=payload,
+                                                   method='PULL'))
+    schedule_worker()
+
+
+def schedule_worker():
+    """Adds one worker task per batching interval. Messages queued within
+       the same interval are sent by the same worker run.
+    """
+    interval = config.mail_batch_seconds
+    name = 'send-mail-{n}'.format(n=int(time.time()) // interval)
+    try:
+        taskqueue.add(url=worker_url, name=name, countdown=interval)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def send(message):
+    """Sends one queued contact form message"""
+    email = mail.EmailMessage(sender=config.email_from,
+                              subject=message['subject'])
+    email.to = config.email_to
+    email.html = (message['message'] + '<br /><br /> The sender is ' +
+                  message['email'])
+    email.send()
+
+
+def backoff_seconds(retry_count):
+    """Delay before a failed message is retried"""
+    return min(config.mail_retry_base_seconds * 2 ** retry_count,
+               config.mail_retry_max_seconds)
+
+
+def save_subscribers(emails):
+    """Stores new sender addresses, skipping known ones"""
+    storage.repository().add_subscribers(emails)
+
+
+def send_queued(max_batches=10):
+    """Sends queued messages in batches. Returns the number sent."""
+    queue = taskqueue.Queue(queue_name)
+    sent_count = 0
+    for _ in xrange(max_batches):
+        tasks = queue.lease_tasks(config.mail_lease_seconds,
+                                  config.mail_batch_size)
+        done, senders = [], []
+        for task in tasks:
+            message = json.loads(task.payload)
+            try:
+                send(message)
+            except (mail.Error, apiproxy_errors.Error):
+                if task.retry_count >= config.mail_max_retries:
+                    logging.exception('Dropping contact message from %s',
+                                      message['email'])
+                    done.append(task)
+                else:
+                    logging.warning('Retrying contact message from %s',
+                                    message['email'], exc_info=True)
+                    queue.modify_task_lease(
+                        task, backoff_seconds(task.retry_count))
+                continue
+            done.append(task)
+            senders.append(message['email'])
+        if senders:
+            save_subscribers(senders)
+            sent_count += len(senders)
+        if done:
+            queue.delete_tasks(done)
+        if len(tasks) < config.mail_batch_size:
+            break
+    return sent_count
@@ -1,8 +1,10 @@
 import os
 
 import webapp2
+from google.appengine.ext import ndb
 
 import handlers
+import instrumentation
 import util
 
 
@@ -21,13 +23,32 @@ routes = [('/', handlers.BlogPostHandler),
           ('/post-change', handlers.EditPostHandler),
           ('/(\d+)', handlers.PermalinkHandler),
           ('/tags/(.*)', handlers.TagHandler),
-          ('/archive/(\d{4})', handlers.ArchiveHandler)]
+          ('/archive/(\d{4})', handlers.ArchiveHandler),
+          ('/search', handlers.SearchHandler),
+          ('/img/(\w+)/(\w+)', handlers.ImageHandler),
+          ('/feed', handlers.FeedHandler),
+          ('/sitemap\.xml', handlers.SitemapIndexHandler),
+          ('/sitemap-pages\.xml', handlers.SitemapPagesHandler),
+          ('/sitemap-(\d{4})-(\d+)\.xml', handlers.SitemapYearHandler),
+          ('/_ah/warmup', handlers.WarmupHandler),
+          ('/tasks/flush-visits', handlers.FlushVisitsHandler),
+          ('/tasks/send-mail', handlers.SendMailHandler),
+          ('/admin/stats', handlers.StatsHandler),
+          ('/tasks/rebuild-summaries', handlers.RebuildSummariesHandler),
+          ('/tasks/rebuild-search', handlers.RebuildSearchIndexHandler),
+          ('/tasks/rebuild-related', handlers.RebuildRelatedHandler),
+          ('/tasks/migrate-ndb', handlers.MigrateHandler)]
 
 
 debug = os.environ.get('SERVER_SOFTWARE', '').startswith('Dev')
 
-app = webapp2.WSGIApplication(routes, debug=debug)
+application = webapp2.WSGIApplication(routes, debug=debug)
+application.router.set_dispatcher(instrumentation.route_dispatcher)
 
-app.error_handlers[404] = util.handle_error404
-if not app.debug:
-    app.error_handlers[500] = util.handle_error500
+application.error_handlers[404] = util.handle_error404
+if not application.debug:
+    application.error_handlers[500] = util.handle_error500
+
+# toplevel gives each request a fresh ndb context and waits for its
+# pending RPCs before the response is returned.
+app = instrumentation.InstrumentationMiddleware(ndb.toplevel(application))
@@ -0,0 +1,230 @@
+"""Markdown rendering of post bodies.
+
+Posts are written in a small Markdown dialect (paragraphs, headings,
+emphasis, code, links, images, lists, blockquotes and rules) and
+rendered once, when the post is saved. HTML in the source is always
+escaped, and link and image URLs are limited to http(s), mailto and
+site-relative ones, so the rendered fragment can be emitted as is.
+"""
+import cgi
+import re
+
+
+heading_re = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+rule_re = re.compile(r'^ {0,3}([-*_])(\s*\1){2,}\s*$')
+fence_re = re.compile(r'^ {0,3}```')
+quote_re = re.compile(r'^ {0,3}> ?')
+bullet_re = re.compile(r'^ {0,3}[-*+]\s+')
+ordered_re = re.compile(r'^ {0,3}\d+\.\s+')
+indented_re = re.compile(r'^(    |\t)')
+
+escape_re = re.compile(r'\\([\\`*_{}\[\]()#+\-.!>])')
+code_span_re = re.compile(r'(`+)(.+?)\1')
+# (url "title") after escaping, so the quotes are &quot;
+target = r'\(\s*([^)\s]+)(?:\s+&quot;(.*?)&quot;)?\s*\)'
+image_re = re.compile(r'!\[([^\]]*)\]' + target)
+link_re = re.compile(r'\[([^\]]+)\]' + target)
+autolink_re = re.compile(r'&lt;((?:https?://|mailto:)[^\s&]+)&gt;')
+strong_re = re.compile(r'(\*\*|__)(?=\S)(.+?)(?<=\S)\1')
+em_re = re.compile(r'(?<![\w*])([*_])(?=\S)(.+?)(?<=\S)\1(?![\w*])')
+placeholder_re = re.compile(u'\x00(\\d+)\x00')
+safe_url_re = re.compile(r'^(https?:|mailto:|/|#|[^:/?#]+(?:[/?#]|$))',
+                         re.I)
+
+tag_re = re.compile(r'(<[^>]*>)')
+tag_name_re = re.compile(r'^<\s*(/?)\s*([a-zA-Z0-9]+)')
+text_unit_re = re.compile(r'&(?:#\d+|#x[0-9a-fA-F]+|\w+);|.', re.S)
+void_tags = frozenset(['br', 'hr', 'img', 'input', 'meta', 'link'])
+
+
+def _escape(text):
+    return cgi.escape(text, quote=True)
+
+
+def _safe_url(url):
+    """Returns url if it is allowed in href/src, otherwise '#'"""
+    return url if safe_url_re.match(url) else '#'
+
+
+def render_inline(text):
+    """Renders the span-level Markdown of one block of escaped text"""
+    stash = []
+
+    def keep(html):
+        stash.append(html)
+        return u'\x00{0}\x00'.format(len(stash) - 1)
+
+    text = escape_re.sub(lambda m: keep(_escape(m.group(1))), text)
+    text = _escape(text)
+    text = code_span_re.sub(
+        lambda m: keep(u'<code>{0}</code>'.format(m.group(2).strip())), text)
+
+    def image(m):
+        title = u' title="{0}"'.format(m.group(3)) if m.group(3) else u''
+        return keep(u'<img src="{0}" alt="{1}"{2}>'.format(
+            _safe_url(m.group(2)), m.group(1), title))
+
+    def link(m):
+        # The title is stashed so emphasis is not applied inside it.
+        title = keep(u' title="{0}"'.format(m.group(3))) if m.group(3) \
+            else u''
+        return u'<a href="{0}"{1}>{2}</a>'.format(
+            keep(_safe_url(m.group(2))), title, m.group(1))
+
+    text = image_re.sub(image, text)
+    text = link_re.sub(link, text)
+    text = autolink_re.sub(lambda m: u'<a href="{0}">{1}</a>'.format(
+        keep(m.group(1)), m.group(1)), text)
+    text = strong_re.sub(r'<strong>\2</strong>', text)
+    text = em_re.sub(r'<em>\2</em>', text)
+    text = text.replace(u'  \n', u'<br>\n')
+    while placeholder_re.search(text):
+        text = placeholder_re.sub(lambda m: stash[int(m.group(1))], text)
+    return text
+
+
+def _starts_block(line):
+    return bool(heading_re.match(line) or rule_re.match(line) or
+                fence_re.match(line) or quote_re.match(line) or
+                bullet_re.match(line) or ordered_re.match(line))
+
+
+def render_blocks(lines):
+    """Renders a list of source lines to a list of HTML blocks"""
+    blocks = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+        elif fence_re.match(line):
+            i += 1
+            code = []
+            while i < len(lines) and not fence_re.match(lines[i]):
+                code.append(lines[i])
+                i += 1
+            i += 1
+            blocks.append(u'<pre><code>{0}</code></pre>'.format(
+                _escape(u'\n'.join(code))))
+        elif indented_re.match(line):
+            code = []
+            while i < len(lines) and (indented_re.match(lines[i]) or
+                                      not lines[i].strip()):
+                code.append(indented_re.sub('', lines[i]))
+                i += 1
+            blocks.append(u'<pre><code>{0}</code></pre>'.format(
+                _escape(u'\n'.join(code).rstrip('\n'))))
+        elif heading_re.match(line):
+            match = heading_re.match(line)
+            level = len(match.group(1))
+            blocks.append(u'<h{0}>{1}</h{0}>'.format(
+                level, render_inline(match.group(2))))
+            i += 1
+        elif rule_re.match(line):
+            blocks.append(u'<hr>')
+            i += 1
+        elif quote_re.match(line):
+            quoted = []
+            while i < len(lines) and lines[i].strip() and (
+                    quote_re.match(lines[i]) or quoted):
+                quoted.append(quote_re.sub('', lines[i]))
+                i += 1
+            blocks.append(u'<blockquote>{0}</blockquote>'.format(
+                u'\n'.join(render_blocks(quoted))))
+        elif bullet_re.match(line) or ordered_re.match(line):
+            item_re = bullet_re if bullet_re.match(line) else ordered_re
+            tag = 'ul' if item_re is bullet_re else 'ol'
+            items = []
+            while i < len(lines) and lines[i].strip():
+                if item_re.match(lines[i]):
+                    items.append([item_re.sub('', lines[i])])
+                elif _starts_block(lines[i]):
+                    break
+                else:
+                    items[-1].append(lines[i].strip())
+                i += 1
+            blocks.append(u'<{0}>{1}</{0}>'.format(tag, u''.join(
+                u'<li>{0}</li>'.format(render_inline(u'\n'.join(item)))
+                for item in items)))
+        else:
+            para = []
+            while i < len(lines) and lines[i].strip() and (
+                    not para or not _starts_block(lines[i])):
+                para.append(lines[i])
+                i += 1
+            blocks.append(u'<p>{0}</p>'.format(
+                render_inline(u'\n'.join(para))))
+    return blocks
+
+
+def render(source):
+    """Renders Markdown source to a safe HTML fragment"""
+    # NUL delimits the placeholders of render_inline.
+    source = source.replace(u'\x00', u'')
+    lines = source.replace(u'\r\n', u'\n').replace(u'\r', u'\n').split(u'\n')
+    return u'\n'.join(render_blocks(lines))
+
+
+def _text_units(text):
+    """Splits an HTML text run into displayed characters; an entity is
+       one character
+    """
+    return text_unit_re.findall(text)
+
+
+def _cut_text(text, length):
+    """Cuts an HTML text run to at most length displayed characters,
+       never inside an entity, preferring a word boundary
+    """
+    units = _text_units(text)
+    cut = units[:length]
+    if len(units) > length and not units[length].isspace():
+        space = len(cut) - 1
+        while space > 0 and not cut[space].isspace():
+            space -= 1
+        if space > length / 2:
+            cut = cut[:space]
+    return u''.join(cut).rstrip()
+
+
+def excerpt(html, length):
+    """Returns the start of an HTML fragment with at most length
+       characters of text, followed by '...' when it was shortened.
+       Tags left open by the cut are closed, so the excerpt is valid
+       HTML on its own.
+    """
+    out = []
+    open_tags = []
+    remaining = length
+    for part in tag_re.split(html):
+        if not part:
+            continue
+        if part.startswith(u'<'):
+            match = tag_name_re.match(part)
+            if match:
+                closing, name = match.group(1), match.group(2).lower()
+                if closing:
+                    if name in open_tags:
+                        del open_tags[len(open_tags) - 1 -
+                                      open_tags[::-1].index(name)]
+                elif name not in void_tags and not part.endswith(u'/>'):
+                    open_tags.append(name)
+            out.append(part)
+            continue
+        shown = len(_text_units(part))
+        if shown <= remaining:
+            out.append(part)
+            remaining -= shown
+            continue
+        out.append(_cut_text(part, remaining) + u'...')
+        out.extend(u'</{0}>'.format(name) for name in reversed(open_tags))
+        return u''.join(out)
+    return html
+
+
+def plain_text(html, length):
+    """Returns up to length characters of the text of an HTML fragment,
+       with entities left encoded so it can be used in an attribute
+    """
+    text = u' '.join(tag_re.sub(u' ', html).split()).replace(u'"', u'&quot;')
+    return _cut_text(text, length)
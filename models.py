@@ -1,20 +1,60 @@
-from google.appengine.ext import db
+import json
+
+from google.appengine.ext import ndb
 
 import config
+import storage
 import util
 
+# markup is imported by the methods that render posts, which only run
+# when a post is written.
+
+
+class BlogPost(ndb.Model):
+    """Model class for blog posts. content is the Markdown source;
+       content_html and description are rendered from it when it is set.
+       Posts written before Markdown (legacy_html) have HTML as their
+       source, which is used as is.
+    """
+    subject = ndb.StringProperty(required=True)
+    content = ndb.TextProperty(required=True)
+    content_html = ndb.TextProperty()
+    description = ndb.StringProperty(indexed=False)
+    legacy_html = ndb.BooleanProperty(default=False, indexed=False)
+    created = ndb.DateProperty(auto_now_add=True)
+    last_modified = ndb.DateTimeProperty(auto_now=True)
+    post_id = ndb.StringProperty()
+    image_url = ndb.StringProperty(required=True)
+    tag = ndb.StringProperty(required=True)
+    author = ndb.StringProperty(default=config.blog_author)
+    visits = ndb.IntegerProperty(default=0)
+
+    description_length = 145
+
+    def is_legacy(self):
+        """True for posts whose content is HTML: flagged by
+           util.rebuild_post_summaries, or not migrated yet
+        """
+        return self.legacy_html or (self.content is not None and
+                                    self.content_html is None)
 
-class BlogPost(db.Model):
-    """Model class for blog posts"""
-    subject = db.StringProperty(required=True)
-    content = db.TextProperty(required=True)
-    created = db.DateProperty(auto_now_add=True)
-    last_modified = db.DateTimeProperty(auto_now=True)
-    post_id = db.StringProperty()
-    image_url = db.StringProperty(required=True)
-    tag = db.StringProperty(required=True)
-    author = db.StringProperty(default=config.blog_author)
-    visits = db.IntegerProperty(default=0)
+    def set_content(self, content):
+        """Sets the Markdown source and renders it"""
+        import markup
+        if self.is_legacy():
+            self.legacy_html = True
+            self.content = content
+            self.set_html(content)
+            return
+        self.content = content
+        self.set_html(markup.render(content))
+
+    def set_html(self, content_html):
+        """Sets the rendered body and the meta description taken from it"""
+        import markup
+        self.content_html = content_html
+        self.description = markup.plain_text(content_html,
+                                             self.description_length)
 
 
 class PostPreview(BlogPost):
@@ -22,20 +62,66 @@ class PostPreview(BlogPost):
     pass
 
 
-class Admin(db.Model):
+class PostSummary(ndb.Model):
+    """Model class for the part of a blog post shown on listing pages.
+       Keyed by post_id and written in the same transaction as the post,
+       so listings never load the full post content.
+    """
+    subject = ndb.StringProperty(required=True)
+    excerpt = ndb.TextProperty()
+    created = ndb.DateProperty()
+    last_modified = ndb.DateTimeProperty()
+    post_id = ndb.StringProperty()
+    image_url = ndb.StringProperty(indexed=False)
+    tag = ndb.StringProperty()
+    visits = ndb.IntegerProperty(default=0, indexed=False)
+
+    excerpt_length = 350
+
+    @classmethod
+    def from_post(cls, post):
+        """Builds the summary entity of a BlogPost"""
+        import markup
+        return cls(id=post.post_id,
+                   subject=post.subject,
+                   excerpt=markup.excerpt(post.content_html,
+                                          cls.excerpt_length),
+                   created=post.created,
+                   last_modified=post.last_modified,
+                   post_id=post.post_id,
+                   image_url=post.image_url,
+                   tag=post.tag,
+                   visits=post.visits)
+
+
+class SearchTerm(ndb.Model):
+    """Model class for one term of the search index, keyed by the term.
+       postings holds the encoded post ids and weights (see search.py).
+    """
+    postings = ndb.BlobProperty()
+    doc_count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class RelatedPosts(ndb.Model):
+    """Model class for the posts related to one post, keyed by its
+       post_id (see related.py). post_ids is indexed so the posts listing
+       a given post can be found when it changes.
+    """
+    post_ids = ndb.IntegerProperty(repeated=True)
+    scores = ndb.FloatProperty(repeated=True, indexed=False)
+    norm = ndb.FloatProperty(indexed=False)
+
+
+class Admin(ndb.Model):
     """Model class for Admin login"""
-    admin_username = db.StringProperty(default=config.admin_username)
-    admin_pw_hash = db.StringProperty(default=config.admin_pw)
+    entity_name = 'admin_key_name'
+    admin_username = ndb.StringProperty(default=config.admin_username)
+    admin_pw_hash = ndb.StringProperty(default=config.admin_pw)
 
     @classmethod
     def login_validation(cls, username):
         """Provides login validation for login"""
-        try:
-            q = db.GqlQuery("SELECT * from Admin WHERE admin_username= :1",
-                            username)
-            return q[0]
-        except IndexError:
-            return None
+        return storage.repository().admin_by_username(username)
 
     @classmethod
     def change_username(cls, new_username, pw):
@@ -48,8 +134,7 @@ class Admin(db.Model):
         elif len(new_username) < 6:
             return 'Username must be greater than 6 characters'
         else:
-            admin_key = db.Key.from_path('Admin', 'admin_key_name')
-            admin = Admin.get(admin_key)
+            admin = storage.repository().get_admin()
             if not util.valid_pw(admin.admin_username, pw,
                                       admin.admin_pw_hash):
                 return 'Invalid Password. Please Retry.'
@@ -57,7 +142,7 @@ class Admin(db.Model):
                 admin.admin_username = new_username
                 pw_hash = util.make_pw_hash(new_username, pw)
                 admin.admin_pw_hash = pw_hash
-                admin.put()
+                storage.repository().save_admin(admin)
                 return 'Username change was successful!'
 
     @classmethod
@@ -68,15 +153,118 @@ class Admin(db.Model):
         elif len(password) < 6:
             return 'Password must be greater than 6 characters.'
         else:
-            admin_key = db.Key.from_path('Admin', 'admin_key_name')
-            admin = Admin.get(admin_key)
+            admin = storage.repository().get_admin()
             pw_hash = util.make_pw_hash(admin.admin_username, password)
             admin.admin_pw_hash = pw_hash
-            admin.put()
+            storage.repository().save_admin(admin)
             return 'Password changed.'
 
 
-class SubscribeEmail(db.Model):
-    """Model class for Receiving Subscribe Emails"""
-    email = db.StringProperty(required=True)
-    created = db.DateTimeProperty(auto_now_add=True)
+class SubscribeEmail(ndb.Model):
+    """Model class for Receiving Subscribe Emails.
+       Keyed by the lower-cased address, so each sender is stored once.
+    """
+    email = ndb.StringProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class PostImage(ndb.Model):
+    """Model class for uploaded post images and their resized variants.
+       Keyed by the image id, or '<id>-<size>' for a variant (images.py).
+    """
+    # Image bytes are cached by images.py, not by ndb.
+    _use_cache = False
+    _use_memcache = False
+
+    content_type = ndb.StringProperty(indexed=False)
+    data = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class SidebarCounts(ndb.Model):
+    """Model class for the tag and archive year counts shown in the sidebar.
+       A single entity whose counts are stored as JSON objects.
+    """
+    tag_counts = ndb.TextProperty(default='{}')
+    year_counts = ndb.TextProperty(default='{}')
+
+    entity_name = 'sidebar_counts'
+
+    def tags(self):
+        """Returns a list of (tag, count) tuples in alphabetical order"""
+        return sorted(json.loads(self.tag_counts).iteritems())
+
+    def years(self):
+        """Returns a list of (year, count) tuples in order"""
+        return sorted(json.loads(self.year_counts).iteritems())
+
+    @classmethod
+    def adjust(cls, tag_deltas, year_deltas):
+        """Applies count changes, e.g. {'python': 1, 'misc': -1}.
+           Must run inside the transaction that writes the posts, so the
+           counts can never drift from the posts. Returns the updated
+           entity, or None if the counts have not been built yet.
+        """
+        counts = cls.get_by_id(cls.entity_name)
+        if counts is None:
+            return None
+        counts.tag_counts = _apply_deltas(counts.tag_counts, tag_deltas)
+        counts.year_counts = _apply_deltas(counts.year_counts, year_deltas)
+        counts.put()
+        return counts
+
+    @classmethod
+    def rebuild(cls):
+        """Counts every BlogPost. Only used when the entity does not exist
+           yet, i.e. the first sidebar render after deploying, and after
+           bulk imports.
+        """
+        tag_counts = {}
+        year_counts = {}
+        for post in BlogPost.query().iter(batch_size=500, use_cache=False):
+            year = post.created.strftime('%Y')
+            tag_counts[post.tag] = tag_counts.get(post.tag, 0) + 1
+            year_counts[year] = year_counts.get(year, 0) + 1
+        counts = cls(id=cls.entity_name,
+                     tag_counts=json.dumps(tag_counts),
+                     year_counts=json.dumps(year_counts))
+        counts.put()
+        return counts
+
+
+def _apply_deltas(encoded, deltas):
+    """Adds deltas to a JSON encoded count dict, dropping empty entries"""
+    counts = json.loads(encoded)
+    for name, delta in deltas.iteritems():
+        total = counts.get(name, 0) + delta
+        if total > 0:
+            counts[name] = total
+        else:
+            counts.pop(name, None)
+    return json.dumps(counts)
+
+
+class VisitShard(ndb.Model):
+    """Model class for one shard of a post's visit counter. Key names are
+       '<post_id>-<shard number>'; a post's visits are the sum of its shards.
+    """
+    post_id = ndb.StringProperty(required=True)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Shards are written and read in batches by counters.py.
+    _use_memcache = False
+
+
+class VisitLeaderboard(ndb.Model):
+    """Model class for the most visited posts: the leaderboard_size posts
+       with the most total visits, most first, as parallel lists. There is
+       one entity, merged with the new totals of the posts in each visit
+       flush (see counters.py).
+    """
+    entity_name = 'visit_leaderboard'
+    post_ids = ndb.StringProperty(repeated=True, indexed=False)
+    visits = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    def ranked(self):
+        """Returns (post_id, visits) tuples, most visited first"""
+        return zip(self.post_ids, self.visits)
@@ -0,0 +1,217 @@
+"""Related posts, precomputed for the permalink pages.
+
+Each post has a RelatedPosts entity with the ids of its related_posts
+best matches and their scores. A candidate scores related_tag_weight
+for sharing the post's tag, related_term_weight times the cosine
+similarity of the two posts' tf-idf vectors (over each post's
+related_terms heaviest terms, weighted as in search.py) and
+related_recency_weight for being new, halving every
+related_half_life_days of its age.
+
+Candidates are the posts sharing the most term weight (read from the
+search index postings), the newest posts with the same tag and the posts
+already listing the post. Writing a post recomputes its list and merges
+it into the lists of those candidates, so a write touches only the
+entities of the posts it relates to. The recency part of a stored score
+is as of when it was computed; /tasks/rebuild-related recomputes every
+list.
+"""
+import datetime
+import math
+from collections import Counter
+
+from google.appengine.ext import ndb
+
+import config
+import models
+import search
+import storage
+import util
+
+
+def term_weight(weight, doc_count, num_posts):
+    """tf-idf weight of a term in a post, as search.search ranks it"""
+    return ((1.0 + math.log(weight)) *
+            math.log(1.0 + float(num_posts) / max(doc_count, 1)))
+
+
+def post_vector(terms, num_posts):
+    """Returns (vector, postings) for a post's search.post_terms().
+       vector maps its related_terms heaviest terms to their tf-idf
+       weight; postings has the index postings of those terms.
+    """
+    heaviest = [term for term, _ in terms.most_common(
+        config.related_terms * 2)]
+    postings = search.term_postings(heaviest)
+    weights = dict((term, term_weight(terms[term], len(postings[term]),
+                                      num_posts))
+                   for term in heaviest)
+    top = sorted(weights, key=weights.get,
+                 reverse=True)[:config.related_terms]
+    return (dict((term, weights[term]) for term in top),
+            dict((term, postings[term]) for term in top))
+
+
+def norm(vector):
+    return math.sqrt(sum(w * w for w in vector.itervalues())) or 1.0
+
+
+def score(same_tag, cosine, created, today):
+    """Score of a candidate created on created"""
+    age = max((today - created).days, 0)
+    recency = 0.5 ** (age / float(config.related_half_life_days))
+    return (config.related_tag_weight * same_tag +
+            config.related_term_weight * cosine +
+            config.related_recency_weight * recency)
+
+
+def _top(pairs):
+    """The best related_posts of (score, post_id) pairs"""
+    return sorted(pairs, reverse=True)[:config.related_posts]
+
+
+def _newest(tag):
+    """Ids of the newest related_candidates posts tagged tag"""
+    summaries, _ = storage.repository().list_posts_async(
+        config.related_candidates, tag=tag).get_result()
+    return [int(summary.post_id) for summary in summaries]
+
+
+def _candidates(post_id, vector, postings, num_posts, same_tag):
+    """Returns ({candidate id: dot product}, candidate ids). same_tag
+       are the _newest() posts with the post's tag.
+    """
+    dots = Counter()
+    for term, weight in vector.iteritems():
+        for other, other_weight in postings[term].iteritems():
+            if other != post_id:
+                dots[other] += weight * term_weight(
+                    other_weight, len(postings[term]), num_posts)
+    candidates = set(other for other, _ in dots.most_common(
+        config.related_candidates))
+    candidates.update(same_tag)
+    candidates.discard(post_id)
+    return dots, sorted(candidates)
+
+
+def refresh_post(post, terms):
+    """Recomputes the related posts of post (a BlogPost or PostSummary)
+       and merges it into the lists of its candidates. terms are its
+       search.post_terms(). Returns the ids of the other posts whose
+       lists show it, whose pages need re-rendering.
+    """
+    post_id = int(post.post_id)
+    today = datetime.date.today()
+    num_posts = sum(count for _, count in util.generate_tag_list()) or 1
+    vector, postings = post_vector(terms, num_posts)
+    post_norm = norm(vector)
+    dots, candidates = _candidates(post_id, vector, postings, num_posts,
+                                   _newest(post.tag))
+    # Posts listing this one must drop it if it no longer relates.
+    listing = models.RelatedPosts.query(
+        models.RelatedPosts.post_ids == post_id).fetch(keys_only=True)
+    candidates = sorted(set(candidates) |
+                        set(int(key.id()) for key in listing))
+
+    summaries = dict((int(summary.post_id), summary) for summary in
+                     storage.repository().get_summaries(candidates))
+    entities = ndb.get_multi([ndb.Key('RelatedPosts', str(other))
+                              for other in candidates])
+    own, puts, shown = [], [], []
+    for other, entity in zip(candidates, entities):
+        summary = summaries.get(other)
+        if summary is None:
+            continue
+        other_norm = entity.norm if entity and entity.norm else post_norm
+        cosine = min(1.0, dots.get(other, 0.0) / (post_norm * other_norm))
+        same_tag = summary.tag == post.tag
+        own.append((score(same_tag, cosine, summary.created, today), other))
+        if entity is None:
+            # Its list is written when it is written or rebuilt.
+            continue
+        pairs = [(s, i) for s, i in zip(entity.scores, entity.post_ids)
+                 if i != post_id]
+        merged = _top(pairs + [(score(same_tag, cosine, post.created,
+                                      today), post_id)])
+        if post_id in entity.post_ids or post_id in [i for _, i in merged]:
+            shown.append(str(other))
+        if merged != zip(entity.scores, entity.post_ids):
+            entity.scores = [s for s, _ in merged]
+            entity.post_ids = [i for _, i in merged]
+            puts.append(entity)
+    own = _top(own)
+    puts.append(models.RelatedPosts(id=str(post_id),
+                                    post_ids=[i for _, i in own],
+                                    scores=[s for s, _ in own],
+                                    norm=post_norm))
+    ndb.put_multi(puts)
+    return shown
+
+
+def _write_lists(entities):
+    """Stores recomputed RelatedPosts entities, then bumps the post scopes
+       of the posts whose list changed, so their cached lists are read
+       again only once the new ones are stored
+    """
+    old = ndb.get_multi([entity.key for entity in entities], use_cache=False)
+    ndb.put_multi(entities, use_cache=False)
+    changed = ['post:' + entity.key.id()
+               for entity, previous in zip(entities, old)
+               if previous is None or previous.post_ids != entity.post_ids]
+    if changed:
+        util.bump_cache_versions(*changed)
+
+
+def rebuild_index(batch_size=100):
+    """Computes the related posts of every post from scratch, after
+       search.rebuild_index(). Returns the number of posts. Permalinks
+       keep their lists meanwhile: every list is overwritten, in
+       batch_size batches, before the lists of posts that no longer
+       exist are deleted.
+    """
+    today = datetime.date.today()
+    repo = storage.repository()
+    num_posts = sum(count for _, count in util.generate_tag_list()) or 1
+    vectors = {}
+    for post in repo.iter_posts(batch_size):
+        terms = search.post_terms(post.subject, post.content)
+        vector, _ = post_vector(terms, num_posts)
+        vectors[int(post.post_id)] = (post.tag, vector)
+    norms = dict((post_id, norm(vector))
+                 for post_id, (_, vector) in vectors.iteritems())
+    # The newest posts of a tag are the same for every post with it.
+    newest = dict((tag, _newest(tag)) for tag, _ in vectors.itervalues())
+    entities = []
+    for post_id, (tag, vector) in vectors.iteritems():
+        # Postings are read again, through ndb's cache, rather than kept
+        # for every post.
+        dots, candidates = _candidates(post_id, vector,
+                                       search.term_postings(list(vector)),
+                                       num_posts, newest[tag])
+        own = []
+        for summary in repo.get_summaries(candidates):
+            other = int(summary.post_id)
+            cosine = min(1.0, dots.get(other, 0.0) /
+                         (norms[post_id] * norms.get(other, norms[post_id])))
+            own.append((score(summary.tag == tag, cosine, summary.created,
+                              today), other))
+        own = _top(own)
+        entities.append(models.RelatedPosts(id=str(post_id),
+                                            post_ids=[i for _, i in own],
+                                            scores=[s for s, _ in own],
+                                            norm=norms[post_id]))
+        if len(entities) == batch_size:
+            _write_lists(entities)
+            entities = []
+    if entities:
+        _write_lists(entities)
+    vanished = []
+    for key in models.RelatedPosts.query().iter(keys_only=True,
+                                               batch_size=batch_size):
+        if int(key.id()) not in vectors:
+            vanished.append(key)
+            if len(vanished) == batch_size:
+                ndb.delete_multi(vanished)
+                vanished = []
+    ndb.delete_multi(vanished)
+    return len(vectors)
@@ -0,0 +1,227 @@
+"""Full-text search over post subjects and content.
+
+An inverted index of SearchTerm entities, one per stemmed term, whose
+postings hold the ids of the posts containing the term and the term's
+weight in each post. Postings are sorted by post id and stored as
+varint-encoded id deltas. post_new and post_update re-index a post by
+rewriting only the terms whose weight changed.
+"""
+import htmlentitydefs
+import logging
+import math
+import re
+import time
+from collections import Counter
+
+from google.appengine.ext import ndb
+
+import config
+import models
+import storage
+import util
+
+
+subject_weight = 3
+
+stop_words = frozenset('''a about after all also an and any are as at be
+    because been but by can could did do does for from had has have he her
+    his how i if in into is it its just me more my no not of on one or our
+    out she so than that the their them then there these they this to up
+    us was we were what when which who will with would you your'''.split())
+
+html_tag_re = re.compile(r'<[^>]*>')
+entity_re = re.compile(r'&(#?\w+);')
+# Letters and digits of any script, so accented and non-Latin words stay
+# whole.
+word_re = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def _unescape(match):
+    name = match.group(1)
+    if name.startswith('#'):
+        try:
+            return unichr(int(name[1:]))
+        except ValueError:
+            return ' '
+    return unichr(htmlentitydefs.name2codepoint.get(name, 32))
+
+
+def strip_html(text):
+    """Removes tags and decodes entities"""
+    return entity_re.sub(_unescape, html_tag_re.sub(' ', text))
+
+
+def stem(word):
+    """Light suffix-stripping stemmer (Porter step 1), enough to match
+       plurals and -ed/-ing forms to their stem.
+    """
+    if len(word) <= 3:
+        return word
+    if word.endswith('sses') or word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+    for suffix in ('eed', 'ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            if suffix == 'eed':
+                word = word[:-1]
+            else:
+                word = word[:-len(suffix)]
+                if word[-2:] in ('at', 'bl', 'iz'):
+                    word += 'e'
+                elif word[-1] == word[-2] and word[-1] not in 'lsz':
+                    word = word[:-1]
+            break
+    if word.endswith('y') and len(word) > 3:
+        word = word[:-1] + 'i'
+    return word
+
+
+def tokenize(text):
+    """Returns the stemmed terms of a piece of HTML or plain text, as
+       UTF-8 strings like the SearchTerm key names
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    words = word_re.findall(strip_html(text).lower())
+    return [stem(word).encode('utf-8') for word in words
+            if word not in stop_words and len(word) > 1]
+
+
+def post_terms(subject, content):
+    """Returns {term: weight} of a post; subject terms count extra"""
+    terms = Counter(tokenize(content))
+    for term in tokenize(subject):
+        terms[term] += subject_weight
+    return terms
+
+
+def _encode_varint(value, out):
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+
+
+def encode_postings(postings):
+    """Encodes {post_id: weight} as varint (id delta, weight) pairs"""
+    out = []
+    previous = 0
+    for post_id in sorted(postings):
+        _encode_varint(post_id - previous, out)
+        _encode_varint(postings[post_id], out)
+        previous = post_id
+    return ''.join(out)
+
+
+def decode_postings(data):
+    """Inverse of encode_postings"""
+    postings = {}
+    values = []
+    value = shift = 0
+    for char in data:
+        byte = ord(char)
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    post_id = 0
+    for i in xrange(0, len(values), 2):
+        post_id += values[i]
+        postings[post_id] = values[i + 1]
+    return postings
+
+
+def update_post(post_id, old_terms, new_terms):
+    """Re-indexes one post. old_terms and new_terms are post_terms()
+       results; pass an empty Counter for a new or deleted post.
+    """
+    post_id = int(post_id)
+    changed = [term for term in set(old_terms) | set(new_terms)
+               if old_terms.get(term) != new_terms.get(term)]
+    if not changed:
+        return
+    keys = [ndb.Key('SearchTerm', term) for term in changed]
+    entities = ndb.get_multi(keys)
+    puts, deletes = [], []
+    for term, key, entity in zip(changed, keys, entities):
+        postings = decode_postings(entity.postings) if entity else {}
+        if new_terms.get(term):
+            postings[post_id] = new_terms[term]
+        else:
+            postings.pop(post_id, None)
+        if postings:
+            puts.append(models.SearchTerm(key=key,
+                                          postings=encode_postings(postings),
+                                          doc_count=len(postings)))
+        elif entity:
+            deletes.append(key)
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+
+
+def term_postings(terms):
+    """Returns {term: {post_id: weight}}. Terms are read through ndb's
+       memcache entity cache.
+    """
+    entities = ndb.get_multi([ndb.Key('SearchTerm', term) for term in terms])
+    return dict((term, decode_postings(entity.postings) if entity else {})
+                for term, entity in zip(terms, entities))
+
+
+def search(query, page=1):
+    """Ranks posts for a query by tf-idf. Returns (summaries, has_more)"""
+    start = time.time()
+    terms = list(set(tokenize(query)))
+    if not terms:
+        return [], False
+    postings = term_postings(terms)
+    num_posts = sum(count for _, count in util.generate_tag_list()) or 1
+    scores = Counter()
+    for term, docs in postings.iteritems():
+        if not docs:
+            continue
+        idf = math.log(1.0 + float(num_posts) / len(docs))
+        for post_id, weight in docs.iteritems():
+            scores[post_id] += (1.0 + math.log(weight)) * idf
+    ranked = [post_id for post_id, _ in scores.most_common()]
+    per_page = config.search_results_per_page
+    page_ids = ranked[(page - 1) * per_page:page * per_page]
+    results = storage.repository().get_summaries(page_ids)
+    logging.info('Search %r: %d matches in %.1f ms', query, len(ranked),
+                 (time.time() - start) * 1000.0)
+    return results, len(ranked) > page * per_page
+
+
+def rebuild_index(batch_size=100):
+    """Indexes every post from scratch, for posts that were created
+       before the index existed or bulk imported. Returns the number of
+       posts. Searches keep working meanwhile: every term is overwritten
+       before the terms no post has any more are deleted, both in
+       batch_size batches.
+    """
+    index = {}
+    indexed = 0
+    for post in storage.repository().iter_posts(batch_size):
+        for term, weight in post_terms(post.subject,
+                                       post.content).iteritems():
+            index.setdefault(term, {})[int(post.post_id)] = weight
+        indexed += 1
+    terms = index.keys()
+    for start in xrange(0, len(terms), batch_size):
+        ndb.put_multi([models.SearchTerm(id=term,
+                                         postings=encode_postings(
+                                             index[term]),
+                                         doc_count=len(index[term]))
+                       for term in terms[start:start + batch_size]])
+    vanished = []
+    for key in models.SearchTerm.query().iter(keys_only=True,
+                                              batch_size=batch_size):
+        if key.id() not in index:
+            vanished.append(key)
+            if len(vanished) == batch_size:
+                ndb.delete_multi(vanished)
+                vanished = []
+    ndb.delete_multi(vanished)
+    return indexed
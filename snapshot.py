@@ -0,0 +1,295 @@
+"""Static snapshot of the reader pages, for serving from a CDN.
+
+Renders the home page, the about page, every permalink and every tag
+and archive year through main.app into a directory tree: a page at /path
+is written to <out>/path/index.html, with a .gz copy (and a .br copy
+when the brotli module is installed) next to it, and static/ is copied
+alongside. Listing pages are followed through their ?cursor= links,
+written as .../page/N/ and their links rewritten to match. Uploaded
+images shown on the pages are written to <out>/img/.
+
+<out>/snapshot.json records each post's last_modified, tag, year and
+related posts, the sidebar counts and the asset build. A later run only
+re-renders the permalinks of changed posts, of the posts whose related
+posts list shows them or changed, and the listings they appear in. When the
+sidebar (shown on every page) or the asset bundles changed, or with
+--full, every page is re-rendered, spread over worker processes.
+
+The datastore is either the live app's, through remote_api, or a local
+dev_appserver datastore file; with config.storage_backend = 'sqlite'
+posts are read from the SQLite file instead. Memcache is always local,
+so exporting never touches the app's caches or visit counters.
+
+    APPENGINE_SDK=~/google_appengine python snapshot.py \\
+        --remote blog.appspot.com snapshot/
+    APPENGINE_SDK=~/google_appengine python snapshot.py \\
+        --datastore-path ~/blog.datastore snapshot/
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import urllib
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+state_file = 'snapshot.json'
+next_page_re = re.compile(r'href="\?cursor=([^"]+)"')
+image_re = re.compile(r'"(/img/\w+/\w+)[" ]')
+
+# The options of the running process, for the worker initializer.
+options = None
+
+
+def setup_sdk(sdk_path=None):
+    """Puts the App Engine SDK on sys.path"""
+    sdk_path = sdk_path or os.environ.get('APPENGINE_SDK')
+    if not sdk_path:
+        sys.exit('Set APPENGINE_SDK or pass --sdk to the SDK directory.')
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if root_dir not in sys.path:
+        sys.path.insert(0, root_dir)
+
+
+def connect(args, save_changes=False, remote_memcache=False):
+    """Sets up local service stubs, with the datastore of the live app or
+       of a local datastore file, written back with save_changes. Returns
+       the testbed. With remote_memcache the live app's memcache is used
+       too, so writes can invalidate its caches.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.ext import testbed
+    datastore = memcache = None
+    if args.remote:
+        from google.appengine.ext.remote_api import remote_api_stub
+        remote_api_stub.ConfigureRemoteApiForOAuth(args.remote,
+                                                   '/_ah/remote_api')
+        datastore = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        if remote_memcache:
+            memcache = apiproxy_stub_map.apiproxy.GetStub('memcache')
+    app_id = os.environ.get('APPLICATION_ID', 'blog')
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    if datastore:
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
+    else:
+        bed.init_datastore_v3_stub(datastore_file=args.datastore_path,
+                                   use_sqlite=True,
+                                   save_changes=save_changes)
+    if memcache:
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache)
+    else:
+        bed.init_memcache_stub()
+    bed.init_mail_stub()
+    bed.init_taskqueue_stub(root_path=root_dir)
+    return bed
+
+
+def init_worker(args):
+    """Pool initializer: every worker needs its own connections"""
+    global options
+    options = args
+    setup_sdk(args.sdk)
+    connect(args)
+
+
+def file_for(out_dir, path):
+    return os.path.join(out_dir, urllib.unquote(path).strip('/'),
+                        'index.html')
+
+
+def write_page(out_dir, path, body):
+    """Writes one page with its precompressed copies"""
+    import assets
+    filename = file_for(out_dir, path)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(body)
+    assets.write_precompressed(filename, body)
+
+
+def get(path):
+    """Renders path through main.app as an anonymous reader"""
+    import webapp2
+    import main
+    return webapp2.Request.blank(path).get_response(main.app)
+
+
+def write_images(out_dir, body):
+    """Writes the uploaded images a page shows that are not exported yet.
+       Their URLs never change, so an existing file is current.
+    """
+    for path in set(image_re.findall(body)):
+        filename = os.path.join(out_dir, path.strip('/'))
+        if os.path.exists(filename):
+            continue
+        response = get(path)
+        if response.status_int != 200:
+            logging.warning('%s: %d, not exported', path,
+                            response.status_int)
+            continue
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            pass  # exists, possibly made by another worker
+        with open(filename, 'wb') as f:
+            f.write(response.body)
+
+
+def render_job(job):
+    """Renders a page, or every page of a listing. Returns the number of
+       pages written.
+    """
+    kind, path = job
+    out_dir = options.out
+    written = 0
+    request_path, page = path, 1
+    while request_path:
+        response = get(request_path)
+        if response.status_int != 200:
+            logging.warning('%s: %d, not exported', request_path,
+                            response.status_int)
+            break
+        body = response.body
+        base = path.rstrip('/')
+        request_path = None
+        match = next_page_re.search(body)
+        if kind == 'listing' and match:
+            next_path = '{base}/page/{n}/'.format(base=base, n=page + 1)
+            body = next_page_re.sub('href="{0}"'.format(next_path), body)
+            request_path = '{path}?cursor={cursor}'.format(
+                path=path, cursor=match.group(1))
+        page_path = path if page == 1 else '{base}/page/{n}/'.format(
+            base=base, n=page)
+        write_page(out_dir, page_path, body)
+        write_images(out_dir, body)
+        written += 1
+        page += 1
+    return written
+
+
+def read_site():
+    """Returns ({post_id: [last_modified, tag, year, related ids]},
+       sidebar)
+    """
+    import models
+    import storage
+    import util
+    related = {}
+    for entity in models.RelatedPosts.query().iter(batch_size=500):
+        related[entity.key.id()] = [str(i) for i in entity.post_ids]
+    posts = {}
+    for summary in storage.repository().iter_summaries():
+        posts[summary.post_id] = [summary.last_modified.isoformat(),
+                                  summary.tag,
+                                  summary.created.strftime('%Y'),
+                                  related.get(summary.post_id, [])]
+    sidebar = util.sidebar_counts()
+    return posts, {'tags': [list(item) for item in sidebar['tags']],
+                   'archive': [list(item) for item in sidebar['archive']]}
+
+
+def listing_paths(tags, years):
+    return (['/'] +
+            ['/tags/' + urllib.quote(tag.encode('utf-8')) for tag in tags] +
+            ['/archive/' + year for year in years])
+
+
+def plan(state, posts, sidebar, asset_version, full):
+    """Returns (jobs, full) for a run from the previous state"""
+    if (full or not state or state.get('sidebar') != sidebar or
+            state.get('assets') != asset_version):
+        jobs = [('page', '/about')]
+        jobs += [('page', '/' + post_id) for post_id in sorted(posts)]
+        jobs += [('listing', path) for path in listing_paths(
+            [tag for tag, _ in sidebar['tags']],
+            [year for year, _ in sidebar['archive']])]
+        return jobs, True
+    # The sidebar is unchanged, so no post was added or removed and no
+    # post moved to another tag or year.
+    changed = set(post_id for post_id, values in posts.iteritems()
+                  if state['posts'].get(post_id, [])[:3] != values[:3])
+    # Related posts lists show the subject and image of the posts in them.
+    pages = changed | set(
+        post_id for post_id, values in posts.iteritems()
+        if state['posts'].get(post_id, [])[3:] != values[3:] or
+        changed.intersection(values[3]))
+    jobs = [('page', '/' + post_id) for post_id in sorted(pages)]
+    if changed:
+        jobs += [('listing', path) for path in listing_paths(
+            sorted(set(posts[post_id][1] for post_id in changed)),
+            sorted(set(posts[post_id][2] for post_id in changed)))]
+    return jobs, False
+
+
+def main():
+    global options
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out', help='output directory')
+    parser.add_argument('--sdk')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--remote', help='app host serving remote_api')
+    source.add_argument('--datastore-path', help='local datastore file')
+    parser.add_argument('--full', action='store_true',
+                        help='re-render every page')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    options = parser.parse_args()
+    options.out = os.path.abspath(options.out)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    setup_sdk(options.sdk)
+    connect(options)
+    import assets
+
+    state_path = os.path.join(options.out, state_file)
+    state = None
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    posts, sidebar = read_site()
+    jobs, full = plan(state, posts, sidebar, assets.version, options.full)
+
+    if os.path.isdir(options.out) and state is None and os.listdir(
+            options.out):
+        # Only a directory holding an earlier snapshot is ever cleared.
+        sys.exit('{out} is not empty and holds no {state}; pass an empty '
+                 'or new directory.'.format(out=options.out,
+                                            state=state_file))
+    if full and os.path.isdir(options.out):
+        shutil.rmtree(options.out)
+    if not os.path.isdir(options.out):
+        os.makedirs(options.out)
+    static_out = os.path.join(options.out, 'static')
+    if os.path.isdir(static_out):
+        shutil.rmtree(static_out)
+    shutil.copytree(os.path.join(root_dir, 'static'), static_out)
+
+    if full and options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, init_worker,
+                                    (options,))
+        written = sum(pool.imap_unordered(render_job, jobs))
+        pool.close()
+        pool.join()
+    else:
+        written = sum(render_job(job) for job in jobs)
+
+    with open(state_path, 'w') as f:
+        json.dump({'posts': posts, 'sidebar': sidebar,
+                   'assets': assets.version}, f, sort_keys=True)
+    logging.info('%s snapshot: %d pages from %d jobs in %s',
+                 'Full' if full else 'Incremental', written, len(jobs),
+                 options.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,597 @@
+"""Storage backends for posts, previews, the admin account, subscribers
+and uploaded images.
+
+repository() returns the backend named by config.storage_backend:
+'datastore' (ndb entities, the default on App Engine) or 'sqlite'. Both
+hand out the model classes in models.py, SQLite rows being turned into
+unsaved entities, so the caches and templates work the same with
+either. Methods ending in _async return ndb futures; the SQLite ones are
+already resolved.
+
+The search index, visit counters and maintenance tasks stay on the
+datastore.
+"""
+import base64
+import binascii
+import datetime
+import json
+import os
+import threading
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import config
+import models
+
+
+class DatastoreRepository(object):
+    """Posts, accounts and images stored as ndb entities"""
+
+    def get_post_async(self, post_id):
+        return models.BlogPost.get_by_id_async(int(post_id))
+
+    def _summaries(self, tag=None, year=None):
+        query = models.PostSummary.query()
+        if tag is not None:
+            query = query.filter(models.PostSummary.tag == tag)
+        if year is not None:
+            query = query.filter(
+                models.PostSummary.created >= datetime.date(int(year), 1, 1),
+                models.PostSummary.created < datetime.date(int(year) + 1,
+                                                           1, 1))
+        return query
+
+    @ndb.tasklet
+    def list_posts_async(self, page_size, cursor=None, tag=None, year=None):
+        """Returns a future of (summaries, next_cursor), newest first.
+           next_cursor is None on the last page. A bad cursor raises
+           datastore_errors.BadValueError or BadRequestError.
+        """
+        query = self._summaries(tag, year).order(-models.PostSummary.created)
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+        posts, next_cursor, more = yield query.fetch_page_async(
+            page_size, start_cursor=start_cursor)
+        raise ndb.Return(
+            (posts, next_cursor.urlsafe() if more and next_cursor else None))
+
+    def iter_summaries(self, year=None, offset=0, limit=None):
+        """Yields summaries oldest first"""
+        query = self._summaries(year=year).order(models.PostSummary.created)
+        start_cursor = None
+        if offset:
+            # Keys-only reads skip the first offset summaries cheaply.
+            keys, start_cursor, more = query.fetch_page(offset,
+                                                        keys_only=True)
+            if not more:
+                return
+        for summary in query.iter(start_cursor=start_cursor, limit=limit,
+                                  batch_size=500):
+            yield summary
+
+    @ndb.tasklet
+    def get_summaries_async(self, post_ids):
+        """Returns a future of the summaries of post_ids, in order,
+           skipping missing posts
+        """
+        summaries = yield ndb.get_multi_async(
+            [ndb.Key('PostSummary', str(post_id)) for post_id in post_ids])
+        raise ndb.Return([summary for summary in summaries if summary])
+
+    def get_summaries(self, post_ids):
+        return self.get_summaries_async(post_ids).get_result()
+
+    def create_post(self, subject, content, image_url, tag):
+        """Writes a new post. Returns (post, SidebarCounts or None)"""
+        # Allocating the id up front lets the post be written with one put.
+        post_id, _ = models.BlogPost.allocate_ids(1)
+
+        def txn():
+            blog_entry = models.BlogPost(id=post_id,
+                                         post_id=str(post_id),
+                                         subject=subject,
+                                         image_url=image_url,
+                                         tag=tag)
+            blog_entry.set_content(content)
+            blog_entry.put()
+            models.PostSummary.from_post(blog_entry).put()
+            year = blog_entry.created.strftime('%Y')
+            counts = models.SidebarCounts.adjust({tag: 1}, {year: 1})
+            return blog_entry, counts
+
+        # Posts and the sidebar counts live in different entity groups.
+        return ndb.transaction(txn, xg=True)
+
+    def update_post(self, post_id, subject, content, image_url, tag):
+        """Rewrites a post. Returns (post, previous, SidebarCounts or None)
+           where previous holds the old subject, content and tag.
+        """
+        def txn():
+            blog_post = models.BlogPost.get_by_id(int(post_id))
+            previous = {'subject': blog_post.subject,
+                        'content': blog_post.content,
+                        'tag': blog_post.tag}
+            blog_post.subject = subject
+            blog_post.set_content(content)
+            blog_post.tag = tag
+            blog_post.image_url = image_url
+            blog_post.put()
+            models.PostSummary.from_post(blog_post).put()
+            counts = None
+            if previous['tag'] != tag:
+                counts = models.SidebarCounts.adjust(
+                    {previous['tag']: -1, tag: 1}, {})
+            return blog_post, previous, counts
+
+        return ndb.transaction(txn, xg=True)
+
+    def iter_posts(self, batch_size=500):
+        """Yields every post in id order. They are not kept in ndb's
+           in-context cache, so any number can be streamed.
+        """
+        return models.BlogPost.query().iter(batch_size=batch_size,
+                                            use_cache=False)
+
+    def import_posts(self, posts):
+        """Writes a batch of posts and their summaries with one put_multi
+           each. Posts without a key get allocated ids; kept ids are
+           reserved so new posts never reuse them. The sidebar counts are
+           left to rebuild_counts.
+        """
+        kept = [post.key.id() for post in posts if post.key is not None]
+        if kept:
+            models.BlogPost.allocate_ids(max=max(kept))
+        new = [post for post in posts if post.key is None]
+        if new:
+            start, _ = models.BlogPost.allocate_ids(len(new))
+            for offset, post in enumerate(new):
+                post.key = ndb.Key(models.BlogPost, start + offset)
+        for post in posts:
+            post.post_id = str(post.key.id())
+        # Puts first, so the summaries copy last_modified.
+        ndb.put_multi(posts, use_cache=False)
+        ndb.put_multi([models.PostSummary.from_post(post) for post in posts],
+                      use_cache=False)
+
+    def rebuild_counts(self):
+        """Recounts the sidebar tags and years of every post"""
+        return models.SidebarCounts.rebuild()
+
+    @ndb.tasklet
+    def sidebar_counts_async(self):
+        """Returns a future of the SidebarCounts entity"""
+        counts = yield models.SidebarCounts.get_by_id_async(
+            models.SidebarCounts.entity_name)
+        if counts is None:
+            counts = models.SidebarCounts.rebuild()
+        raise ndb.Return(counts)
+
+    def get_preview(self):
+        return ndb.Key('PostPreview', 'preview').get()
+
+    def save_preview(self, subject, content, image_url, tag):
+        preview = models.PostPreview(subject=subject,
+                                     image_url=image_url,
+                                     tag=tag,
+                                     id='preview')
+        preview.set_content(content)
+        preview.put()
+
+    def get_admin(self):
+        return ndb.Key('Admin', models.Admin.entity_name).get()
+
+    def admin_by_username(self, username):
+        return models.Admin.query(
+            models.Admin.admin_username == username).get()
+
+    def save_admin(self, admin):
+        admin.put()
+
+    def add_subscribers(self, emails):
+        """Stores new sender addresses, one SubscribeEmail per address.
+           Addresses are keyed lower-cased but stored as they were sent.
+        """
+        by_key = dict((email.lower(), email) for email in emails)
+        keys = [ndb.Key('SubscribeEmail', address) for address in by_key]
+        existing = ndb.get_multi(keys)
+        ndb.put_multi([models.SubscribeEmail(key=key, email=by_key[key.id()])
+                       for key, entity in zip(keys, existing)
+                       if entity is None])
+
+    def get_image(self, image_id):
+        """Returns (content type, bytes) of a stored image, or None"""
+        image = models.PostImage.get_by_id(image_id)
+        if image:
+            return image.content_type, image.data
+
+    def save_image(self, image_id, content_type, data):
+        models.PostImage(id=image_id, content_type=content_type,
+                         data=data).put()
+
+
+def _resolved(value):
+    """Returns an ndb future that already has value"""
+    future = ndb.Future()
+    future.set_result(value)
+    return future
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _datetime(value):
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+summary_columns = ('id, subject, excerpt, created, last_modified, image_url,'
+                   ' tag, visits')
+
+
+class SqliteRepository(object):
+    """Posts and accounts stored in a SQLite database file, for running
+       outside App Engine. Each thread (and each process of a pre-forking
+       server) opens its own connection. Listings page with keyset
+       cursors over the created index.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subject TEXT NOT NULL,
+            content TEXT NOT NULL,
+            content_html TEXT,
+            description TEXT,
+            excerpt TEXT,
+            created TEXT NOT NULL,
+            last_modified TEXT NOT NULL,
+            image_url TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            author TEXT,
+            visits INTEGER NOT NULL DEFAULT 0,
+            legacy_html INTEGER NOT NULL DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS posts_created ON posts (created, id);
+        CREATE INDEX IF NOT EXISTS posts_tag ON posts (tag, created, id);
+        CREATE INDEX IF NOT EXISTS posts_visits ON posts (visits);
+        CREATE TABLE IF NOT EXISTS previews (
+            name TEXT PRIMARY KEY,
+            subject TEXT, content TEXT, content_html TEXT,
+            description TEXT, image_url TEXT, tag TEXT);
+        CREATE TABLE IF NOT EXISTS admins (
+            name TEXT PRIMARY KEY,
+            username TEXT UNIQUE,
+            pw_hash TEXT);
+        CREATE TABLE IF NOT EXISTS subscribers (
+            address TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            created TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS images (
+            id TEXT PRIMARY KEY,
+            content_type TEXT NOT NULL,
+            data BLOB NOT NULL);
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        self.sqlite3 = sqlite3
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        conn.executescript(self.schema)
+        columns = [row['name'] for row in
+                   conn.execute('PRAGMA table_info(posts)').fetchall()]
+        if 'legacy_html' not in columns:
+            conn.execute('ALTER TABLE posts ADD COLUMN legacy_html '
+                         'INTEGER NOT NULL DEFAULT 0')
+
+    def connection(self):
+        """Returns this thread's connection, opening it on first use"""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            conn = self.sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = self.sqlite3.Row
+            # Readers do not block the writer, or each other.
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn, self.local.pid = conn, pid
+        return self.local.conn
+
+    def _post(self, row):
+        return models.BlogPost(id=row['id'],
+                   post_id=str(row['id']),
+                   subject=row['subject'],
+                   content=row['content'],
+                   content_html=row['content_html'],
+                   description=row['description'],
+                   created=_date(row['created']),
+                   last_modified=_datetime(row['last_modified']),
+                   image_url=row['image_url'],
+                   tag=row['tag'],
+                   author=row['author'],
+                   visits=row['visits'],
+                   legacy_html=bool(row['legacy_html']))
+
+    def _summary(self, row):
+        return models.PostSummary(id=str(row['id']),
+                                  post_id=str(row['id']),
+                                  subject=row['subject'],
+                                  excerpt=row['excerpt'],
+                                  created=_date(row['created']),
+                                  last_modified=_datetime(
+                                      row['last_modified']),
+                                  image_url=row['image_url'],
+                                  tag=row['tag'],
+                                  visits=row['visits'])
+
+    def get_post_async(self, post_id):
+        row = self.connection().execute('SELECT * FROM posts WHERE id = ?',
+                                         (int(post_id),)).fetchone()
+        return _resolved(self._post(row) if row else None)
+
+    def _filters(self, tag=None, year=None):
+        clauses, params = [], []
+        if tag is not None:
+            clauses.append('tag = ?')
+            params.append(tag)
+        if year is not None:
+            clauses.append('created >= ? AND created < ?')
+            params.extend(['{0}-01-01'.format(int(year)),
+                           '{0}-01-01'.format(int(year) + 1)])
+        return clauses, params
+
+    def list_posts_async(self, page_size, cursor=None, tag=None, year=None):
+        """Returns a future of (summaries, next_cursor), newest first.
+           The cursor is the created date and id of the last post shown.
+           A bad cursor raises datastore_errors.BadValueError, as it does
+           with the datastore.
+        """
+        clauses, params = self._filters(tag, year)
+        if cursor:
+            try:
+                created, post_id = base64.urlsafe_b64decode(
+                    str(cursor)).split('|')
+                post_id = int(post_id)
+                _date(created)
+            except (ValueError, TypeError, binascii.Error):
+                raise datastore_errors.BadValueError('Invalid cursor')
+            clauses.append('(created < ? OR (created = ? AND id < ?))')
+            params.extend([created, created, post_id])
+        sql = 'SELECT {columns} FROM posts{where} ' \
+              'ORDER BY created DESC, id DESC LIMIT ?'.format(
+                  columns=summary_columns,
+                  where=' WHERE ' + ' AND '.join(clauses) if clauses else '')
+        rows = self.connection().execute(
+            sql, params + [page_size + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > page_size:
+            last = rows[page_size - 1]
+            next_cursor = base64.urlsafe_b64encode('{0}|{1}'.format(
+                last['created'], last['id']))
+        return _resolved(([self._summary(row) for row in rows[:page_size]],
+                          next_cursor))
+
+    def iter_summaries(self, year=None, offset=0, limit=None):
+        """Yields summaries oldest first"""
+        clauses, params = self._filters(year=year)
+        sql = 'SELECT {columns} FROM posts{where} ORDER BY created, id ' \
+              'LIMIT ? OFFSET ?'.format(
+                  columns=summary_columns,
+                  where=' WHERE ' + ' AND '.join(clauses) if clauses else '')
+        rows = self.connection().execute(
+            sql, params + [-1 if limit is None else limit, offset])
+        for row in rows:
+            yield self._summary(row)
+
+    def get_summaries_async(self, post_ids):
+        """Returns a future of the summaries of post_ids, in order,
+           skipping missing posts
+        """
+        if not post_ids:
+            return _resolved([])
+        rows = self.connection().execute(
+            'SELECT {columns} FROM posts WHERE id IN ({marks})'.format(
+                columns=summary_columns,
+                marks=', '.join('?' * len(post_ids))),
+            [int(post_id) for post_id in post_ids]).fetchall()
+        by_id = dict((row['id'], self._summary(row)) for row in rows)
+        return _resolved([by_id[int(post_id)] for post_id in post_ids
+                          if int(post_id) in by_id])
+
+    def get_summaries(self, post_ids):
+        return self.get_summaries_async(post_ids).get_result()
+
+    def _write_post(self, conn, post, replace=False):
+        """Inserts or updates a post with its summary columns. With
+           replace, a post with a key is inserted under its id, replacing
+           any post stored there.
+        """
+        excerpt = models.PostSummary.from_post(post).excerpt
+        values = (post.subject, post.content, post.content_html,
+                  post.description, excerpt, str(post.created),
+                  str(post.last_modified), post.image_url, post.tag,
+                  post.author, post.visits, bool(post.legacy_html))
+        if post.key is not None and replace:
+            conn.execute(
+                'INSERT OR REPLACE INTO posts (id, subject, content, '
+                'content_html, description, excerpt, created, '
+                'last_modified, image_url, tag, author, visits, '
+                'legacy_html) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (post.key.id(),) + values)
+        elif post.key is None:
+            cursor = conn.execute(
+                'INSERT INTO posts (subject, content, content_html, '
+                'description, excerpt, created, last_modified, image_url, '
+                'tag, author, visits, legacy_html) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+            post.key = ndb.Key(models.BlogPost, cursor.lastrowid)
+            post.post_id = str(cursor.lastrowid)
+        else:
+            conn.execute(
+                'UPDATE posts SET subject = ?, content = ?, '
+                'content_html = ?, description = ?, excerpt = ?, '
+                'created = ?, last_modified = ?, image_url = ?, tag = ?, '
+                'author = ?, visits = ?, legacy_html = ? WHERE id = ?',
+                values + (post.key.id(),))
+
+    def create_post(self, subject, content, image_url, tag):
+        """Writes a new post. Returns (post, SidebarCounts)"""
+        post = models.BlogPost(subject=subject, image_url=image_url, tag=tag)
+        post.set_content(content)
+        post.last_modified = datetime.datetime.utcnow()
+        post.created = post.last_modified.date()
+        conn = self.connection()
+        with conn:
+            self._write_post(conn, post)
+        return post, self.sidebar_counts_async().get_result()
+
+    def update_post(self, post_id, subject, content, image_url, tag):
+        """Rewrites a post. Returns (post, previous, SidebarCounts or None)
+           where previous holds the old subject, content and tag.
+        """
+        conn = self.connection()
+        with conn:
+            row = conn.execute('SELECT * FROM posts WHERE id = ?',
+                               (int(post_id),)).fetchone()
+            post = self._post(row)
+            previous = {'subject': post.subject,
+                        'content': post.content,
+                        'tag': post.tag}
+            post.subject = subject
+            post.set_content(content)
+            post.tag = tag
+            post.image_url = image_url
+            post.last_modified = datetime.datetime.utcnow()
+            self._write_post(conn, post)
+        counts = None
+        if previous['tag'] != tag:
+            counts = self.sidebar_counts_async().get_result()
+        return post, previous, counts
+
+    def iter_posts(self, batch_size=500):
+        """Yields every post in id order, batch_size rows at a time"""
+        cursor = self.connection().execute('SELECT * FROM posts ORDER BY id')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield self._post(row)
+
+    def import_posts(self, posts):
+        """Writes a batch of posts in one transaction. Posts without a
+           key are given the next ids.
+        """
+        conn = self.connection()
+        with conn:
+            for post in posts:
+                self._write_post(conn, post, replace=True)
+
+    def rebuild_counts(self):
+        """The sidebar counts are always counted from the posts table"""
+        return self.sidebar_counts_async().get_result()
+
+    def sidebar_counts_async(self):
+        """Returns a future of an unsaved SidebarCounts entity, counted
+           with the tag and created indexes
+        """
+        conn = self.connection()
+        tags = conn.execute('SELECT tag, COUNT(*) FROM posts GROUP BY tag')
+        years = conn.execute('SELECT substr(created, 1, 4), COUNT(*) '
+                             'FROM posts GROUP BY substr(created, 1, 4)')
+        return _resolved(models.SidebarCounts(
+            id=models.SidebarCounts.entity_name,
+            tag_counts=json.dumps(dict(tags.fetchall())),
+            year_counts=json.dumps(dict(years.fetchall()))))
+
+    def get_preview(self):
+        row = self.connection().execute(
+            "SELECT * FROM previews WHERE name = 'preview'").fetchone()
+        if row:
+            return models.PostPreview(id='preview',
+                                      subject=row['subject'],
+                                      content=row['content'],
+                                      content_html=row['content_html'],
+                                      description=row['description'],
+                                      image_url=row['image_url'],
+                                      tag=row['tag'])
+
+    def save_preview(self, subject, content, image_url, tag):
+        preview = models.PostPreview(subject=subject, image_url=image_url,
+                                     tag=tag)
+        preview.set_content(content)
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO previews (name, subject, content, '
+                'content_html, description, image_url, tag) '
+                "VALUES ('preview', ?, ?, ?, ?, ?, ?)",
+                (preview.subject, preview.content, preview.content_html,
+                 preview.description, preview.image_url, preview.tag))
+
+    def _admin(self, row):
+        if row:
+            return models.Admin(id=row['name'],
+                                admin_username=row['username'],
+                                admin_pw_hash=row['pw_hash'])
+
+    def get_admin(self):
+        return self._admin(self.connection().execute(
+            'SELECT * FROM admins WHERE name = ?',
+            (models.Admin.entity_name,)).fetchone())
+
+    def admin_by_username(self, username):
+        return self._admin(self.connection().execute(
+            'SELECT * FROM admins WHERE username = ?',
+            (username,)).fetchone())
+
+    def save_admin(self, admin):
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO admins (name, username, '
+                         'pw_hash) VALUES (?, ?, ?)',
+                         (admin.key.id(), admin.admin_username,
+                          admin.admin_pw_hash))
+
+    def add_subscribers(self, emails):
+        """Stores new sender addresses, one row per address"""
+        now = str(datetime.datetime.utcnow())
+        conn = self.connection()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO subscribers (address, '
+                             'email, created) VALUES (?, ?, ?)',
+                             [(email.lower(), email, now)
+                              for email in set(emails)])
+
+    def get_image(self, image_id):
+        """Returns (content type, bytes) of a stored image, or None"""
+        row = self.connection().execute(
+            'SELECT content_type, data FROM images WHERE id = ?',
+            (image_id,)).fetchone()
+        if row:
+            return row['content_type'], str(row['data'])
+
+    def save_image(self, image_id, content_type, data):
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO images (id, content_type, '
+                         'data) VALUES (?, ?, ?)',
+                         (image_id, content_type, buffer(data)))
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def repository():
+    """Returns the backend selected by config.storage_backend"""
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                if config.storage_backend == 'sqlite':
+                    _repository = SqliteRepository(config.sqlite_path)
+                else:
+                    _repository = DatastoreRepository()
+    return _repository
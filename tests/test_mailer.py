@@ -0,0 +1,121 @@
+"""Tests of the contact form mail queue, against the SDK's local task
+queue, mail and datastore stubs. Point APPENGINE_SDK at the SDK directory
+(the one containing dev_appserver.py) and run with Python 2.7:
+
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sdk_path = os.environ.get('APPENGINE_SDK')
+if sdk_path:
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+
+
+@unittest.skipUnless(sdk_path, 'APPENGINE_SDK is not set')
+class MailerTest(unittest.TestCase):
+
+    def setUp(self):
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        import config
+        import mailer
+        self.config = config
+        self.mailer = mailer
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_taskqueue_stub(root_path=repo_dir)
+        ndb.get_context().clear_cache()
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.saved_config = dict((name, getattr(config, name)) for name in
+                                 ('mail_max_retries', 'mail_batch_size'))
+        self.saved_send = mailer.send
+
+    def tearDown(self):
+        for name, value in self.saved_config.iteritems():
+            setattr(self.config, name, value)
+        self.mailer.send = self.saved_send
+        self.testbed.deactivate()
+
+    def queued(self):
+        return self.taskqueue_stub.get_filtered_tasks(
+            queue_names=self.mailer.queue_name)
+
+    def fail_sending(self):
+        from google.appengine.api import mail
+
+        def send(message):
+            raise mail.Error('unavailable')
+        self.mailer.send = send
+
+    def test_queue_message_adds_message_and_one_worker_task(self):
+        self.mailer.queue_message('Reader@Example.com', 'Hi', 'Hello')
+        self.mailer.queue_message('other@example.com', 'Re', 'Again')
+        self.assertEqual(len(self.queued()), 2)
+        workers = self.taskqueue_stub.get_filtered_tasks(
+            url=self.mailer.worker_url)
+        self.assertEqual(len(workers), 1)
+        self.assertEqual(self.mail_stub.get_sent_messages(), [])
+
+    def test_send_queued_sends_and_records_senders(self):
+        import models
+        self.mailer.queue_message('Reader@Example.com', 'Hi', 'Hello')
+        self.mailer.queue_message('Reader@Example.com', 'Re', 'Again')
+        self.assertEqual(self.mailer.send_queued(), 2)
+        messages = self.mail_stub.get_sent_messages()
+        self.assertEqual(sorted(m.subject for m in messages), ['Hi', 'Re'])
+        self.assertEqual(messages[0].to, self.config.email_to)
+        self.assertEqual(self.queued(), [])
+        # One subscriber per address, keyed lower-cased, stored as sent.
+        subscribers = models.SubscribeEmail.query().fetch()
+        self.assertEqual([(s.key.id(), s.email) for s in subscribers],
+                         [('reader@example.com', 'Reader@Example.com')])
+
+    def test_send_queued_keeps_failed_message_for_retry(self):
+        from google.appengine.api import taskqueue
+        self.fail_sending()
+        self.mailer.queue_message('reader@example.com', 'Hi', 'Hello')
+        self.assertEqual(self.mailer.send_queued(), 0)
+        self.assertEqual(len(self.queued()), 1)
+        # The lease was extended by the backoff, so it is not retried yet.
+        queue = taskqueue.Queue(self.mailer.queue_name)
+        self.assertEqual(queue.lease_tasks(60, 10), [])
+
+    def test_send_queued_drops_message_after_max_retries(self):
+        self.config.mail_max_retries = 0
+        self.fail_sending()
+        self.mailer.queue_message('reader@example.com', 'Hi', 'Hello')
+        self.assertEqual(self.mailer.send_queued(), 0)
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(self.mail_stub.get_sent_messages(), [])
+
+    def test_send_queued_reads_every_batch(self):
+        self.config.mail_batch_size = 2
+        for n in xrange(5):
+            self.mailer.queue_message('reader{n}@example.com'.format(n=n),
+                                      'Hi', 'Hello')
+        self.assertEqual(self.mailer.send_queued(), 5)
+        self.assertEqual(len(self.mail_stub.get_sent_messages()), 5)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        base = self.config.mail_retry_base_seconds
+        self.assertEqual(self.mailer.backoff_seconds(0), base)
+        self.assertEqual(self.mailer.backoff_seconds(1), base * 2)
+        self.assertEqual(self.mailer.backoff_seconds(3), base * 8)
+        self.assertEqual(self.mailer.backoff_seconds(100),
+                         self.config.mail_retry_max_seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
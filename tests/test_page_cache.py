@@ -0,0 +1,83 @@
+"""Tests that warm reader pages are served without datastore RPCs,
+against the SDK's local stubs. Point APPENGINE_SDK at the SDK directory
+(the one containing dev_appserver.py) and run with Python 2.7:
+
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests
+"""
+import datetime
+import os
+import sys
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sdk_path = os.environ.get('APPENGINE_SDK')
+if sdk_path:
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+
+
+@unittest.skipUnless(sdk_path, 'APPENGINE_SDK is not set')
+class WarmPageTest(unittest.TestCase):
+
+    def setUp(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        import util
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='blog')
+        # Strongly consistent, so listings see the posts just written.
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_taskqueue_stub(root_path=repo_dir)
+        ndb.get_context().clear_cache()
+        util.local_cache.clear()
+        self.util = util
+        self.permalink = None
+        for n in xrange(3):
+            self.permalink = util.post_new(
+                'Post {n}'.format(n=n), 'Some *Markdown* content.',
+                'http://example.com/{n}.png'.format(n=n), 'news')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def datastore_rpcs(self, path):
+        """Requests path anonymously. Returns its datastore RPC count."""
+        import webapp2
+        import instrumentation
+        import main
+        response = webapp2.Request.blank(path).get_response(main.app)
+        self.assertEqual(response.status_int, 200, path)
+        return instrumentation.last_record()['datastore_rpcs']
+
+    def assert_warm_without_datastore(self, path):
+        self.datastore_rpcs(path)
+        self.assertEqual(self.datastore_rpcs(path), 0, path)
+        # A new instance has only memcache.
+        self.util.local_cache.clear()
+        self.assertEqual(self.datastore_rpcs(path), 0, path)
+
+    def test_permalink(self):
+        self.assert_warm_without_datastore(self.permalink)
+
+    def test_main_listing(self):
+        self.assert_warm_without_datastore('/')
+
+    def test_tag_listing(self):
+        self.assert_warm_without_datastore('/tags/news')
+
+    def test_archive_listing(self):
+        self.assert_warm_without_datastore(
+            '/archive/{y}'.format(y=datetime.date.today().year))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,82 @@
 import os
 import re
+import time
+import datetime
 import hashlib
-import hmac
+import math
 import random
 import logging
+import threading
+import cPickle as pickle
 from string import letters
 from collections import Counter
 
 import jinja2
 from google.appengine.api import memcache
-from google.appengine.ext import db
-from google.appengine.api import mail
+from google.appengine.ext import ndb
+from google.appengine.datastore import entity_pb
 
+import assets
 import config
+import counters
+import instrumentation
+import localcache
 import models
+import storage
+
+# mailer, search and hmac are imported where they are used. They serve
+# the contact form, post writes and admin logins, so new instances start
+# without loading them.
 
 
 #Template variables
 
+template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+
+# One environment per instance. Compiled templates are kept in the
+# environment's in-process cache and their bytecode is shared through
+# memcache, so a fresh instance skips the parse/compile step as well.
+jinja_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(template_dir),
+    autoescape=False,
+    auto_reload=config.template_auto_reload,
+    cache_size=config.template_cache_size,
+    bytecode_cache=jinja2.MemcachedBytecodeCache(memcache,
+                                                 prefix='jinja2/bytecode/'))
+jinja_env.globals['asset_urls'] = assets.asset_urls
+
+uploaded_image_re = re.compile(r'^/img/(\w+)/\w+$')
+
+
+def image_src(image_url, size):
+    """Returns the URL of the size variant of an uploaded post image.
+       Other image URLs are returned as they are.
+    """
+    match = uploaded_image_re.match(image_url or '')
+    if match:
+        return '/img/{id}/{size}'.format(id=match.group(1), size=size)
+    return image_url
+
+jinja_env.globals['image_src'] = image_src
+
+
+def compile_templates():
+    """Loads every template into the environment's cache, compiling it or
+       taking its bytecode from memcache. Returns the template names.
+    """
+    names = jinja_env.list_templates()
+    for name in names:
+        jinja_env.get_template(name)
+    return names
+
 
 def generate_template(template_name, **kwargs):
     """Template generation helper function"""
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    j_loader = jinja2.Environment(loader=jinja2.FileSystemLoader(path),
-                                  autoescape=False)
-    template = j_loader.get_template(template_name)
-    return template.render(**kwargs)
+    start = time.time()
+    template = jinja_env.get_template(template_name)
+    html = template.render(**kwargs)
+    instrumentation.record_template((time.time() - start) * 1000.0)
+    return html
 
 
 #Hasning functions - cookies
@@ -40,6 +91,7 @@ def random_letters():
 
 def hash_str(s):
     """Hashing of cookies for Admin login."""
+    import hmac
     return hmac.new(config.cookie_secret, s).hexdigest()
 
 
@@ -77,103 +129,447 @@ def valid_pw(username, password, h):
 
 # Memcache Functions
 
+# Memcache values are limited to 1MB. Larger lists are split into chunks.
+memcache_chunk_size = 950 * 1000
+
+# Per-instance cache counters, keyed by (cache name, outcome). Outcomes
+# are 'local' (in-process hit), 'hit' (memcache hit) and 'miss', plus
+# the stampede protection outcomes below.
+cache_stats = Counter()
+
+# The in-process tier, for values stored under versioned keys.
+local_cache = localcache.LRUCache(config.local_cache_bytes,
+                                  config.local_cache_seconds)
+
+entity_adapter = ndb.ModelAdapter()
+
+
+def encode_entities(entities):
+    """Serializes a list of entities as their encoded protocol buffers"""
+    return pickle.dumps([entity_adapter.entity_to_pb(e).Encode()
+                         for e in entities], pickle.HIGHEST_PROTOCOL)
+
+
+def decode_entities(data):
+    """Inverse of encode_entities"""
+    return [entity_adapter.pb_to_entity(entity_pb.EntityProto(pb))
+            for pb in pickle.loads(data)]
+
+
+@ndb.tasklet
+def cache_get_data_async(key, local=False):
+    """Returns a cached string, or None on a miss. Small values take a
+       single memcache get. With local, the in-process tier is tried
+       first and filled from memcache; only use it for versioned keys.
+    """
+    if local:
+        data = local_cache.get(key)
+        if data is not None:
+            cache_stats[(key.split('|')[0], 'local')] += 1
+            raise ndb.Return(data)
+    ctx = ndb.get_context()
+    header = yield ctx.memcache_get(key)
+    data = None
+    if header and header[0] == 'data':
+        data = header[1]
+    elif header and header[0] == 'chunks':
+        chunk_keys = ['{key}|{token}|{n}'.format(key=key, token=header[2], n=n)
+                      for n in xrange(header[1])]
+        chunks = yield [ctx.memcache_get(k) for k in chunk_keys]
+        if None not in chunks:
+            data = ''.join(chunks)
+    cache_stats[(key.split('|')[0], 'miss' if data is None else 'hit')] += 1
+    if local and data is not None:
+        local_cache.set(key, data)
+    raise ndb.Return(data)
+
+
+def cache_get_data(key, local=False):
+    return cache_get_data_async(key, local).get_result()
+
+
+@ndb.tasklet
+def cache_set_data_async(key, data, seconds=0, local=False):
+    """Caches a string, splitting it into chunks when it does not fit into
+       one memcache value. It expires after seconds, if given. With
+       local, it is kept in the in-process tier as well.
+    """
+    if local:
+        local_cache.set(key, data)
+    ctx = ndb.get_context()
+    if len(data) <= memcache_chunk_size:
+        yield ctx.memcache_set(key, ('data', data), time=seconds)
+        return
+    token = '%x' % random.getrandbits(32)
+    chunks = []
+    for n, start in enumerate(xrange(0, len(data), memcache_chunk_size)):
+        chunk_key = '{key}|{token}|{n}'.format(key=key, token=token, n=n)
+        chunks.append(ctx.memcache_set(
+            chunk_key, data[start:start + memcache_chunk_size], time=seconds))
+    # Chunks first, so a reader never finds a header without its chunks.
+    yield chunks
+    yield ctx.memcache_set(key, ('chunks', len(chunks), token), time=seconds)
+
+
+def cache_set_data(key, data, local=False):
+    cache_set_data_async(key, data, local=local).get_result()
+
+
+def encode_page(entities, next_cursor=None):
+    """Serializes a fetched list of entities and the cursor of the next
+       page
+    """
+    return pickle.dumps((encode_entities(entities), next_cursor),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+def decode_page(data):
+    """Inverse of encode_page. Returns (entities, next_cursor)."""
+    entities, next_cursor = pickle.loads(data)
+    return decode_entities(entities), next_cursor
+
+
+@ndb.tasklet
+def cache_get_entities_async(key):
+    """Returns a cached (entities, next_cursor) tuple, or None on a miss.
+       A hit makes no datastore RPCs.
+    """
+    data = yield cache_get_data_async(key)
+    if data is not None:
+        raise ndb.Return(decode_page(data))
+
+
+def cache_set_entities_async(key, entities, next_cursor=None):
+    """Caches a fetched list of entities and the cursor of the next page"""
+    return cache_set_data_async(key, encode_page(entities, next_cursor))
+
+
+# Stampede protection. When a popular key is missing, only the request
+# that wins its lease (a memcache add) recomputes it. The others serve
+# the last value computed under any version of the key, or wait for the
+# winner. Values are also refreshed early, at random, before they expire,
+# so a popular key is usually recomputed while it can still be served.
+_local = threading.local()
+
+
+def stale_reads():
+    """Number of stale values served on this thread. A page rendered from
+       a stale value must not be stored under the current versions.
+    """
+    return getattr(_local, 'stale_reads', 0)
+
+
+def refresh_early(expires, delta, now=None):
+    """Decides whether to recompute a value before it expires. delta is
+       the time it took to compute; slow values are refreshed earlier.
+    """
+    now = now or time.time()
+    jitter = -math.log(1.0 - random.random())
+    return now + delta * config.cache_early_refresh_beta * jitter >= expires
+
 
-def main_page_posts(update=False):
-    """Caching for top 10 posts shown in the Blog Main Page"""
-    key = 'main_page_posts'
-    posts = memcache.get(key)
-    if posts is None or update:
-        logging.error('DB Query: Main Page')
-        posts = db.GqlQuery("""SELECT *
-                            FROM BlogPost
-                            ORDER BY created
-                            DESC
-                            LIMIT 10
-                            """)
-        memcache.set(key, posts)
-    return posts
-
-
-def tag_cache(tag_name, update=False):
-    """Stores cache for all tags to be displayed on every Blog Page"""
-    key = 'tag_{tag}'.format(tag=tag_name)
-    tag = memcache.get(key)
-    if tag is None or update:
-        logging.error('DB Query: Tag')
-        tag = db.GqlQuery(""" SELECT * FROM BlogPost
-                              WHERE tag = :1""", tag_name)
-        memcache.set(key, tag)
-    return tag
-
-
-def archive_cache(archive_year, update=False):
-    """Stores cache for all archive years to be displayed on every Blog page"""
-    next_year = str(int(archive_year) + 1)
-    first_year = '{year}-1-1'.format(year=archive_year)
-    second_year = '{year}-1-1'.format(year=next_year)
-
-    key = 'archive_{year}'.format(year=archive_year)
-    year = memcache.get(key)
-    if year is None or update:
-        logging.error('DB Query: Archive')
-        year = db.GqlQuery("""SELECT * FROM BlogPost
-                                WHERE created >= DATE(:first)
-                                AND created < DATE(:second)
-                           """, first=first_year, second=second_year)
-        memcache.set(key, year)
-    return year
-
-
-def visits_cache(update=False):
-    """Stores cache of the Number of visits to be displayed in Admin pref."""
-    key = 'visits_cache'
-    posts = memcache.get(key)
-    if posts is None or update:
-        logging.error('DB Query: Visits Sorting DESC')
-        posts = db.GqlQuery("""SELECT *
-                            FROM BlogPost
-                            ORDER BY visits DESC
-                            """)
-        memcache.set(key, posts)
-    return posts
+@ndb.tasklet
+def cache_coalesced_async(key, stale_key, compute, seconds, update=False):
+    """Returns the string cached at key, calling the tasklet compute() for
+       it when it is missing or due for an early refresh. The value lives
+       for seconds; stale_key keeps the last value without expiry. With
+       update, recomputes unconditionally.
+    """
+    ctx = ndb.get_context()
+    name = key.split('|')[0]
+    lease_key = 'lease|' + key
+    leased = False
+    if not update:
+        entry = yield cache_get_data_async(key, local=True)
+        if entry is not None:
+            expires, delta, data = pickle.loads(entry)
+            if not refresh_early(expires, delta):
+                raise ndb.Return(data)
+        leased = yield ctx.memcache_add(lease_key, 1,
+                                        time=config.cache_lease_seconds)
+        if not leased:
+            cache_stats[(name, 'coalesced')] += 1
+            if entry is not None:
+                # Still valid; the lease holder is refreshing it.
+                raise ndb.Return(data)
+            data = yield cache_get_data_async(stale_key)
+            if data is not None:
+                cache_stats[(name, 'stale')] += 1
+                _local.stale_reads = stale_reads() + 1
+                raise ndb.Return(data)
+            deadline = time.time() + config.cache_lease_wait_seconds
+            while time.time() < deadline:
+                yield ndb.sleep(config.cache_lease_poll_seconds)
+                entry = yield cache_get_data_async(key, local=True)
+                if entry is not None:
+                    raise ndb.Return(pickle.loads(entry)[2])
+            # The lease holder is slow or failed, so compute it here too.
+        elif entry is not None:
+            cache_stats[(name, 'early')] += 1
+    start = time.time()
+    try:
+        data = yield compute()
+    except Exception:
+        if leased:
+            ctx.memcache_delete(lease_key)
+        raise
+    entry = pickle.dumps((time.time() + seconds, time.time() - start, data),
+                         pickle.HIGHEST_PROTOCOL)
+    yield (cache_set_data_async(key, entry, seconds, local=True),
+           cache_set_data_async(stale_key, data))
+    if leased:
+        yield ctx.memcache_delete(lease_key)
+    raise ndb.Return(data)
+
+
+# Cache invalidation. Cached values are keyed by the version numbers of
+# the scopes they depend on: 'global' (everything), 'posts' (any post),
+# 'sidebar' (tag/year counts), 'tag:<tag>', 'year:<year>' and
+# 'post:<post_id>'. Bumping a scope's version makes every dependent key
+# unreachable without enumerating or deleting anything.
+#
+# A version that memcache evicted restarts from the clock in microseconds
+# and a bump adds 1, so it can only repeat a value used before if the
+# scope was bumped more than once a microsecond on average since it was
+# seeded, or an instance's clock is behind by more than that margin.
+versions_namespace = 'versions'
+
+
+def initial_version():
+    """The version of a scope that is not in memcache"""
+    return int(time.time() * 1000000)
+
+
+@ndb.tasklet
+def cache_versions_async(scopes):
+    """Returns {scope: version} for scopes in one memcache round trip"""
+    ctx = ndb.get_context()
+    values = yield [ctx.memcache_get(scope, namespace=versions_namespace)
+                    for scope in scopes]
+    versions = dict(zip(scopes, values))
+    missing = [scope for scope in scopes if versions[scope] is None]
+    if missing:
+        initial = initial_version()
+        yield [ctx.memcache_add(scope, initial, namespace=versions_namespace)
+               for scope in missing]
+        values = yield [ctx.memcache_get(scope, namespace=versions_namespace)
+                        for scope in missing]
+        versions.update(zip(missing, values))
+    raise ndb.Return(versions)
+
+
+def bump_cache_versions(*scopes):
+    """Invalidates every cache entry that depends on any of scopes"""
+    memcache.offset_multi(dict((scope, 1) for scope in scopes),
+                          namespace=versions_namespace,
+                          initial_value=initial_version())
+
+
+@ndb.tasklet
+def versioned_key_async(name, scopes):
+    """Builds a cache key for name that depends on scopes and 'global'"""
+    scopes = ['global'] + list(scopes)
+    versions = yield cache_versions_async(scopes)
+    raise ndb.Return('{name}|{versions}'.format(name=name, versions=','.join(
+        '{0}={1}'.format(scope, versions.get(scope)) for scope in scopes)))
+
+
+def post_scopes(post_id, tag, year):
+    """Scopes invalidated by writing a post"""
+    return ['posts', 'post:' + post_id, 'tag:' + tag, 'year:' + year]
+
+
+def page_cache_key(path, scopes):
+    """Returns the page cache key of path, for a page depending on scopes.
+       Pages embed the asset bundle URLs, so the key includes the build.
+    """
+    return versioned_key_async('page|{assets}|{path}'.format(
+        assets=assets.version, path=path), scopes).get_result()
+
+
+def page_cache_get(key):
+    """Returns the cached page, or None on a miss"""
+    data = cache_get_data(key, local=True)
+    if data is not None:
+        return pickle.loads(data)
+
+
+def page_cache_set(key, body, last_modified=None):
+    """Caches a rendered page with its strong ETag and returns it. Its
+       Last-Modified is last_modified, or the time it was stored.
+    """
+    page = {'body': body,
+            'etag': '"{0}"'.format(hashlib.sha1(body).hexdigest()),
+            'last_modified': last_modified or datetime.datetime.utcnow()}
+    cache_set_data(key, pickle.dumps(page, pickle.HIGHEST_PROTOCOL),
+                   local=True)
+    return page
+
+
+def latest_modified(posts):
+    """Returns the latest last_modified of posts, or None"""
+    return max([post.last_modified for post in posts] or [None])
+
+
+@ndb.tasklet
+def listing_cache_async(key, scope, fetch, cursor, update):
+    """Caches one page of a post listing. fetch(cursor) returns a future
+       of (posts, next_cursor) from the storage backend. Pages are keyed
+       by the version of scope, since a new post shifts every cursor
+       after it, and are recomputed by one request at a time. Returns
+       (posts, next_cursor); next_cursor is None on the last page. A bad
+       cursor raises datastore_errors.BadValueError or BadRequestError.
+    """
+    name = '{key}|{cursor}'.format(key=key, cursor=cursor or '')
+    versioned = yield versioned_key_async(name, [scope])
+
+    @ndb.tasklet
+    def compute():
+        logging.debug('DB Query: {key}'.format(key=versioned))
+        posts, next_cursor = yield fetch(cursor)
+        raise ndb.Return(encode_page(posts, next_cursor))
+
+    data = yield cache_coalesced_async(versioned, 'stale|' + name, compute,
+                                       config.listing_cache_seconds, update)
+    raise ndb.Return(decode_page(data))
+
+
+def main_page_posts_async(cursor=None, update=False):
+    """Caching for the pages of posts shown in the Blog Main Page.
+       Returns a future of (posts, next_cursor).
+    """
+    def fetch(cursor):
+        return storage.repository().list_posts_async(config.posts_per_page,
+                                                     cursor)
+    return listing_cache_async('main_page_posts', 'posts', fetch, cursor,
+                               update)
+
+
+def main_page_posts(cursor=None, update=False):
+    return main_page_posts_async(cursor, update).get_result()
+
+
+def tag_cache_async(tag_name, cursor=None, update=False):
+    """Caching for the pages of posts with a tag.
+       Returns a future of (posts, next_cursor).
+    """
+    def fetch(cursor):
+        return storage.repository().list_posts_async(
+            config.tag_posts_per_page, cursor, tag=tag_name)
+    return listing_cache_async('tag_{tag}'.format(tag=tag_name),
+                               'tag:' + tag_name, fetch, cursor, update)
+
+
+def tag_cache(tag_name, cursor=None, update=False):
+    return tag_cache_async(tag_name, cursor, update).get_result()
+
+
+def archive_cache_async(archive_year, cursor=None, update=False):
+    """Caching for the pages of posts created in an archive year.
+       Returns a future of (posts, next_cursor).
+    """
+    def fetch(cursor):
+        return storage.repository().list_posts_async(
+            config.archive_posts_per_page, cursor, year=archive_year)
+    return listing_cache_async('archive_{year}'.format(year=archive_year),
+                               'year:' + archive_year, fetch, cursor, update)
+
+
+def archive_cache(archive_year, cursor=None, update=False):
+    return archive_cache_async(archive_year, cursor, update).get_result()
+
+
+def visits_leaderboard(page=1):
+    """Returns ((summary, visits) tuples of one page of the most visited
+       posts, whether the leaderboard has more pages)
+    """
+    ranked = counters.leaderboard()
+    start = (page - 1) * config.history_page_size
+    shown = ranked[start:start + config.history_page_size]
+    summaries = dict((summary.post_id, summary) for summary in
+                     storage.repository().get_summaries(
+                         [post_id for post_id, _ in shown]))
+    return ([(summaries[post_id], visits) for post_id, visits in shown
+             if post_id in summaries],
+            start + config.history_page_size < len(ranked))
+
+
+@ndb.tasklet
+def visits_by_date_async(cursor=None):
+    """Returns a future of ((summary, visits) tuples of a page of every
+       post, newest first, next_cursor), for the posts below the
+       leaderboard
+    """
+    summaries, next_cursor = yield storage.repository().list_posts_async(
+        config.history_page_size, cursor)
+    visits = counters.post_visits([summary.post_id
+                                   for summary in summaries])
+    raise ndb.Return(([(summary, visits.get(summary.post_id, 0))
+                       for summary in summaries], next_cursor))
 
 #Misc. Functions
 
 
+@ndb.tasklet
+def sidebar_counts_async(counts=None):
+    """Caches the tag and archive year counts shown on every Blog page.
+       Passing the SidebarCounts returned by a post write refreshes the
+       cache without reading them again; bump the 'sidebar' scope first.
+    """
+    key = yield versioned_key_async('sidebar_counts', ['sidebar'])
+    if counts is None:
+        data = yield cache_get_data_async(key, local=True)
+        if data is not None:
+            raise ndb.Return(pickle.loads(data))
+        logging.debug('DB Query: Sidebar Counts')
+        counts = yield storage.repository().sidebar_counts_async()
+    sidebar = {'tags': counts.tags(), 'archive': counts.years()}
+    yield cache_set_data_async(
+        key, pickle.dumps(sidebar, pickle.HIGHEST_PROTOCOL), local=True)
+    raise ndb.Return(sidebar)
+
+
+def sidebar_counts(counts=None):
+    return sidebar_counts_async(counts).get_result()
+
+
+@ndb.tasklet
+def related_posts_async(post_id):
+    """Returns a future of the summaries of the posts related to post_id
+       (see related.py), cached in the post's scope
+    """
+    key = yield versioned_key_async('related|' + post_id, ['post:' + post_id])
+    data = yield cache_get_data_async(key, local=True)
+    if data is not None:
+        raise ndb.Return(decode_page(data)[0])
+    related = yield models.RelatedPosts.get_by_id_async(post_id)
+    summaries = []
+    if related is not None:
+        summaries = yield storage.repository().get_summaries_async(
+            related.post_ids)
+    yield cache_set_data_async(key, encode_page(summaries), local=True)
+    raise ndb.Return(summaries)
+
+
 def generate_tag_list():
-    """Queries db for a unique list of tags sorted alphabetically"""
-    tag_entries = db.GqlQuery("SELECT tag FROM BlogPost")
-    tags_all = [str(item.tag) for item in tag_entries]  # excecute query
-    c = Counter(tags_all)    # provides dict with count of each tag
-    return sorted(c.iteritems())  # returns list w/ tuples in alpha. order
+    """Returns a unique list of (tag, count) sorted alphabetically"""
+    return sidebar_counts()['tags']
 
 
 def generate_archive_list():
-    """Queries db for a unique list of archive years sorted desc"""
-    archive = db.GqlQuery("""   SELECT *
-                                FROM BlogPost
-                                WHERE created>DATE('2009-1-1')
-                          """)
-    # excecute query
-    archive_years = [str(item.created.strftime('%Y')) for item in archive]
-    c = Counter(archive_years)    # provides dict with count of each year
-    return sorted(c.iteritems())  # returns list w/ ordered tuples
+    """Returns a unique list of (archive year, count) in order"""
+    return sidebar_counts()['archive']
 
 
 #Contact for functions
 
 
 def send_mail(email, email_subject, email_message):
-    """Send mail function"""
+    """Validates a contact form message and queues it for sending"""
+    import mailer
     match = re.match(r'\w+\.?\w+@\w+\.\w{2,3}', email)
     if match:
-        message = mail.EmailMessage(sender=config.email_from,
-                                    subject=email_subject)
-        message.to = config.email_to
-        message.html = email_message + '<br /><br /> The sender is ' + email
-        message.send()
-        e = models.SubscribeEmail(email=email)
-        e.put()
+        mailer.queue_message(email, email_subject, email_message)
         return 'Thank you for contacting us.'
     else:
         return 'You have input an invalid entry. Please retry.'
@@ -212,11 +608,13 @@ def post_helper(subject, content, tag, image_url, preview, update=None):
         return post_new(subject, content, tag, image_url)
 
 
-def blog_post_param(request):
+def blog_post_param(request, image_url=None):
+    """Returns the submitted post fields, or None if one is missing.
+       image_url, the URL of an uploaded image, replaces the typed one.
+    """
     subject = request.get('subject')
     content = request.get('content')
-    content = content.replace('\n', '<br>').replace('\"', '\'')
-    image_url = request.get('image_url')
+    image_url = image_url or request.get('image_url')
     tag = request.get('tag')
     if subject and content and image_url and tag:
         return {'subject': subject,
@@ -226,15 +624,8 @@ def blog_post_param(request):
 
 
 def post_preview(subject, content, image_url, tag):
-    """Creates a Preview Entity of the kind PostPreview
-       and stores in into the db.
-    """
-    preview = models.PostPreview(subject=subject,
-                                          content=content,
-                                          image_url=image_url,
-                                          tag=tag,
-                                          key_name='preview')
-    preview.put()
+    """Stores the post being previewed"""
+    storage.repository().save_preview(subject, content, image_url, tag)
     return '/newpost/preview'
 
 
@@ -242,12 +633,21 @@ def post_update(subject, content, image_url, tag, update):
     """Helper function to fetch an existing post and
        modifies it's contents.
     """
-    blog_post = models.BlogPost.get_by_id(update)
-    blog_post.subject = subject
-    blog_post.content = content
-    blog_post.tag = tag
-    blog_post.image_url = image_url
-    blog_post.put()
+    import related
+    import search
+    blog_post, previous, counts = storage.repository().update_post(
+        update, subject, content, image_url, tag)
+    year = blog_post.created.strftime('%Y')
+    scopes = post_scopes(blog_post.post_id, tag, year)
+    if counts:
+        scopes += ['tag:' + previous['tag'], 'sidebar']
+    old_terms = search.post_terms(previous['subject'], previous['content'])
+    new_terms = search.post_terms(subject, content)
+    search.update_post(update, old_terms, new_terms)
+    shown = related.refresh_post(blog_post, new_terms)
+    bump_cache_versions(*(scopes + ['post:' + other for other in shown]))
+    if counts:
+        sidebar_counts(counts)
     return '/{post_id}'.format(post_id=update)
 
 
@@ -255,19 +655,108 @@ def post_new(subject, content, image_url, tag):
     """Helper function that creates a new Entity for
        a new blog post.
     """
-    blog_entry = models.BlogPost(subject=subject,
-                                      content=content,
-                                      image_url=image_url,
-                                      tag=tag)
-    blog_entry.put()
-    post_id = str(blog_entry.key().id())
-    blog_entry.post_id = post_id
-    blog_entry.put()
-
-    #rerun query and update the cache.
-    main_page_posts(True)
-    tag_cache(tag, True)
-    archive_year = blog_entry.created.strftime('%Y')
-    archive_cache(archive_year, True)
-    visits_cache(True)
+    import related
+    import search
+    blog_entry, counts = storage.repository().create_post(
+        subject, content, image_url, tag)
+    post_id = blog_entry.post_id
+    terms = search.post_terms(subject, content)
+    search.update_post(post_id, Counter(), terms)
+    shown = related.refresh_post(blog_entry, terms)
+    year = blog_entry.created.strftime('%Y')
+    bump_cache_versions('sidebar', *(post_scopes(post_id, tag, year) +
+                                     ['post:' + other for other in shown]))
+    if counts:
+        sidebar_counts(counts)
     return '/{post_id}'.format(post_id=post_id)
+
+
+def rebuild_post_summaries(batch_size=100):
+    """Writes a PostSummary for every BlogPost. Used once for posts that
+       were created before summaries existed. Posts written before
+       Markdown have HTML content, which is kept as their rendered body;
+       they are flagged legacy_html so editing them keeps it HTML.
+       Returns the number written.
+    """
+    written = 0
+    query = models.BlogPost.query()
+    posts, cursor, more = query.fetch_page(batch_size)
+    while posts:
+        legacy = [post for post in posts if post.content_html is None]
+        for post in legacy:
+            post.set_content(post.content)
+        ndb.put_multi(legacy +
+                      [models.PostSummary.from_post(post) for post in posts])
+        written += len(posts)
+        if not more:
+            break
+        posts, cursor, more = query.fetch_page(batch_size,
+                                               start_cursor=cursor)
+    bump_cache_versions('global')
+    return written
+
+
+def _signed_up_before(subscriber, other):
+    """Whether subscriber signed up before other. Unknown dates count as
+       the latest.
+    """
+    if subscriber.created is None:
+        return False
+    return other.created is None or subscriber.created < other.created
+
+
+def migrate_to_ndb(batch_size=100):
+    """One-shot migration of entities written by the old db models.
+       Re-puts every post through ndb (filling in missing post ids),
+       rekeys subscribers by their lower-cased address (keeping the
+       earliest signup of each), and rebuilds the summaries,
+       sidebar counts and search index. Safe to run more than once.
+       Returns a Counter of the entities written per kind.
+    """
+    import search
+    written = Counter()
+    query = models.BlogPost.query()
+    posts, cursor, more = query.fetch_page(batch_size)
+    while posts:
+        for post in posts:
+            post.post_id = post.post_id or str(post.key.id())
+        ndb.put_multi(posts)
+        written['BlogPost'] += len(posts)
+        if not more:
+            break
+        posts, cursor, more = query.fetch_page(batch_size,
+                                               start_cursor=cursor)
+
+    # db subscribers were keyed by numeric ids. Addresses differing only
+    # in case become one subscriber: the earliest signup, keeping its
+    # address and created date.
+    old_keys = [key for key in models.SubscribeEmail.query().iter(
+                keys_only=True) if key.integer_id()]
+    for start in xrange(0, len(old_keys), batch_size):
+        batch = [old for old in ndb.get_multi(
+            old_keys[start:start + batch_size]) if old]
+        earliest = {}
+        for old in batch:
+            if old.email:
+                address = old.email.lower()
+                if (address not in earliest or
+                        _signed_up_before(old, earliest[address])):
+                    earliest[address] = old
+        addresses = earliest.keys()
+        existing = ndb.get_multi([ndb.Key('SubscribeEmail', address)
+                                  for address in addresses])
+        ndb.put_multi([models.SubscribeEmail(id=address,
+                                             email=earliest[address].email,
+                                             created=earliest[address].created)
+                       for address, current in zip(addresses, existing)
+                       if current is None or
+                       _signed_up_before(earliest[address], current)])
+        ndb.delete_multi([old.key for old in batch])
+        written['SubscribeEmail'] += len(batch)
+
+    written['PostSummary'] = rebuild_post_summaries(batch_size)
+    counts = models.SidebarCounts.rebuild()
+    search.rebuild_index(batch_size)
+    bump_cache_versions('global', 'sidebar')
+    sidebar_counts(counts)
+    return written
@@ -0,0 +1,69 @@
+"""WSGI entry point for running the blog under a plain WSGI server, with
+config.storage_backend = 'sqlite':
+
+    APPENGINE_SDK=~/google_appengine APPENGINE_API_HOST=localhost:8010 \\
+        gunicorn --workers 4 wsgi:application
+
+Posts, accounts and images are in the SQLite file. The blog still uses
+the App Engine SDK for its models and for memcache, the search index,
+related posts, visit counters, the mail queue and the task queue. Those
+API calls go to the API server of a dev_appserver named by
+APPENGINE_API_HOST (dev_appserver.py --api_port 8010 .), which every
+worker process shares. Without it each process gets its own in-memory
+stubs: caches are then not invalidated across processes, so only run one
+worker process that way.
+"""
+import logging
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def setup_sdk():
+    """Puts the App Engine SDK on sys.path"""
+    sdk_path = os.environ.get('APPENGINE_SDK')
+    if not sdk_path:
+        sys.exit('Set APPENGINE_SDK to the SDK directory.')
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if root_dir not in sys.path:
+        sys.path.insert(0, root_dir)
+
+
+def connect():
+    """Sends the App Engine API calls to the shared API server, or to stubs
+       in this process
+    """
+    app_id = os.environ.get('APPLICATION_ID', 'blog')
+    api_host = os.environ.get('APPENGINE_API_HOST')
+    if api_host:
+        from google.appengine.ext.remote_api import remote_api_stub
+        # The dev API server takes datastore calls as they are, like the
+        # RPCs of the apps dev_appserver runs itself.
+        remote_api_stub.ConfigureRemoteApi(app_id, '/', lambda: ('', ''),
+                                           api_host,
+                                           use_remote_datastore=False)
+        os.environ.setdefault('SERVER_SOFTWARE', 'Development/wsgi')
+        os.environ.setdefault('CURRENT_VERSION_ID', '1.1')
+        os.environ.setdefault('DEFAULT_VERSION_HOSTNAME', api_host)
+        return
+    logging.warning('APPENGINE_API_HOST is not set: memcache and the '
+                    'datastore are local to this process.')
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_mail_stub()
+    bed.init_taskqueue_stub(root_path=root_dir)
+
+
+setup_sdk()
+connect()
+
+import main  # after setup_sdk, which puts google.appengine on sys.path
+
+application = main.app